@@ -0,0 +1,244 @@
+"""
+Throughput benchmarks of the stochastic and deterministic CSAN engines.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --output benchmark.json
+    python -m benchmarks.run_benchmarks --quick --only ssa
+    python -m benchmarks.run_benchmarks --compare old.json new.json
+
+Results are written as JSON: the environment they were measured in, and a record per case
+with the name of the benchmark, the case (sizes, parameter set, method...) and its metrics.
+--compare prints the ratio of every metric of the cases two result files have in common.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import scipy
+
+import constants
+from models.event import ConstantEvent, ConstantEventModel
+from models.metrics import RunMetrics
+from models.stochastic_csans import CSANModel
+from scripts.deterministic_csans import CSANDetModel
+
+RECEPTOR_COUNTS = [(1, 1), (4, 8), (10, 10), (20, 20)]
+SSA_METHODS = ["direct", "next_reaction", "sum_tree", "tau_leap", "vectorized"]
+SAMPLE_COUNTS = [100, 1000, 10000]
+DETERMINISTIC_RECEPTOR_COUNTS = [(4, 8), (10, 10), (20, 20)]
+CHAIN_LENGTHS = [10, 100, 300, 1000]
+HIGH_COPY_SCALES = [1, 10, 100]
+HIGH_COPY_DOSE = 640000
+HIGH_COPY_METHODS = ["sum_tree", "tau_leap"]
+
+
+def get_parameter_sets():
+    """Every parameter dictionary in constants.py, by name."""
+    return {name: value for name, value in vars(constants).items() if name.isupper() and isinstance(value, dict)}
+
+
+def get_initial_state(model, scale=1):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100 * scale
+    initial_state.Es[0] = 300 * scale
+    initial_state.D = 2000 * scale
+    return initial_state
+
+
+def benchmark_ssa(budget, quick=False):
+    """SSA steps per second of CSANModel, for every receptor count, parameter set and engine."""
+    receptor_counts = RECEPTOR_COUNTS[:2] if quick else RECEPTOR_COUNTS
+    for e_receptors, t_receptors in receptor_counts:
+        for method in SSA_METHODS:
+            model = CSANModel(e_receptors, t_receptors, method=method)
+            for parameter_name, parameters in get_parameter_sets().items():
+                metrics = measure_ssa(model, parameters, get_initial_state(model), budget)
+                yield {"name": "ssa_steps", "case": {"e_receptors": e_receptors, "t_receptors": t_receptors,
+                                                     "method": method, "parameters": parameter_name},
+                       "metrics": metrics}
+
+
+def measure_ssa(model, parameters, initial_state, budget, time_step=0.1, horizon=48):
+    """
+    Runs the model in steps of time_step until budget seconds have passed or horizon is reached.
+    Steps are counted by the engine through RunMetrics, whose bookkeeping is part of the measured time:
+    events fired or rejected by thinning, or leaps for tau leaping.
+    """
+    rng = np.random.default_rng(0)
+    parameters = model.compile_parameters(parameters)
+    metrics = RunMetrics()
+    state = initial_state
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget and metrics.simulated_time < horizon:
+        state = model.run(parameters, state, time_step, rng=rng, metrics=metrics)
+    seconds = time.perf_counter() - start
+    firing_count = sum(metrics.firings.values())
+    return {"steps": metrics.steps, "firings": firing_count, "seconds": seconds,
+            "steps_per_second": metrics.steps / seconds, "firings_per_second": firing_count / seconds,
+            "simulated_time": metrics.simulated_time}
+
+
+def benchmark_high_copy(quick=False, duration=0.1):
+    """
+    Wall time of a run of CSANModel with SIMPLE_D41_PARAMETERS at a dose of HIGH_COPY_DOSE, from the cell counts 
+    of get_initial_state scaled up by each of HIGH_COPY_SCALES, with the exact sum tree engine and with tau leaping.
+    The tau leaping record also has its speedup over the sum tree engine. Leaping only pays off at thousands of cells:
+    at the unscaled counts it takes exact steps at about the speed of the sum tree engine.
+    """
+    for e_receptors, t_receptors in RECEPTOR_COUNTS[:1] if quick else RECEPTOR_COUNTS[:2]:
+        model = CSANModel(e_receptors, t_receptors)
+        for scale in HIGH_COPY_SCALES:
+            initial_state = get_initial_state(model, scale)
+            initial_state.D = HIGH_COPY_DOSE
+            exact_seconds = None
+            for method in HIGH_COPY_METHODS:
+                metrics = RunMetrics()
+                model.run(constants.SIMPLE_D41_PARAMETERS, initial_state, duration, method=method, rng=0, metrics=metrics)
+                firing_count = sum(metrics.firings.values())
+                record_metrics = {"seconds": metrics.wall_seconds, "steps": metrics.steps, "firings": firing_count,
+                                  "firings_per_second": firing_count / metrics.wall_seconds}
+                if method == "sum_tree":
+                    exact_seconds = metrics.wall_seconds
+                else:
+                    record_metrics["speedup"] = exact_seconds / metrics.wall_seconds
+                yield {"name": "high_copy_run", "case": {"e_receptors": e_receptors, "t_receptors": t_receptors,
+                                                         "method": method, "parameters": "SIMPLE_D41_PARAMETERS",
+                                                         "scale": scale, "dose": HIGH_COPY_DOSE, "duration": duration},
+                       "metrics": record_metrics}
+
+
+def benchmark_generate(quick=False):
+    """Wall time and peak traced memory of generate_simulation_data on a (1, 1) CSANModel."""
+    model = CSANModel(1, 1)
+    timepoints = [4 * i for i in range(1, 13)]
+    for sample_count in SAMPLE_COUNTS[:1] if quick else SAMPLE_COUNTS:
+        start = time.perf_counter()
+        model.generate_simulation_data(constants.TEST_PARAMETERS, get_initial_state(model), timepoints, sample_count, seed=0,
+                                       progress=None)
+        seconds = time.perf_counter() - start
+
+        # Tracing slows allocation down, so memory is measured in a separate run.
+        tracemalloc.start()
+        model.generate_simulation_data(constants.TEST_PARAMETERS, get_initial_state(model), timepoints, sample_count, seed=0,
+                                       progress=None)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        yield {"name": "generate_simulation_data", "case": {"sample_count": sample_count, "timepoints": len(timepoints)},
+               "metrics": {"seconds": seconds, "samples_per_second": sample_count / seconds, "peak_bytes": peak_bytes}}
+
+
+def benchmark_deterministic(budget, quick=False):
+    """Right hand side evaluations per second of CSANDetModel, and the time of a full run with each solver."""
+    parameters = constants.EFFECTIVE_PARAMS
+    timepoints = [48 / 99 * i for i in range(100)]
+    receptor_counts = DETERMINISTIC_RECEPTOR_COUNTS[:1] if quick else DETERMINISTIC_RECEPTOR_COUNTS
+    for e_receptors, t_receptors in receptor_counts:
+        model = CSANDetModel(e_receptors, t_receptors)
+        initial_state = model.get_initial_state(20000, 30000, 10000)
+        model.get_derivative(initial_state, parameters)
+        evaluation_count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < budget:
+            model.get_derivative(initial_state, parameters)
+            evaluation_count += 1
+        seconds = time.perf_counter() - start
+        case = {"e_receptors": e_receptors, "t_receptors": t_receptors, "parameters": "EFFECTIVE_PARAMS"}
+        yield {"name": "ode_rhs", "case": case,
+               "metrics": {"evaluations": evaluation_count, "evaluations_per_second": evaluation_count / seconds}}
+
+        for method in ["odeint", "BDF"]:
+            start = time.perf_counter()
+            model.run(parameters, initial_state, timepoints, method=method)
+            yield {"name": "ode_run", "case": dict(case, method=method),
+                   "metrics": {"seconds": time.perf_counter() - start}}
+
+
+def benchmark_stable_distribution(budget, quick=False):
+    """Time of ConstantEventModel.get_stable_distribution on birth-death chains of increasing length."""
+    parameters = {"birth": 1.0, "death": 2.0}
+    for chain_length in CHAIN_LENGTHS[:2] if quick else CHAIN_LENGTHS:
+        events = []
+        for state in range(chain_length - 1):
+            events.append(ConstantEvent(state, state + 1, lambda parameters: parameters["birth"]))
+            events.append(ConstantEvent(state + 1, state, lambda parameters: parameters["death"]))
+        model = ConstantEventModel(events)
+        call_count = 0
+        start = time.perf_counter()
+        while call_count == 0 or time.perf_counter() - start < budget:
+            model.get_stable_distribution(parameters)
+            call_count += 1
+        yield {"name": "stable_distribution", "case": {"states": chain_length},
+               "metrics": {"seconds": (time.perf_counter() - start) / call_count, "calls": call_count}}
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def run_benchmarks(only=None, budget=0.5, quick=False):
+    """Returns the results of the benchmarks whose names start with only, or of all of them."""
+    suites = {
+        "ssa": lambda: benchmark_ssa(budget, quick),
+        "high_copy": lambda: benchmark_high_copy(quick),
+        "generate": lambda: benchmark_generate(quick),
+        "deterministic": lambda: benchmark_deterministic(budget, quick),
+        "stable_distribution": lambda: benchmark_stable_distribution(budget, quick),
+    }
+    results = []
+    for suite_name, suite in suites.items():
+        if only is not None and not suite_name.startswith(only):
+            continue
+        for record in suite():
+            print(record["name"], record["case"], {name: round(value, 3) for name, value in record["metrics"].items()})
+            results.append(record)
+    return {"environment": get_environment(), "results": results}
+
+
+def compare(old_path, new_path):
+    """Prints new / old for every metric of the cases in both result files."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old_results, new_results = json.load(old_file)["results"], json.load(new_file)["results"]
+    old_by_case = {(record["name"], json.dumps(record["case"], sort_keys=True)): record for record in old_results}
+    for record in new_results:
+        old_record = old_by_case.get((record["name"], json.dumps(record["case"], sort_keys=True)))
+        if old_record is None:
+            continue
+        ratios = {name: value / old_record["metrics"][name]
+                  for name, value in record["metrics"].items() if old_record["metrics"].get(name)}
+        print(record["name"], record["case"], {name: round(ratio, 3) for name, ratio in ratios.items()})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the CSAN engines.")
+    parser.add_argument("--output", help="Path of the JSON file to write the results to.")
+    parser.add_argument("--only", help="Only run the suites whose names start with this: "
+                                       "ssa, high_copy, generate, deterministic or stable_distribution.")
+    parser.add_argument("--budget", type=float, default=0.5, help="Seconds spent measuring each throughput case.")
+    parser.add_argument("--quick", action="store_true", help="Only run the smallest cases.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead.")
+    arguments = parser.parse_args()
+    if arguments.compare:
+        compare(*arguments.compare)
+    else:
+        benchmark_results = run_benchmarks(arguments.only, arguments.budget, arguments.quick)
+        if arguments.output:
+            with open(arguments.output, "w") as output_file:
+                json.dump(benchmark_results, output_file, indent=2)
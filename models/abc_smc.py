@@ -0,0 +1,180 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy.stats import multivariate_normal
+
+
+def _simulate_particle(model, conditions, timepoints, observable, tolerance, run_options, parameters, seed_sequence):
+    """
+    Returns the distance between the data and a simulation of every condition with parameters, or inf as soon as
+    the partial distance exceeds tolerance, and the simulated time.
+    Each condition is only simulated up to its last data point.
+    """
+    squared_tolerance = tolerance ** 2
+    squared_distance = 0.0
+    simulated_time = 0
+    for (initial_state, data), condition_seed in zip(conditions, seed_sequence.spawn(len(conditions))):
+        condition_timepoints = timepoints[:len(data)]
+        data_by_time = dict(zip(condition_timepoints, data))
+        remaining_timepoints = iter(condition_timepoints)
+
+        def early_stop(timepoint_data):
+            nonlocal squared_distance
+            time = next(remaining_timepoints)
+            squared_distance += (data_by_time[time] - observable(timepoint_data[time])) ** 2
+            return squared_distance > squared_tolerance
+
+        sample = model.generate_sample(parameters, initial_state, condition_timepoints, condition_seed,
+                                       early_stop=early_stop, **run_options)
+        simulated_time += max(sample)
+        if squared_distance > squared_tolerance:
+            return np.inf, simulated_time
+    return np.sqrt(squared_distance), simulated_time
+
+
+class ABCSMC:
+    """
+    Approximate Bayesian computation by sequential Monte Carlo, for parameters of a stochastic model
+    whose likelihood is out of reach.
+
+    Like a SimulationObjective, the data is a list of conditions, each an initial state and the values
+    of observable at timepoints. The distance of a particle (a parameter vector) to the data is the Euclidean
+    distance between the data and the observable of one simulation of each condition.
+
+    The first generation samples the prior, uniform within bounds. Each later generation keeps particles within
+    a tolerance, the quantile of the distances of the previous one, proposed by perturbing particles of the
+    previous generation with a Gaussian of twice their weighted covariance, as in Beaumont et al. (2009).
+    Since the partial distance only grows along a trajectory, a simulation is abandoned at the first
+    recorded timepoint where it exceeds the tolerance, which saves most of the simulated time of rejected particles.
+
+    Particles are simulated in workers processes, or on executor if one is given. Each proposal draws from
+    its own random stream spawned from seed, so results do not depend on the number of workers.
+    """
+
+    def __init__(self, model, conditions, timepoints, observable, bounds, get_parameters=dict, particle_count=100,
+                 workers=None, executor=None, seed=None, **run_options):
+        """
+        observable must be picklable, such as a module level function, when particles are simulated in processes.
+        get_parameters turns a parameter vector into the parameter dictionary of the model.
+        run_options are passed to run.
+        """
+        self.model = model
+        self.conditions = conditions
+        self.timepoints = list(timepoints)
+        self.observable = observable
+        self.bounds = np.array(bounds, dtype=float)
+        self.get_parameters = get_parameters
+        self.particle_count = particle_count
+        self.workers = workers
+        self.executor = executor
+        self.run_options = run_options
+        self.rng = np.random.default_rng(seed)
+        self._seed_sequence = np.random.SeedSequence(seed)
+        self._process_pool = None
+
+    def run(self, generation_count=5, quantile=0.5, minimum_tolerance=0):
+        """
+        Runs generations until generation_count of them have run or the tolerance falls to minimum_tolerance.
+        Returns a dictionary of:
+            - particles: (particle_count x parameters) array of the last generation.
+            - weights: their normalized importance weights.
+            - distances: their distances to the data.
+            - generations: a dictionary per generation of its tolerance, the number of simulations,
+            the acceptance rate and the fraction of the time of full simulations that was actually simulated.
+        """
+        particles, weights, distances = None, None, None
+        tolerance = np.inf
+        generations = []
+        for generation_index in range(generation_count):
+            if generation_index > 0:
+                tolerance = max(float(np.quantile(distances, quantile)), minimum_tolerance)
+            particles, weights, distances, statistics = self._run_generation(particles, weights, tolerance)
+            statistics["tolerance"] = tolerance
+            generations.append(statistics)
+            if tolerance <= minimum_tolerance:
+                break
+        return {"particles": particles, "weights": weights, "distances": distances, "generations": generations}
+
+    def close(self):
+        """Shuts down the worker processes, if any were started."""
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _run_generation(self, previous_particles, previous_weights, tolerance):
+        free = self.bounds[:, 1] > self.bounds[:, 0]
+        if previous_particles is not None:
+            covariance = 2 * np.atleast_2d(np.cov(previous_particles[:, free], rowvar=False, aweights=previous_weights))
+            widths = self.bounds[free, 1] - self.bounds[free, 0]
+            covariance += np.diag((1e-6 * widths) ** 2)
+            kernel = multivariate_normal(cov=covariance)
+
+        full_time = sum(self.timepoints[:len(data)][-1] for _, data in self.conditions if len(data) > 0)
+        accepted, accepted_distances = [], []
+        simulation_count, simulated_time = 0, 0
+        acceptance_rate = 1.0
+        while len(accepted) < self.particle_count:
+            remaining = self.particle_count - len(accepted)
+            proposal_count = min(int(np.ceil(remaining / max(acceptance_rate, 0.01))), 20 * self.particle_count)
+            if previous_particles is None:
+                proposals = self.rng.uniform(self.bounds[:, 0], self.bounds[:, 1], size=(proposal_count, len(self.bounds)))
+            else:
+                proposals = np.array([self._perturb(previous_particles, previous_weights, kernel, free)
+                                      for _ in range(proposal_count)])
+            results = self._simulate(proposals, tolerance)
+            for proposal, (distance, particle_time) in zip(proposals, results):
+                simulation_count += 1
+                simulated_time += particle_time
+                if distance <= tolerance and len(accepted) < self.particle_count:
+                    accepted.append(proposal)
+                    accepted_distances.append(distance)
+            acceptance_rate = len(accepted) / simulation_count
+
+        particles = np.array(accepted)
+        if previous_particles is None:
+            weights = np.ones(len(particles))
+        else:
+            # The prior is uniform, so weights are the inverse of the density of the proposal distribution.
+            differences = particles[:, None, free] - previous_particles[None, :, free]
+            proposal_density = kernel.pdf(differences.reshape(-1, np.count_nonzero(free))).reshape(len(particles), -1)
+            weights = 1 / (proposal_density @ previous_weights)
+        statistics = {
+            "simulation_count": simulation_count,
+            "acceptance_rate": acceptance_rate,
+            "simulated_time_fraction": simulated_time / (simulation_count * full_time) if full_time > 0 else 1.0,
+        }
+        return particles, weights / weights.sum(), np.array(accepted_distances), statistics
+
+    def _perturb(self, previous_particles, previous_weights, kernel, free):
+        """Returns a perturbation of a particle drawn by weight, redrawn until it is within bounds."""
+        while True:
+            particle = previous_particles[self.rng.choice(len(previous_particles), p=previous_weights)].copy()
+            particle[free] += np.atleast_1d(kernel.rvs(random_state=self.rng))
+            if np.all((particle >= self.bounds[:, 0]) & (particle <= self.bounds[:, 1])):
+                return particle
+
+    def _simulate(self, proposals, tolerance):
+        simulate_particle = partial(_simulate_particle, self.model, self.conditions, self.timepoints, self.observable,
+                                    tolerance, self.run_options)
+        parameter_sets = [self.get_parameters(list(proposal)) for proposal in proposals]
+        seed_sequences = self._seed_sequence.spawn(len(proposals))
+        executor = self._get_executor()
+        if executor is None:
+            return list(map(simulate_particle, parameter_sets, seed_sequences))
+        return list(executor.map(simulate_particle, parameter_sets, seed_sequences))
+
+    def _get_executor(self):
+        if self.executor is not None:
+            return self.executor
+        if self.workers is None or self.workers <= 1:
+            return None
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._process_pool
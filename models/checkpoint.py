@@ -0,0 +1,208 @@
+import os
+import pickle
+from time import perf_counter
+
+import numpy as np
+
+from models.metrics import RunMetrics
+from models.random_stream import as_random_stream
+from models.timepoint_recorder import TimepointRecorder
+
+
+class ResumableSimulation:
+    """
+    generate_simulation_data that saves its progress to a checkpoint file and can be stopped and resumed.
+
+    Samples are run one segment at a time. A segment runs to the next timepoint, or for at most
+    checkpoint_interval of simulated time, so single long trajectories can be checkpointed too.
+    With checkpoint_interval=None segments always run to the next timepoint.
+    The simulation can stop for a budget, and its progress is saved every checkpoint_seconds between segments:
+    the completed samples, and the state, simulation time and random stream of the sample in progress.
+    Resuming from a checkpoint continues bit-exactly: the samples are those of an uninterrupted
+    ResumableSimulation with the same seed and checkpoint_interval, unless a run was stopped inside a segment. 
+    Since runs restart at every segment, and wherever they were stopped, they are not those of the single pass 
+    of generate_simulation_data, though for the exact engines they follow the same distribution.
+
+    Create a simulation with its constructor, or load one with ResumableSimulation.resume, then call run.
+    Samples run one after another in this process. Model.generate_simulation_data(..., checkpoint=path) does both.
+    """
+
+    def __init__(self, model, parameters, initial_state, timepoints, sample_count=1, seed=None, path=None,
+                 checkpoint_seconds=60, checkpoint_interval=1, **run_options):
+        """path is the checkpoint file. Without one nothing is saved. run_options are passed to run."""
+        self.model = model
+        self.parameters = parameters
+        self.initial_state = initial_state
+        self.timepoints = list(timepoints)
+        self.sample_count = sample_count
+        self.path = path
+        self.checkpoint_seconds = checkpoint_seconds
+        self.checkpoint_interval = checkpoint_interval
+        self.run_options = run_options
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequences = seed.spawn(sample_count)
+        self.samples = []
+        self._sample = None
+
+    @staticmethod
+    def resume(path, model, checkpoint_seconds=60):
+        """Returns the simulation saved at path, for model, which must be like the one it was created with."""
+        with open(path, "rb") as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        if checkpoint["model"] != model.get_cache_description():
+            raise ValueError("The checkpoint was saved for a different model")
+        simulation = ResumableSimulation(model, checkpoint["parameters"], checkpoint["initial_state"],
+                                         checkpoint["timepoints"], checkpoint["sample_count"], path=path,
+                                         checkpoint_seconds=checkpoint_seconds,
+                                         checkpoint_interval=checkpoint["checkpoint_interval"],
+                                         **checkpoint["run_options"])
+        simulation.seed_sequences = checkpoint["seed_sequences"]
+        simulation.samples = checkpoint["samples"]
+        simulation._sample = checkpoint["sample"]
+        return simulation
+
+    @property
+    def complete(self):
+        return len(self.samples) == self.sample_count
+
+    def run(self, time_budget=None, step_budget=None):
+        """
+        Runs until every sample is complete, or until time_budget seconds have passed or step_budget steps
+        have been taken, and returns get_result. 
+        The engines in both the instrumented_methods and the recording_methods of the model check the budgets 
+        at every step, and stop inside a segment once one is exhausted. So does a max_num_steps of run_options:
+        a run that takes that many steps stops, and the sample continues from there at the next call of run.
+        With any other engine budgets are checked between segments, max_num_steps raises a RuntimeError as in run,
+        and a step_budget raises a ValueError, since steps are not counted.
+        The checkpoint is saved when run returns. If run is interrupted, for example by KeyboardInterrupt, 
+        the segment in progress has drawn random numbers it did not use, so the checkpoint is left as it was 
+        at the last save and only the progress since then is lost.
+        """
+        method = self.run_options.get("method", getattr(self.model, "method", None))
+        stops_in_run = (method in getattr(self.model, "instrumented_methods", ())
+                        and method in getattr(self.model, "recording_methods", ()))
+        if step_budget is not None and not stops_in_run:
+            raise ValueError(f"Steps are not counted by the {method} method, so it cannot run with a step_budget")
+        start = last_save = perf_counter()
+        metrics = None
+        if stops_in_run and (time_budget is not None or step_budget is not None
+                             or self.run_options.get("max_num_steps") is not None):
+            metrics = _BudgetMetrics(None if time_budget is None else start + time_budget, step_budget,
+                                     self.run_options.get("max_num_steps"))
+        parameters = self.model.compile_parameters(self.parameters)
+        while not self.complete:
+            if time_budget is not None and perf_counter() - start >= time_budget:
+                break
+            if metrics is not None and metrics.exhausted:
+                break
+            self._run_segment(parameters, metrics)
+            if self.path is not None and perf_counter() - last_save >= self.checkpoint_seconds:
+                self.save()
+                last_save = perf_counter()
+        if self.path is not None:
+            self.save()
+        return self.get_result()
+
+    def get_result(self):
+        """Returns the completed samples in the format of generate_simulation_data, and whether all are complete."""
+        return {
+            "parameters": self.parameters,
+            "model": self.model.name,
+            "data": list(self.samples),
+            "timepoints": self.timepoints,
+            "complete": self.complete,
+        }
+
+    def save(self):
+        """Writes the checkpoint to path, replacing the previous one only once it is fully written."""
+        checkpoint = {
+            "model": self.model.get_cache_description(),
+            "parameters": dict(self.parameters),
+            "initial_state": self.initial_state,
+            "timepoints": self.timepoints,
+            "sample_count": self.sample_count,
+            "checkpoint_interval": self.checkpoint_interval,
+            "run_options": self.run_options,
+            "seed_sequences": self.seed_sequences,
+            "samples": self.samples,
+            "sample": self._sample,
+        }
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path)
+
+    def _run_segment(self, parameters, metrics):
+        """Runs the sample in progress, starting a new one if there is none, up to its next timepoint or for checkpoint_interval."""
+        if self._sample is None:
+            self._sample = {
+                "timepoint_data": {0: self.initial_state},
+                "state": self.initial_state,
+                "time": 0,
+                "timepoint_index": 0,
+                "rng": as_random_stream(self.seed_sequences[len(self.samples)]),
+            }
+        sample = self._sample
+        timepoint = self.timepoints[sample["timepoint_index"]]
+        if self.checkpoint_interval is None or timepoint - sample["time"] <= self.checkpoint_interval:
+            end_time = timepoint
+        else:
+            end_time = sample["time"] + self.checkpoint_interval
+        run_options = self.run_options
+        recorder = None
+        if metrics is not None:
+            recorder = TimepointRecorder(sample["state"], [])
+            metrics.start_run(recorder)
+            run_options = dict(run_options, metrics=metrics, recorder=recorder, max_num_steps=None)
+        state = self.model.run(parameters, sample["state"], end_time - sample["time"], rng=sample["rng"], **run_options)
+        sample["state"] = state
+        if recorder is not None and recorder.stop_time is not None and sample["time"] + recorder.stop_time < end_time:
+            sample["time"] += recorder.stop_time
+            return
+        sample["time"] = end_time
+        if end_time == timepoint:
+            sample["timepoint_data"][timepoint] = sample["state"]
+            sample["timepoint_index"] += 1
+            if sample["timepoint_index"] == len(self.timepoints):
+                self.samples.append(sample["timepoint_data"])
+                self._sample = None
+
+
+class _BudgetMetrics(RunMetrics):
+    """
+    RunMetrics that stops the engine through the recorder of its run once the deadline of perf_counter,
+    the step_budget of all runs or the max_num_steps of a single run is reached. 
+    """
+
+    def __init__(self, deadline=None, step_budget=None, max_num_steps=None):
+        super().__init__()
+        self.deadline = deadline
+        self.step_budget = step_budget
+        self.max_num_steps = max_num_steps
+        self.exhausted = False
+        self._recorder = None
+        self._run_start_steps = 0
+
+    def start_run(self, recorder):
+        self._recorder = recorder
+        self._run_start_steps = self.steps
+
+    def record_firing(self, event):
+        super().record_firing(event)
+        self._check_budgets()
+
+    def record_leap(self, events, firings):
+        super().record_leap(events, firings)
+        self._check_budgets()
+
+    def record_rejection(self):
+        super().record_rejection()
+        self._check_budgets()
+
+    def _check_budgets(self):
+        if ((self.step_budget is not None and self.steps >= self.step_budget)
+                or (self.max_num_steps is not None and self.steps - self._run_start_steps >= self.max_num_steps)
+                or (self.deadline is not None and perf_counter() >= self.deadline)):
+            self.exhausted = True
+            self._recorder.stop()
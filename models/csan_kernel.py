@@ -0,0 +1,85 @@
+import numpy as np
+
+from models.csan_parameters import get_formation_rate_table
+
+
+class CSANPropensityKernel:
+    """
+    Computes the rates of every event of a CSANModel at once with NumPy.
+
+    States are flat arrays in the State.export_to_list layout. A 2D array is treated as
+    a batch of states, one per row. Rates are returned in the order of CSANModel.events
+    and are bit-identical to calling get_max_rate on each event: every rate is computed
+    with the same floating point operations, in the same order, as the event classes.
+    Counts are converted to floats first, so products of counts above 2**53, which the events
+    multiply exactly as Python integers, may differ from theirs in the last bit.
+    """
+
+    def __init__(self, e_receptors, t_receptors):
+        self.e_receptors = e_receptors
+        self.t_receptors = t_receptors
+        self.dimension = 3 + e_receptors + t_receptors + 2 * e_receptors * t_receptors
+
+        self._Es_start = 1
+        self._Ts_start = self._Es_start + e_receptors + 1
+        self._EDTs_start = self._Ts_start + t_receptors + 1
+        self._ETs_start = self._EDTs_start + e_receptors * t_receptors
+
+        self._e_bound = np.arange(e_receptors + 1)
+        self._t_bound = np.arange(t_receptors + 1)
+        self._e_free = e_receptors - self._e_bound
+        self._t_free = t_receptors - self._t_bound
+
+        self._parameters = None
+        self._formation_table = None
+
+    def get_rates(self, flat_state, parameters):
+        """Returns the rate of every event at a flat state, or at every row of a batch of flat states."""
+        # Products of counts overflow int64 at around 1e9 CSANs and cells, so they are taken in floating point.
+        flat_state = np.asarray(flat_state, dtype=float)
+        batch_shape = flat_state.shape[:-1]
+        D = flat_state[..., 0:1]
+        Es = flat_state[..., self._Es_start:self._Ts_start]
+        Ts = flat_state[..., self._Ts_start:self._EDTs_start]
+        EDTs = flat_state[..., self._EDTs_start:self._ETs_start]
+        ETs = flat_state[..., self._ETs_start:self.dimension]
+
+        TCell_rates = np.stack([
+            Es * parameters["d_E"],
+            D * self._e_free * Es * parameters["lambda_E"],
+            self._e_bound * Es * parameters["mu_E"],
+        ], axis=-1)
+        tumor_rates = np.stack([
+            Ts * parameters["b_T"],
+            D * self._t_free * Ts * parameters["lambda_T"],
+            self._t_bound * Ts * parameters["mu_T"],
+        ], axis=-1)
+
+        # Outer product of the Es and Ts counts, scaled by the rate constants of the three complexes.
+        formation_rates = self._get_formation_table(parameters) * Es[..., :, None, None] * Ts[..., None, :, None]
+
+        complex_rates = np.stack([
+            parameters["d_EDT"] * EDTs,
+            parameters["d_ET"] * ETs,
+        ], axis=-1)
+
+        return np.concatenate([
+            TCell_rates.reshape(batch_shape + (-1,)),
+            tumor_rates.reshape(batch_shape + (-1,)),
+            formation_rates.reshape(batch_shape + (-1,)),
+            complex_rates.reshape(batch_shape + (-1,)),
+        ], axis=-1)
+
+    def _get_formation_table(self, parameters):
+        """
+        Returns the formation rate constants as an (e_receptors + 1) x (t_receptors + 1) x 3 array.
+        They depend only on the parameters, so they are cached until the parameters change.
+        """
+        if self._parameters is not None and self._parameters == parameters:
+            return self._formation_table
+        table = getattr(parameters, "formation_rate_constants", None)
+        if table is None:
+            table = get_formation_rate_table(parameters, self.e_receptors, self.t_receptors)
+        self._parameters = dict(parameters)
+        self._formation_table = np.array(table, dtype=float)
+        return self._formation_table
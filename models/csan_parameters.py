@@ -0,0 +1,27 @@
+def get_formation_rate_constants(parameters, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
+    """
+    Returns the rate constants of forming an EDT complex with the CSAN on the TCell (ED_T),
+    an EDT complex with the CSAN on the tumor cell (E_DT) and an ET complex (E_T)
+    from a TCell and a tumor cell with the given bound CSAN counts.
+    The rate of each formation event is its rate constant times the number of TCells times the number of tumor cells.
+    """
+    receptor_product = TCell_receptors * tumor_receptors
+    c_e_t = (TCell_receptors - TCell_bound_count) * (tumor_receptors - tumor_bound_count) * parameters["p_E|T"] / receptor_product
+    c_e_dt = (TCell_receptors - TCell_bound_count) * tumor_bound_count * parameters["p_E|DT"] / receptor_product
+    c_ed_t = TCell_bound_count * (tumor_receptors - tumor_bound_count) * parameters["p_ED|T"] / receptor_product
+
+    c_f = 1 - c_e_t - c_e_dt - c_ed_t
+    if c_f == 1:
+        return 0, 0, 0
+    formation_constant = parameters["lambda_ET"] * (1 - c_f ** parameters["M"]) / (c_e_t + c_e_dt + c_ed_t)
+    return formation_constant * c_ed_t, formation_constant * c_e_dt, formation_constant * c_e_t
+
+
+def get_formation_rate_table(parameters, TCell_receptors, tumor_receptors):
+    """
+    Returns get_formation_rate_constants for every pair of bound CSAN counts,
+    as nested lists indexed by TCell bound count, then tumor bound count.
+    """
+    return [[get_formation_rate_constants(parameters, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors)
+             for tumor_bound_count in range(tumor_receptors + 1)]
+            for TCell_bound_count in range(TCell_receptors + 1)]
@@ -0,0 +1,153 @@
+import numpy as np
+
+
+class RunningMoments:
+    """Mean and variance of a stream of equally shaped arrays, updated one array at a time with Welford's algorithm."""
+
+    def __init__(self):
+        self.count = 0
+        self._mean = None
+        self._squared_deviations = None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        self.count += 1
+        if self.count == 1:
+            self._mean = values.copy()
+            self._squared_deviations = np.zeros_like(values)
+            return
+        delta = values - self._mean
+        self._mean += delta / self.count
+        self._squared_deviations += delta * (values - self._mean)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        """The sample variance. Zero until two arrays have been added."""
+        if self.count < 2:
+            return None if self._mean is None else np.zeros_like(self._mean)
+        return self._squared_deviations / (self.count - 1)
+
+
+class P2Quantile:
+    """
+    Streaming estimate of the p-quantile of every entry of a stream of equally shaped arrays,
+    with the P-square algorithm of Jain and Chlamtac (1985).
+    Memory does not grow with the number of arrays: each entry keeps five markers.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._first_values = []
+        self._heights = None
+        self._positions = None
+        self._desired_positions = None
+        self._desired_increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        self.count += 1
+        if self.count <= 5:
+            self._first_values.append(values)
+            if self.count == 5:
+                self._heights = np.sort(np.stack(self._first_values, axis=-1), axis=-1)
+                shape = self._heights.shape
+                self._positions = np.broadcast_to(np.arange(1.0, 6.0), shape).copy()
+                desired = [1, 1 + 2 * self.p, 1 + 4 * self.p, 3 + 2 * self.p, 5]
+                self._desired_positions = np.broadcast_to(np.array(desired), shape).copy()
+                self._first_values = []
+            return
+
+        heights = self._heights
+        positions = self._positions
+        heights[..., 0] = np.minimum(heights[..., 0], values)
+        heights[..., 4] = np.maximum(heights[..., 4], values)
+        cells = (values[..., None] >= heights[..., 1:4]).sum(axis=-1)
+        positions += np.arange(5) > cells[..., None]
+        self._desired_positions += self._desired_increments
+
+        for i in (1, 2, 3):
+            offset = self._desired_positions[..., i] - positions[..., i]
+            gap_above = positions[..., i + 1] - positions[..., i]
+            gap_below = positions[..., i] - positions[..., i - 1]
+            move = ((offset >= 1) & (gap_above > 1)) | ((offset <= -1) & (gap_below > 1))
+            if not move.any():
+                continue
+            step = np.sign(offset)
+            height = heights[..., i]
+            parabolic = height + step / (positions[..., i + 1] - positions[..., i - 1]) * (
+                (gap_below + step) * (heights[..., i + 1] - height) / gap_above
+                + (gap_above - step) * (height - heights[..., i - 1]) / gap_below)
+            neighbour_height = np.where(step > 0, heights[..., i + 1], heights[..., i - 1])
+            neighbour_gap = np.where(step > 0, gap_above, -gap_below)
+            linear = height + step * (neighbour_height - height) / neighbour_gap
+            in_order = (heights[..., i - 1] < parabolic) & (parabolic < heights[..., i + 1])
+            heights[..., i] = np.where(move, np.where(in_order, parabolic, linear), height)
+            positions[..., i] += np.where(move, step, 0)
+
+    @property
+    def value(self):
+        """The current estimate. Exact while fewer than five arrays have been added."""
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            return np.quantile(np.stack(self._first_values, axis=-1), self.p, axis=-1)
+        return self._heights[..., 2].copy()
+
+
+class EnsembleSummary:
+    """
+    Online summary of simulation samples, in the timepoint data format of generate_simulation_data.
+
+    observables maps names to functions of a state, such as {"T": State.T}. For every observable
+    and timepoint it keeps the running mean and variance and streaming estimates of quantiles,
+    so memory does not grow with the number of samples added.
+    """
+
+    def __init__(self, observables: dict, quantiles=(0.05, 0.5, 0.95)):
+        self.observables = observables
+        self.quantiles = quantiles
+        self.timepoints = None
+        self._moments = RunningMoments()
+        self._quantile_estimates = [P2Quantile(p) for p in quantiles]
+
+    @property
+    def sample_count(self):
+        return self._moments.count
+
+    def add(self, timepoint_data):
+        """Adds one sample."""
+        if self.timepoints is None:
+            self.timepoints = list(timepoint_data.keys())
+        values = np.array([[observable(timepoint_data[time]) for time in self.timepoints]
+                           for observable in self.observables.values()], dtype=float)
+        self._moments.add(values)
+        for estimate in self._quantile_estimates:
+            estimate.add(values)
+
+    def get_summary(self):
+        """
+        Returns
+        {
+            "timepoints": [timepoints],
+            "sample_count": [number of samples added],
+            "observables": {name: {"mean": [...], "variance": [...], "quantiles": {p: [...]}}},
+        }
+        """
+        summary = {"timepoints": self.timepoints, "sample_count": self.sample_count, "observables": {}}
+        if self.sample_count == 0:
+            return summary
+        means = self._moments.mean
+        variances = self._moments.variance
+        quantile_values = [estimate.value for estimate in self._quantile_estimates]
+        for index, name in enumerate(self.observables):
+            summary["observables"][name] = {
+                "mean": means[index].tolist(),
+                "variance": variances[index].tolist(),
+                "quantiles": {p: values[index].tolist() for p, values in zip(self.quantiles, quantile_values)},
+            }
+        return summary
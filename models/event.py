@@ -1,10 +1,33 @@
 from copy import deepcopy
-from random import random
 from abc import abstractmethod
+from time import perf_counter
 
 import numpy as np
 from scipy.linalg import solve
 from models.model import Model
+from models.random_stream import as_random_stream
+from models.priority_queue import IndexedPriorityQueue
+from models.reaction_network import ReactionNetwork
+from models.sum_tree import PropensityTree
+from models.timepoint_recorder import TimepointRecorder
+
+
+def get_state_field(state, field):
+    """Returns the value of a field such as ("D",) or ("EDTs", 1, 3) of state."""
+    value = getattr(state, field[0])
+    for index in field[1:]:
+        value = value[index]
+    return value
+
+def add_to_state_field(state, field, amount):
+    """Adds amount to a field such as ("D",) or ("EDTs", 1, 3) of state. Mutates state."""
+    if len(field) == 1:
+        setattr(state, field[0], getattr(state, field[0]) + amount)
+        return
+    container = getattr(state, field[0])
+    for index in field[1:-1]:
+        container = container[index]
+    container[field[-1]] = container[field[-1]] + amount
 
 class Event:
     """
@@ -29,6 +52,65 @@ class Event:
         """Returns the new state after event is implemented.
         Mutates the state to become the new state."""
 
+    def get_rate_constant(self, model_parameters):
+        """
+        Returns a number that is zero exactly when the rate of the event is zero in every state, 
+        such as the rate per reactant of mass action events.
+        None means unknown, in which case the event is never assumed to be impossible.
+        """
+        return None
+
+    def get_reads(self):
+        """
+        Returns the set of state fields the rate of the event depends on.
+        Fields are tuples such as ("D",), ("Es", 2) or ("EDTs", 1, 3).
+        None means unknown, in which case the event is assumed to depend on every field.
+        """
+        return None
+
+    def get_writes(self):
+        """
+        Returns the set of state fields that implement may change, in the same format as get_reads.
+        None means unknown, in which case the event is assumed to change every field.
+        """
+        return None
+
+    def get_state_change(self):
+        """
+        Returns a dictionary from state field to the change implement makes to it.
+        For events with random effects, this is the expected change. 
+        None means unknown, in which case approximate methods such as tau leaping cannot be used.
+        """
+        return None
+
+    def get_propensity_law(self):
+        """
+        Returns how the rate of the event depends on the state, for ReactionNetwork:
+        "mass_action" if it is get_rate_constant times the product of the fields in get_reads.
+        None means unknown.
+        """
+        return None
+
+    def has_random_effect(self):
+        """Returns whether implement changes the state randomly, in which case get_state_change is the expected change."""
+        return False
+
+    def get_state_change_distribution(self):
+        """
+        Returns the possible changes implement makes, as a list of (probability, state change dictionary).
+        None means unknown. Events without random effects have a single change, get_state_change.
+        """
+        if self.has_random_effect():
+            return None
+        state_change = self.get_state_change()
+        return None if state_change is None else [(1, state_change)]
+
+    def implement_many(self, state, count, **kwargs):
+        """Implements the event count times. Mutates the state to become the new state."""
+        for _ in range(count):
+            self.implement(state, **kwargs)
+        return state
+
 class TimeIndependentEvent(Event):
     """Class for events whose rate does not depend on time."""
     def get_rate(self, state, time, model_parameters):
@@ -47,9 +129,31 @@ class ConstantEvent(TimeIndependentEvent):
             return self.get_rate_from_parameters(model_parameters)
         return 0
 
-    def implement(self, state):
+    def implement(self, state, **kwargs):
         return self.end_state
 
+    def get_rate_constant(self, model_parameters):
+        return self.get_rate_from_parameters(model_parameters)
+
+class CompiledParameters(dict):
+    """
+    Parameters prepared for running a particular EventModel, made by EventModel.compile_parameters.
+    They are still a dictionary of the parameters, and in addition have:
+        - events: the events of the model they were compiled for.
+        - rate_constants: the get_rate_constant of each event.
+        - active_events: the indices of the events that can occur, whose rate constant is not zero.
+        - any tables precomputed from the parameters by the model, as attributes.
+    """
+
+    def __init__(self, parameters, events, **tables):
+        super().__init__(parameters)
+        self.events = events
+        for name, table in tables.items():
+            setattr(self, name, table)
+        self.rate_constants = [event.get_rate_constant(self) for event in events]
+        self.active_events = tuple(index for index, rate_constant in enumerate(self.rate_constants) 
+                                   if rate_constant != 0)
+
 class EventModel(Model):
     """
     Abstract class to handle event-driven time-independent models.
@@ -75,39 +179,172 @@ class EventModel(Model):
     """
 
     name = "Event-Driven Model"
+    methods = ("direct", "next_reaction", "sum_tree", "tau_leap")
+    instrumented_methods = ("direct", "next_reaction", "sum_tree", "tau_leap")
+    recording_methods = ("direct", "next_reaction", "sum_tree", "tau_leap")
 
-    def __init__(self, events: list[Event]):
-        """"""
+    def __init__(self, events: list[Event], method="direct"):
+        """
+        method selects the simulation engine used by run:
+            - "direct": Gillespie's direct method. Every rate is recomputed every step.
+            - "next_reaction": Gibson and Bruck's next reaction method. Only the rates
+            of events that depend on the fired event are recomputed.
+            - "sum_tree": the direct method with rates stored in a sum tree. Only the rates
+            of dependent events are recomputed and events are selected in O(log n).
+            - "tau_leap": approximate explicit tau leaping. See _run_tau_leap.
+        """
         self.events = events
-
-    def run(self, parameters: dict, initial_state, duration: float, max_num_steps=None, verbose=False):
+        self.method = method
+        self._dependency_graph = None
+        self._active_event_cache = {}
+        self._leap_table_cache = {}
+        self._reaction_network = None
+
+    def run(self, parameters: dict, initial_state, duration: float, max_num_steps=None, verbose=False,
+            method=None, rng=None, metrics=None, **options):
         """
         Returns the result of running the model. Does not mutate any of the arguments.  
+        method overrides the engine chosen when the model was instantiated.
+        rng is the source of randomness: a RandomStream, a numpy Generator, or a seed or SeedSequence for one.
+        If metrics is a RunMetrics, the run is recorded in it. Engines in instrumented_methods record every step.
+        Any other keyword arguments are options of the engine.
+        """
+        method = self.method if method is None else method
+        if method not in self.methods:
+            raise ValueError(f"Unknown simulation method {method}. Choose one of {self.methods}")
+        engine = getattr(self, f"_run_{method}")
+        if metrics is not None:
+            start = perf_counter()
+            if method in self.instrumented_methods:
+                options["metrics"] = metrics
+        current_state = engine(self.compile_parameters(parameters), deepcopy(initial_state), duration, max_num_steps, as_random_stream(rng), **options)
+        if metrics is not None:
+            metrics.record_run(duration, perf_counter() - start)
+        if verbose:
+            print(current_state)
+        return current_state
+
+    def run_recorded(self, parameters, initial_state, timepoints: list, on_record=None, method=None, **kwargs):
+        """
+        Returns the states of a single trajectory at timepoints as in Model.run_recorded.
+        Engines in recording_methods run the whole trajectory in a single pass, copying the state only 
+        into a TimepointRecorder as each timepoint is crossed, so dense timepoints cost little.
+        Other engines run from one timepoint to the next.
+        """
+        method = self.method if method is None else method
+        if method not in self.recording_methods:
+            return super().run_recorded(parameters, initial_state, timepoints, on_record=on_record, method=method, **kwargs)
+        if len(timepoints) == 0:
+            return []
+        recorder = TimepointRecorder(initial_state, timepoints, getattr(self, "get_state_from_array", None), on_record)
+        final_state = self.run(parameters, initial_state, timepoints[-1], method=method, recorder=recorder, **kwargs)
+        recorder.record(final_state)
+        return recorder.states
+
+    def compile_parameters(self, parameters):
+        """
+        Returns CompiledParameters for running this model with parameters. 
+        Parameters that are already compiled for this model are returned as they are.
+        """
+        if isinstance(parameters, CompiledParameters) and parameters.events is self.events:
+            return parameters
+        return CompiledParameters(parameters, self.events, **self._get_parameter_tables(parameters))
+
+    def _get_parameter_tables(self, parameters):
+        """Returns the tables that events can look up in compiled parameters instead of computing them. """
+        return {}
+
+    def get_active_events(self, parameters):
         """
-        current_state = deepcopy(initial_state)
+        Returns the events that can occur under compiled parameters, 
+        and the dependency graph between them as in get_dependency_graph.
+        Events whose rate constant is zero are left out, so engines never compute their rates.
+        """
+        active_events = parameters.active_events
+        if active_events not in self._active_event_cache:
+            events = [self.events[index] for index in active_events]
+            self._active_event_cache[active_events] = events, self._build_dependency_graph(events)
+        return self._active_event_cache[active_events]
+
+    def get_reaction_network(self):
+        """
+        Returns the ReactionNetwork of the events of the model.
+        Only for models whose states are flat count vectors. They must define get_dimension, 
+        the length of the vectors, and get_field_index, the position of a state field in them.
+        """
+        if self._reaction_network is None:
+            self._reaction_network = ReactionNetwork(self.events, self.get_dimension(), self.get_field_index)
+        return self._reaction_network
+
+    def get_dependency_graph(self):
+        """
+        Returns, for each event, the indices of the events whose rates may change when it is implemented.
+        Built once from the fields each event reads and writes.
+        """
+        if self._dependency_graph is None:
+            self._dependency_graph = self._build_dependency_graph(self.events)
+        return self._dependency_graph
+
+    @staticmethod
+    def _build_dependency_graph(events):
+        readers = {}
+        unknown_readers = []
+        for index, event in enumerate(events):
+            reads = event.get_reads()
+            if reads is None:
+                unknown_readers.append(index)
+                continue
+            for field in reads:
+                readers.setdefault(field, []).append(index)
+
+        everything = tuple(range(len(events)))
+        graph = []
+        for event in events:
+            writes = event.get_writes()
+            if writes is None:
+                graph.append(everything)
+                continue
+            dependents = set(unknown_readers)
+            for field in writes:
+                dependents.update(readers.get(field, []))
+            graph.append(tuple(sorted(dependents)))
+        return graph
+
+    @staticmethod
+    def _draw_firing_time(current_time, rate, rng):
+        if rate == 0:
+            return np.inf
+        return current_time + rng.exponential() / rate
+
+    def _run_direct(self, parameters, current_state, duration, max_num_steps, rng, metrics=None, recorder=None):
+        events, _ = self.get_active_events(parameters)
         current_time = 0
         num_steps = 0
+        if metrics is not None:
+            metrics.lap()
         while True:
             num_steps += 1
             if max_num_steps is not None and num_steps > max_num_steps:
                 raise RuntimeError(
                     "Maximum number of steps for single simulation exceeded")
             rates = []
-            for event in self.events:
+            for event in events:
                 rates.append(event.get_max_rate(current_state, parameters))
             total_rate = sum(rates)
+            if metrics is not None:
+                metrics.lap("rates")
             if total_rate == 0:
                 break
             else:
-                random_number = random()
-                waiting_time = - np.log(random_number) / total_rate
+                waiting_time = rng.exponential() / total_rate
             current_time += waiting_time
-            
+            if recorder is not None and current_time > recorder.next_time and recorder.record(current_state, current_time):
+                break
             if current_time > duration:
                 break
-            event_index = random() * total_rate
+            event_index = rng.random() * total_rate
             found_event = None
-            for event, rate in zip(self.events, rates):
+            for event, rate in zip(events, rates):
                 if rate >= event_index:
                     found_event = event
                     found_max_rate = rate
@@ -116,13 +353,298 @@ class EventModel(Model):
                 event_index -= rate
             if found_event is None:
                 raise RuntimeError("Event was not able to be found!")
-            if found_rate / found_max_rate > random():
-                found_event.implement(current_state)
-        
-        if verbose:
-            print(current_state)
+            if found_rate / found_max_rate > rng.random():
+                if metrics is not None:
+                    metrics.lap("selection")
+                found_event.implement(current_state, rng=rng)
+                if metrics is not None:
+                    metrics.lap("implement")
+                    metrics.record_firing(found_event)
+            elif metrics is not None:
+                metrics.lap("selection")
+                metrics.record_rejection()
+        return current_state
+
+    def _run_next_reaction(self, parameters, current_state, duration, max_num_steps, rng, metrics=None, recorder=None):
+        events, dependencies = self.get_active_events(parameters)
+        if not events:
+            return current_state
+        if metrics is not None:
+            metrics.lap()
+        rates = [event.get_max_rate(current_state, parameters) for event in events]
+        firing_times = IndexedPriorityQueue([self._draw_firing_time(0, rate, rng) for rate in rates])
+        if metrics is not None:
+            metrics.lap("rates")
+        num_steps = 0
+        while True:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for single simulation exceeded")
+            event_index, current_time = firing_times.peek()
+            if recorder is not None and current_time > recorder.next_time and recorder.record(current_state, current_time):
+                break
+            if current_time > duration or current_time == np.inf:
+                break
+            event = events[event_index]
+            if event.get_rate(current_state, current_time, parameters) / rates[event_index] > rng.random():
+                if metrics is not None:
+                    metrics.lap("selection")
+                event.implement(current_state, rng=rng)
+                if metrics is not None:
+                    metrics.lap("implement")
+                    metrics.record_firing(event)
+                for dependent in dependencies[event_index]:
+                    if dependent == event_index:
+                        continue
+                    old_rate = rates[dependent]
+                    new_rate = events[dependent].get_max_rate(current_state, parameters)
+                    if new_rate == old_rate:
+                        continue
+                    rates[dependent] = new_rate
+                    if old_rate == 0 or new_rate == 0:
+                        firing_time = self._draw_firing_time(current_time, new_rate, rng)
+                    else:
+                        # Reuse the unfired waiting time, rescaled to the new rate.
+                        firing_time = current_time + old_rate / new_rate * (firing_times[dependent] - current_time)
+                    firing_times.update(dependent, firing_time)
+                rates[event_index] = event.get_max_rate(current_state, parameters)
+            elif metrics is not None:
+                metrics.lap("selection")
+                metrics.record_rejection()
+            firing_times.update(event_index, self._draw_firing_time(current_time, rates[event_index], rng))
+            if metrics is not None:
+                metrics.lap("rates")
+        return current_state
+
+    def _run_sum_tree(self, parameters, current_state, duration, max_num_steps, rng, metrics=None, recorder=None):
+        events, dependencies = self.get_active_events(parameters)
+        if metrics is not None:
+            metrics.lap()
+        rates = PropensityTree([event.get_max_rate(current_state, parameters) for event in events])
+        if metrics is not None:
+            metrics.lap("rates")
+        current_time = 0
+        num_steps = 0
+        while True:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for single simulation exceeded")
+            total_rate = rates.total
+            if total_rate == 0:
+                break
+            current_time += rng.exponential() / total_rate
+            if recorder is not None and current_time > recorder.next_time and recorder.record(current_state, current_time):
+                break
+            if current_time > duration:
+                break
+            event_index = rates.sample(rng.random() * total_rate)
+            event = events[event_index]
+            if event.get_rate(current_state, current_time, parameters) / rates[event_index] > rng.random():
+                if metrics is not None:
+                    metrics.lap("selection")
+                event.implement(current_state, rng=rng)
+                if metrics is not None:
+                    metrics.lap("implement")
+                    metrics.record_firing(event)
+                for dependent in dependencies[event_index]:
+                    rates.update(dependent, events[dependent].get_max_rate(current_state, parameters))
+                if metrics is not None:
+                    metrics.lap("rates")
+            elif metrics is not None:
+                metrics.lap("selection")
+                metrics.record_rejection()
+        return current_state
+
+    def _run_tau_leap(self, parameters, current_state, duration, max_num_steps, rng, epsilon=0.03, leap="poisson",
+                      critical_firings=10, exact_threshold=10, exact_steps=100, metrics=None, recorder=None):
+        """
+        Explicit tau leaping with the step selection of Cao, Gillespie and Petzold (2006).
+
+        Every leap fires each event a Poisson (or, with leap="binomial", binomial) number of times, 
+        with the leap chosen so that the expected relative change of the rate of every event stays below epsilon. 
+        An event is critical when its reactants allow fewer than critical_firings more firings.
+        Critical events fire at most once per leap, chosen exactly as in the direct method.
+        When the leap would be shorter than exact_threshold / total rate, exact steps are taken instead:
+        exact_steps of them, twice as many after each leap in a row that is too short, up to 16 * exact_steps.
+        The leap is not even selected when fewer than exact_threshold firings are expected before it would end.
+        Leaps that would make the state incoherent are rejected and retried with half the step.
+        Leaps end at the timepoints of the recorder, and each leap is a step of metrics.
+
+        The fields an event reads are its reactants. A firing consumes as many copies of a reactant as the event
+        removes from it, and at least one. The order of an event is the number of copies it consumes in total.
+        Events must define get_reads and get_state_change and states must define verify_coherence.
+
+        Leaping only pays off when every count an event consumes is in the thousands. For a (4, 8) CSANModel with
+        SIMPLE_D41_PARAMETERS at D = 640000, it is as fast as the sum tree engine at 100 T and 300 E cells,
+        where it takes exact steps, and 10 times as fast at 10000 T and 30000 E cells (see benchmark_high_copy).
+        """
+        events, fields, reactant_positions, change_matrix, consumers = self._get_leap_tables(parameters)
+
+        current_time = 0
+        num_steps = 0
+        # The rates of the exact steps, kept between fallbacks until a leap changes the state.
+        exact_rates = None
+        fallback_steps = exact_steps
+        if metrics is not None:
+            metrics.lap()
+        while True:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for single simulation exceeded")
+            if recorder is not None and current_time >= recorder.next_time and recorder.record(current_state, np.nextafter(current_time, np.inf)):
+                break
+            end_time = duration if recorder is None else min(duration, recorder.next_time)
+            if exact_rates is None:
+                exact_rates = PropensityTree([event.get_max_rate(current_state, parameters) for event in events])
+            if exact_rates.total == 0:
+                break
+            # Too few firings are expected before end_time for a leap to pay off, so the leap is not selected.
+            if exact_rates.total * (end_time - current_time) < exact_threshold:
+                current_time = self._take_exact_steps(parameters, current_state, current_time, duration, exact_steps, rng,
+                                                      metrics, recorder, exact_rates)
+                if current_time > duration:
+                    break
+                continue
+
+            rates = np.array([event.get_rate(current_state, current_time, parameters) for event in events])
+            total_rate = rates.sum()
+            counts = np.array([get_state_field(current_state, field) for field in fields], dtype=float)
+            firing_limits = np.array([min((counts[position] // copies for position, copies in event_positions), default=np.inf)
+                                      for event_positions in reactant_positions])
+            critical = (rates > 0) & (firing_limits < critical_firings)
+            leap_rates = np.where(critical, 0, rates)
+            means = leap_rates @ change_matrix
+            variances = leap_rates @ change_matrix ** 2
+            # The relative change of a count that changes the rates of its consumers by at most epsilon.
+            sensitivities = np.array([max((order / copies * sum(count / (count - k) for k in range(copies))
+                                           if count >= copies else np.inf) for order, copies in field_consumers)
+                                      for count, field_consumers in zip(counts, consumers)])
+            bounds = np.maximum(epsilon * counts / sensitivities, 1)
+            with np.errstate(divide="ignore"):
+                tau = min(np.min(bounds / np.abs(means), initial=np.inf), np.min(bounds ** 2 / variances, initial=np.inf))
+            if metrics is not None:
+                metrics.lap("rates")
+
+            if tau * total_rate < exact_threshold:
+                current_time = self._take_exact_steps(parameters, current_state, current_time, duration, fallback_steps,
+                                                      rng, metrics, recorder, exact_rates)
+                # Leaps stay short while the state changes little, so each failed selection doubles the next fallback.
+                fallback_steps = min(2 * fallback_steps, 16 * exact_steps)
+                if current_time > duration:
+                    break
+                continue
+
+            critical_rate = rates[critical].sum()
+            critical_time = rng.exponential() / critical_rate if critical_rate > 0 else np.inf
+            while True:
+                step = min(tau, critical_time, end_time - current_time)
+                firings = np.zeros(len(events), dtype=np.int64)
+                if critical_time == step:
+                    critical_indices = np.flatnonzero(critical)
+                    cumulative_rates = np.cumsum(rates[critical_indices])
+                    selected = np.searchsorted(cumulative_rates, rng.random() * critical_rate, side="right")
+                    firings[critical_indices[min(selected, len(critical_indices) - 1)]] = 1
+                for index in np.flatnonzero(leap_rates):
+                    if leap == "binomial" and firing_limits[index] != np.inf:
+                        limit = int(firing_limits[index])
+                        firings[index] = rng.binomial(limit, min(leap_rates[index] * step / limit, 1))
+                    else:
+                        firings[index] = rng.poisson(leap_rates[index] * step)
+                if metrics is not None:
+                    metrics.lap("selection")
+
+                new_state = deepcopy(current_state)
+                for index in np.flatnonzero(firings):
+                    events[index].implement_many(new_state, int(firings[index]), rng=rng)
+                if new_state.verify_coherence():
+                    break
+                if metrics is not None:
+                    metrics.lap("implement")
+                    metrics.record_rejection()
+                tau /= 2
+
+            if metrics is not None:
+                metrics.lap("implement")
+                metrics.record_leap(events, firings)
+            current_state = new_state
+            current_time += step
+            exact_rates = None
+            fallback_steps = exact_steps
+            if current_time >= duration:
+                break
         return current_state
 
+    def _get_leap_tables(self, parameters):
+        """
+        Returns the active events and the tables tau leaping needs for them, built once per set of active events:
+        the reactant fields, the positions and copies of the reactants of each event, 
+        the matrix of the change of each event to each reactant, and the (order, copies) of the consumers of each reactant.
+        """
+        active_events = parameters.active_events
+        if active_events not in self._leap_table_cache:
+            events, _ = self.get_active_events(parameters)
+            reads = [event.get_reads() for event in events]
+            changes = [event.get_state_change() for event in events]
+            if any(fields is None for fields in reads) or any(change is None for change in changes):
+                raise ValueError("Tau leaping requires every event to define get_reads and get_state_change")
+
+            reactants = [{field: max(int(-min(change.get(field, 0), 0)), 1) for field in fields}
+                         for fields, change in zip(reads, changes)]
+            fields = list(dict.fromkeys(field for copies in reactants for field in copies))
+            positions = {field: position for position, field in enumerate(fields)}
+            reactant_positions = [[(positions[field], copies) for field, copies in event_reactants.items()]
+                                  for event_reactants in reactants]
+            change_matrix = np.zeros((len(events), len(fields)))
+            for index, change in enumerate(changes):
+                for field, amount in change.items():
+                    if field in positions:
+                        change_matrix[index, positions[field]] += amount
+            # The orders of the events consuming each reactant, and the copies of it they consume.
+            consumers = [set() for _ in fields]
+            for event_reactants in reactants:
+                order = sum(event_reactants.values())
+                for field, copies in event_reactants.items():
+                    consumers[positions[field]].add((order, copies))
+            self._leap_table_cache[active_events] = events, fields, reactant_positions, change_matrix, consumers
+        return self._leap_table_cache[active_events]
+
+    def _take_exact_steps(self, parameters, current_state, current_time, duration, step_count, rng, metrics=None,
+                          recorder=None, rates=None):
+        """
+        Takes up to step_count steps of the sum tree direct method. 
+        Mutates current_state and returns the new time, which is infinite if no event can occur or the recorder stopped.
+        rates, if given, is the PropensityTree of the maximum rates of the active events in current_state, 
+        and is kept up to date.
+        """
+        events, dependencies = self.get_active_events(parameters)
+        if rates is None:
+            rates = PropensityTree([event.get_max_rate(current_state, parameters) for event in events])
+        for _ in range(step_count):
+            total_rate = rates.total
+            if total_rate == 0:
+                return np.inf
+            current_time += rng.exponential() / total_rate
+            if recorder is not None and current_time > recorder.next_time and recorder.record(current_state, current_time):
+                return np.inf
+            if current_time > duration:
+                return current_time
+            event_index = rates.sample(rng.random() * total_rate)
+            event = events[event_index]
+            if event.get_rate(current_state, current_time, parameters) / rates[event_index] > rng.random():
+                event.implement(current_state, rng=rng)
+                if metrics is not None:
+                    metrics.record_firing(event)
+                for dependent in dependencies[event_index]:
+                    rates.update(dependent, events[dependent].get_max_rate(current_state, parameters))
+            elif metrics is not None:
+                metrics.record_rejection()
+        if metrics is not None:
+            metrics.lap("implement")
+        return current_time
+
     
 
 
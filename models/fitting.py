@@ -0,0 +1,358 @@
+import csv
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
+from itertools import repeat
+
+import numpy as np
+from scipy import optimize
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+from scipy.stats import norm, qmc
+
+
+def read_data_table(path):
+    """
+    Reads a table such as data/Normalized D41.csv: a header row, then one row per timepoint,
+    with the time in the first column and one column per condition.
+    Returns the timepoints and a dictionary from each condition name to its values, in the order of the columns.
+    """
+    with open(path, newline='') as csv_file:
+        rows = list(csv.reader(csv_file))
+    names = rows[0][1:]
+    timepoints = [float(row[0]) for row in rows[1:]]
+    columns = {name: [float(row[column_index + 1]) for row in rows[1:]] for column_index, name in enumerate(names)}
+    return timepoints, columns
+
+
+class SimulationObjective:
+    """
+    Squared error between data and simulations of a stochastic model, as a function of a parameter vector,
+    for minimizers such as scipy.optimize.minimize.
+
+    Each condition is an initial state and the data observed from it at timepoints. Every evaluation
+    simulates each condition replicate_count times and compares the data with the mean of observable over
+    the replicates. The replicates use the same random streams in every evaluation (common random numbers),
+    so the objective is a deterministic function of the parameters and differences between nearby
+    parameter vectors are not drowned in simulation noise.
+
+    Conditions x replicates are simulated in workers processes, or on executor if one is given.
+    Errors of the last cache_size parameter vectors are kept, so repeated vectors are not simulated again.
+    """
+
+    def __init__(self, model, conditions, timepoints, observable, get_parameters=dict, replicate_count=1, seed=0,
+                 workers=None, executor=None, cache_size=1024, verbose=False, **run_options):
+        """
+        conditions is a list of (initial state, data), where data are the observed values at timepoints.
+        Extra timepoints without data are simulated but not compared.
+        get_parameters turns a parameter vector into the parameter dictionary of the model.
+        run_options are passed to run, for example method.
+        """
+        self.model = model
+        self.conditions = conditions
+        self.timepoints = timepoints
+        self.observable = observable
+        self.get_parameters = get_parameters
+        self.replicate_count = replicate_count
+        self.seed = seed
+        self.workers = workers
+        self.executor = executor
+        self.cache_size = cache_size
+        self.verbose = verbose
+        self.run_options = run_options
+        self.evaluation_count = 0
+        self.cache_hits = 0
+        self._cache = OrderedDict()
+        self._process_pool = None
+
+    def __call__(self, parameter_vector):
+        return self.evaluate_many([parameter_vector])[0]
+
+    def evaluate_many(self, parameter_vectors):
+        """Returns the error at each parameter vector. The simulations of all of them are spread over the workers at once."""
+        keys = [tuple(float(parameter) for parameter in parameter_vector) for parameter_vector in parameter_vectors]
+        new_keys = []
+        for key in keys:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            elif key not in new_keys:
+                new_keys.append(key)
+
+        errors = {key: self._cache[key] for key in keys if key in self._cache}
+        parameter_sets = [self.get_parameters(list(key)) for key in new_keys]
+        for key, parameters, observed in zip(new_keys, parameter_sets, self._simulate(parameter_sets)):
+            error = 0
+            for (_, data), simulated in zip(self.conditions, observed.mean(axis=1)):
+                for real_point, sample_point in zip(data, simulated):
+                    error += (real_point - sample_point) ** 2
+            error = float(error)
+            if self.verbose:
+                print(parameters)
+                print(error)
+            self.evaluation_count += 1
+            errors[key] = error
+            self._cache[key] = error
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return [errors[key] for key in keys]
+
+    def get_simulated_observables(self, parameters):
+        """Returns the observable of every replicate of every condition, as a (conditions x replicates x timepoints) array."""
+        return self._simulate([parameters])[0]
+
+    def _simulate(self, parameter_sets):
+        """Returns get_simulated_observables of each parameter set, as one array."""
+        initial_states = [initial_state for initial_state, _ in self.conditions for _ in range(self.replicate_count)]
+        # A fresh SeedSequence spawns the same children every time, which makes the random numbers common.
+        seed_sequences = np.random.SeedSequence(self.seed).spawn(len(initial_states))
+        generate_sample = partial(self.model.generate_sample, **self.run_options)
+        arguments = (
+            [parameters for parameters in parameter_sets for _ in initial_states],
+            initial_states * len(parameter_sets),
+            repeat(self.timepoints),
+            seed_sequences * len(parameter_sets),
+        )
+        executor = self._get_executor()
+        if executor is None:
+            samples = map(generate_sample, *arguments)
+        else:
+            samples = executor.map(generate_sample, *arguments)
+        observables = [[self.observable(sample[time]) for time in self.timepoints] for sample in samples]
+        shape = (len(parameter_sets), len(self.conditions), self.replicate_count, len(self.timepoints))
+        return np.array(observables, dtype=float).reshape(shape)
+
+    def close(self):
+        """Shuts down the worker processes, if the objective started any."""
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._process_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def _get_executor(self):
+        if self.executor is not None:
+            return self.executor
+        if self.workers is None or self.workers <= 1:
+            return None
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._process_pool
+
+
+class GaussianProcessSurrogate:
+    """
+    Gaussian process regression of an objective over parameter vectors within bounds.
+
+    The kernel is Matern 5/2 with a length scale per parameter. Parameters are scaled to the unit cube
+    and values are standardized; parameters whose bounds are a single point are left out. The length scales,
+    signal variance and noise variance maximize the marginal likelihood of the observed values.
+    """
+
+    def __init__(self, bounds, noise_variance=1e-6):
+        self.bounds = np.array(bounds, dtype=float)
+        self.points = np.zeros((0, len(self.bounds)))
+        self.values = np.zeros(0)
+        free_count = np.count_nonzero(self._get_free())
+        self.log_length_scales = np.full(free_count, np.log(0.3))
+        self.log_signal_variance = 0.0
+        self.log_noise_variance = np.log(noise_variance)
+        self._factorization = None
+
+    def add(self, points, values, fit=True, rng=None):
+        """Adds observed values of the objective at points, then refits the hyperparameters if fit, with rng as in fit."""
+        self.points = np.concatenate([self.points, np.reshape(points, (-1, len(self.bounds)))])
+        self.values = np.concatenate([self.values, np.ravel(values)])
+        if fit:
+            self.fit(rng=rng)
+        else:
+            self._factorize()
+
+    def fit(self, restart_count=3, rng=None):
+        """
+        Sets the hyperparameters that maximize the marginal likelihood, from the current ones and restart_count random ones.
+        rng draws the random ones: a numpy Generator, or a seed for one.
+        """
+        rng = np.random.default_rng(rng)
+        free_count = len(self.log_length_scales)
+        hyperparameter_bounds = [(np.log(0.01), np.log(10))] * free_count + [(-5, 5), (np.log(1e-8), 0)]
+        starts = [np.concatenate([self.log_length_scales, [self.log_signal_variance, self.log_noise_variance]])]
+        for _ in range(restart_count):
+            starts.append(np.array([rng.uniform(low, high) for low, high in hyperparameter_bounds]))
+        scaled_points, standardized_values = self._scale(self.points), self._standardize(self.values)
+        best = None
+        for start in starts:
+            result = optimize.minimize(self._get_negative_log_likelihood, start, args=(scaled_points, standardized_values),
+                                       bounds=hyperparameter_bounds, method="L-BFGS-B")
+            if best is None or result.fun < best.fun:
+                best = result
+        self.log_length_scales = best.x[:free_count]
+        self.log_signal_variance, self.log_noise_variance = best.x[free_count:]
+        self._factorize()
+
+    def predict(self, points):
+        """Returns the posterior mean and standard deviation of the objective at each of points."""
+        points = np.reshape(points, (-1, len(self.bounds)))
+        if len(self.values) == 0:
+            return np.zeros(len(points)), np.full(len(points), np.exp(self.log_signal_variance / 2))
+        cholesky, weights = self._factorization
+        covariances = self._get_kernel(self._scale(points), self._scale(self.points), self.log_length_scales,
+                                       self.log_signal_variance)
+        mean = covariances @ weights
+        reduced = solve_triangular(cholesky, covariances.T, lower=True)
+        variance = np.maximum(np.exp(self.log_signal_variance) - np.sum(reduced ** 2, axis=0), 0)
+        scale = self._get_value_scale()
+        return mean * scale + self._get_value_offset(), np.sqrt(variance) * scale
+
+    def get_expected_improvement(self, points, best_value=None, exploration=0.0):
+        """Returns the expected amount by which the objective at each of points is below best_value, by default the lowest observed."""
+        if best_value is None:
+            best_value = self.values.min()
+        mean, deviation = self.predict(points)
+        improvement = best_value - mean - exploration
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = improvement / deviation
+            expected_improvement = improvement * norm.cdf(z) + deviation * norm.pdf(z)
+        return np.where(deviation > 0, expected_improvement, np.maximum(improvement, 0))
+
+    def save(self, path):
+        """Saves the observations and hyperparameters to path, an .npz file."""
+        np.savez(path, bounds=self.bounds, points=self.points, values=self.values,
+                 log_length_scales=self.log_length_scales,
+                 hyperparameters=np.array([self.log_signal_variance, self.log_noise_variance]))
+
+    @staticmethod
+    def load(path):
+        """Returns the surrogate saved at path, without refitting it."""
+        with np.load(path) as saved:
+            surrogate = GaussianProcessSurrogate(saved["bounds"])
+            surrogate.points = saved["points"]
+            surrogate.values = saved["values"]
+            surrogate.log_length_scales = saved["log_length_scales"]
+            surrogate.log_signal_variance, surrogate.log_noise_variance = saved["hyperparameters"]
+        surrogate._factorize()
+        return surrogate
+
+    def _factorize(self):
+        if len(self.values) == 0:
+            self._factorization = None
+            return
+        scaled_points = self._scale(self.points)
+        covariance = self._get_kernel(scaled_points, scaled_points, self.log_length_scales, self.log_signal_variance)
+        covariance[np.diag_indices_from(covariance)] += np.exp(self.log_noise_variance) + 1e-10
+        cholesky = np.linalg.cholesky(covariance)
+        weights = cho_solve((cholesky, True), self._standardize(self.values))
+        self._factorization = cholesky, weights
+
+    def _get_negative_log_likelihood(self, hyperparameters, scaled_points, standardized_values):
+        free_count = len(self.log_length_scales)
+        log_signal_variance, log_noise_variance = hyperparameters[free_count:]
+        covariance = self._get_kernel(scaled_points, scaled_points, hyperparameters[:free_count], log_signal_variance)
+        covariance[np.diag_indices_from(covariance)] += np.exp(log_noise_variance) + 1e-10
+        try:
+            factor = cho_factor(covariance, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e10
+        weights = cho_solve(factor, standardized_values)
+        return 0.5 * standardized_values @ weights + np.log(np.diag(factor[0])).sum()
+
+    @staticmethod
+    def _get_kernel(first_points, second_points, log_length_scales, log_signal_variance):
+        scaled_differences = (first_points[:, None, :] - second_points[None, :, :]) / np.exp(log_length_scales)
+        distance = np.sqrt(5 * np.sum(scaled_differences ** 2, axis=-1))
+        return np.exp(log_signal_variance) * (1 + distance + distance ** 2 / 3) * np.exp(-distance)
+
+    def _get_free(self):
+        return self.bounds[:, 1] > self.bounds[:, 0]
+
+    def _scale(self, points):
+        free = self._get_free()
+        low, high = self.bounds[free, 0], self.bounds[free, 1]
+        return (points[:, free] - low) / (high - low)
+
+    def _get_value_offset(self):
+        return self.values.mean() if len(self.values) else 0.0
+
+    def _get_value_scale(self):
+        scale = self.values.std() if len(self.values) > 1 else 0.0
+        return scale if scale > 0 else 1.0
+
+    def _standardize(self, values):
+        return (values - self._get_value_offset()) / self._get_value_scale()
+
+
+class BayesianOptimizer:
+    """
+    Minimizes an expensive objective within bounds, such as a SimulationObjective, by Bayesian optimization.
+
+    A GaussianProcessSurrogate is fit to every evaluation. Each iteration evaluates a batch of batch_size points
+    that maximize its expected improvement, chosen one at a time with the constant liar heuristic: chosen points
+    are added to a copy of the surrogate with the lowest observed value before choosing the next.
+    A batch is evaluated with one call to the evaluate_many method of the objective, if it has one,
+    so a SimulationObjective runs all of its simulations in parallel.
+    """
+
+    def __init__(self, objective, bounds, surrogate=None, batch_size=4, candidate_count=2000, seed=None):
+        self.objective = objective
+        self.bounds = np.array(bounds, dtype=float)
+        self.surrogate = GaussianProcessSurrogate(bounds) if surrogate is None else surrogate
+        self.batch_size = batch_size
+        self.candidate_count = candidate_count
+        self.rng = np.random.default_rng(seed)
+
+    def minimize(self, iteration_count=20, initial_points=None, initial_count=None):
+        """
+        Evaluates initial_points and initial_count Latin hypercube points, by default twice the number of parameters
+        when the surrogate has no observations yet, then iteration_count batches of acquisition points.
+        Returns a scipy OptimizeResult with the best evaluated point.
+        """
+        if initial_count is None:
+            initial_count = 2 * len(self.bounds) if len(self.surrogate.values) == 0 else 0
+        points = [] if initial_points is None else [np.asarray(point, dtype=float) for point in initial_points]
+        if initial_count > 0:
+            points.extend(self._get_initial_points(initial_count))
+        if points:
+            self.surrogate.add(points, self._evaluate(points), rng=self.rng)
+        for _ in range(iteration_count):
+            batch = self.suggest(self.batch_size)
+            self.surrogate.add(batch, self._evaluate(batch), rng=self.rng)
+
+        best_index = np.argmin(self.surrogate.values)
+        return optimize.OptimizeResult(x=self.surrogate.points[best_index], fun=self.surrogate.values[best_index],
+                                       nfev=len(self.surrogate.values), nit=iteration_count, success=True)
+
+    def suggest(self, count):
+        """Returns count points to evaluate next. Without any observations yet, they are Latin hypercube points."""
+        if len(self.surrogate.values) == 0:
+            return self._get_initial_points(count)
+        surrogate = deepcopy(self.surrogate)
+        lie = surrogate.values.min()
+        batch = []
+        for _ in range(count):
+            candidates = self._get_candidates(surrogate)
+            point = candidates[np.argmax(surrogate.get_expected_improvement(candidates, best_value=lie))]
+            batch.append(point)
+            surrogate.add([point], [lie], fit=False)
+        return np.array(batch)
+
+    def _get_initial_points(self, count):
+        sample = qmc.LatinHypercube(d=len(self.bounds), seed=self.rng).random(count)
+        return self.bounds[:, 0] + sample * (self.bounds[:, 1] - self.bounds[:, 0])
+
+    def _get_candidates(self, surrogate):
+        """Uniform points in the bounds, and perturbations of the best observed points."""
+        low, high = self.bounds[:, 0], self.bounds[:, 1]
+        uniform = self.rng.uniform(low, high, size=(self.candidate_count, len(self.bounds)))
+        best_points = surrogate.points[np.argsort(surrogate.values)[:5]]
+        local = best_points[self.rng.integers(len(best_points), size=self.candidate_count)]
+        local = np.clip(local + self.rng.normal(scale=0.05, size=local.shape) * (high - low), low, high)
+        return np.concatenate([uniform, local])
+
+    def _evaluate(self, points):
+        if hasattr(self.objective, "evaluate_many"):
+            return self.objective.evaluate_many(points)
+        return [self.objective(point) for point in points]
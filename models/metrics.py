@@ -0,0 +1,87 @@
+from time import perf_counter
+
+
+class RunMetrics:
+    """
+    Counters filled in by EventModel.run and generate_simulation_data when they are given one, through metrics=.
+
+    Every run records its wall time and simulated duration. The engines in EventModel.instrumented_methods
+    also record each step: which class of event fired, whether the event was rejected by thinning,
+    and the time spent computing rates, selecting the event and implementing it.
+    A step of tau leaping is a leap, which can fire many events, and its rejections are rejected leaps.
+    Runs without metrics do not pay for any of this beyond a few checks per step.
+    """
+
+    phases = ("rates", "selection", "implement")
+
+    def __init__(self):
+        self.run_count = 0
+        self.wall_seconds = 0.0
+        self.simulated_time = 0.0
+        self.steps = 0
+        self.rejections = 0
+        self.firings = {}
+        self.phase_seconds = dict.fromkeys(self.phases, 0.0)
+        self._lap_start = None
+
+    def lap(self, phase=None):
+        """Adds the time since the previous lap to phase, if one is given. Engines call this between phases."""
+        now = perf_counter()
+        if phase is not None:
+            self.phase_seconds[phase] += now - self._lap_start
+        self._lap_start = now
+
+    def record_firing(self, event):
+        self.steps += 1
+        name = type(event).__name__
+        self.firings[name] = self.firings.get(name, 0) + 1
+
+    def record_leap(self, events, firings):
+        """Records a leap that fired each of events the number of times in firings."""
+        self.steps += 1
+        for event, count in zip(events, firings):
+            if count > 0:
+                name = type(event).__name__
+                self.firings[name] = self.firings.get(name, 0) + int(count)
+
+    def record_rejection(self):
+        self.steps += 1
+        self.rejections += 1
+
+    def record_run(self, duration, wall_seconds):
+        self.run_count += 1
+        self.simulated_time += duration
+        self.wall_seconds += wall_seconds
+
+    def merge(self, other):
+        """Adds the counters of other, such as the metrics of a sample run in another process."""
+        self.run_count += other.run_count
+        self.wall_seconds += other.wall_seconds
+        self.simulated_time += other.simulated_time
+        self.steps += other.steps
+        self.rejections += other.rejections
+        for name, count in other.firings.items():
+            self.firings[name] = self.firings.get(name, 0) + count
+        for phase, seconds in other.phase_seconds.items():
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+
+    def as_dict(self):
+        """Returns the counters and the rates derived from them as a dictionary of plain values."""
+        return {
+            "run_count": self.run_count,
+            "wall_seconds": self.wall_seconds,
+            "simulated_time": self.simulated_time,
+            "steps": self.steps,
+            "steps_per_second": self.steps / self.wall_seconds if self.wall_seconds > 0 else 0.0,
+            "rejections": self.rejections,
+            "rejection_ratio": self.rejections / self.steps if self.steps > 0 else 0.0,
+            "firings": dict(self.firings),
+            "phase_seconds": dict(self.phase_seconds),
+        }
+
+
+def print_progress(progress):
+    """Prints the progress of an ensemble of more than 100 samples every time another tenth of it is completed."""
+    completed, total = progress["completed"], progress["total"]
+    if total > 100 and completed * 10 // total != (completed - 1) * 10 // total:
+        print(f"{completed}/{total} completed, {progress['eta_seconds']:.0f}s remaining")
@@ -1,9 +1,21 @@
 """
-Models are implemented in a parameter-agnostic way. 
+Models are implemented in a parameter-agnostic way.
 Parameters instead are supplied at the time of running.
 """
 # pylint:disable=arguments-differ
 from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
+
+import os
+
+import numpy as np
+
+from models.checkpoint import ResumableSimulation
+from models.ensemble_statistics import EnsembleSummary
+from models.metrics import RunMetrics, print_progress
+from models.random_stream import as_random_stream
 
 class Model:
     """Abstract class. Contains a state space and function to run for a duration."""
@@ -13,17 +25,37 @@ class Model:
     def run(self, parameters, initial_state, duration: float, **kwargs):
         """Returns the result of running the model on initial_state for a duration with given parameters."""
 
+    def get_cache_description(self):
+        """Returns what identifies the model in the keys of a ResultCache: its class and its plain attributes."""
+        description = {name: value for name, value in vars(self).items() if isinstance(value, (bool, int, float, str))}
+        description["class"] = f"{type(self).__module__}.{type(self).__qualname__}"
+        return description
+
+    def compile_parameters(self, parameters):
+        """Returns parameters in the form run works with fastest. Compiling them once saves work in every run."""
+        return parameters
+
     def generate_simulation_data(self, parameters: dict, initial_state, timepoints: list, sample_count: int = 1,
-                                 **kwargs):
+                                 cache=None, checkpoint=None, **kwargs):
         """
         Returns result of run between timepoints starting from initial_state sample_count times.
-        
+
         Data is output in json-style:
         {
             "model": [model name],
             "parameters": [parameter dictionary],
             "data": [timepoint data dictionary],
         }
+
+        If cache is a ResultCache and a seed is given, the data is looked up in it first and stored in it otherwise,
+        unless the other keyword arguments are not plain data, such as an early_stop function.
+        If checkpoint is a path, the samples are run by a ResumableSimulation that saves its progress there,
+        resuming from it if the file exists, which raises a ValueError if it was saved for other arguments. 
+        checkpoint_seconds and checkpoint_interval are then passed to it, as are time_budget and step_budget to its run,
+        while workers, executor, chunksize, progress and metrics are ignored, and a cache cannot be given.
+        The result then has a "complete" key, which is False if a budget or max_num_steps stopped the simulation
+        before every sample was complete. "data" only has the complete samples.
+        Keyword arguments are as in iterate_simulation_data.
         """
 
 
@@ -33,24 +65,180 @@ class Model:
             "data": [],
             "timepoints": timepoints
         }
+        if checkpoint is not None:
+            if cache is not None:
+                raise ValueError("Checkpointed simulations cannot be cached")
+            checkpointed_result = self._run_checkpointed(parameters, initial_state, timepoints, sample_count,
+                                                         checkpoint, **kwargs)
+            simulation_result["data"] = checkpointed_result["data"]
+            simulation_result["complete"] = checkpointed_result["complete"]
+            return simulation_result
+        seed = kwargs.get("seed")
+        if cache is not None and seed is not None:
+            run_options = {name: value for name, value in kwargs.items() 
+                           if name not in ("seed", "workers", "executor", "chunksize", "progress", "metrics")}
+            key = cache.get_key(self, parameters, initial_state, timepoints, sample_count, seed, **run_options)
+            cached_data = cache.get(self, key) if key is not None else None
+            if cached_data is not None:
+                if isinstance(seed, np.random.SeedSequence):
+                    # Spawn as a simulation would, so later uses of seed behave the same after a hit.
+                    seed.spawn(sample_count)
+                simulation_result["data"] = cached_data
+                return simulation_result
+        for timepoint_data in self.iterate_simulation_data(parameters, initial_state, timepoints, sample_count, **kwargs):
+            simulation_result["data"].append(timepoint_data)
+        if cache is not None and seed is not None and key is not None:
+            cache.put(self, key, simulation_result["data"])
+        return simulation_result
 
-        percent_completed = -10
+    def _run_checkpointed(self, parameters, initial_state, timepoints, sample_count, path, seed=None,
+                          checkpoint_seconds=60, checkpoint_interval=1, time_budget=None, step_budget=None, **kwargs):
+        """Returns the result of running the ResumableSimulation checkpointed at path, or a new one saved there."""
+        run_options = {name: value for name, value in kwargs.items()
+                       if name not in ("workers", "executor", "chunksize", "progress", "metrics")}
+        if os.path.exists(path):
+            simulation = ResumableSimulation.resume(path, self, checkpoint_seconds)
+            if not isinstance(seed, np.random.SeedSequence):
+                seed = np.random.SeedSequence(seed)
+            # Spawn as a new simulation would, so later uses of seed behave the same after resuming.
+            seed_sequences = seed.spawn(sample_count)
+            if (simulation.parameters != dict(parameters) or simulation.timepoints != list(timepoints)
+                    or simulation.sample_count != sample_count or simulation.checkpoint_interval != checkpoint_interval
+                    or simulation.run_options != run_options
+                    or not _is_same_state(simulation.initial_state, initial_state)
+                    or [(sequence.entropy, sequence.spawn_key) for sequence in simulation.seed_sequences]
+                    != [(sequence.entropy, sequence.spawn_key) for sequence in seed_sequences]):
+                raise ValueError(f"The checkpoint {path} was saved for a different simulation")
+        else:
+            simulation = ResumableSimulation(self, parameters, initial_state, timepoints, sample_count, seed=seed,
+                                             path=path, checkpoint_seconds=checkpoint_seconds,
+                                             checkpoint_interval=checkpoint_interval, **run_options)
+        return simulation.run(time_budget, step_budget)
 
+    def generate_summary_data(self, parameters: dict, initial_state, timepoints: list, observables: dict,
+                              sample_count: int = 1, quantiles=(0.05, 0.5, 0.95), **kwargs):
+        """
+        Returns online summary statistics of sample_count samples, without keeping the samples in memory.
+        observables maps names to functions of a state. See EnsembleSummary.get_summary for the format.
+        Keyword arguments are as in iterate_simulation_data.
+        """
+        summary = EnsembleSummary(observables, quantiles)
+        for timepoint_data in self.iterate_simulation_data(parameters, initial_state, timepoints, sample_count, **kwargs):
+            summary.add(timepoint_data)
+        summary_result = summary.get_summary()
+        summary_result["parameters"] = parameters
+        summary_result["model"] = self.name
+        return summary_result
 
-        for i in range(sample_count):
-            if sample_count > 100 and i * 100 / sample_count >= percent_completed + 10:
-                percent_completed += 10
-                print(f"{i}/{sample_count} completed")
+    def iterate_simulation_data(self, parameters: dict, initial_state, timepoints: list, sample_count: int = 1,
+                                workers=None, executor=None, chunksize=None, seed=None, progress=print_progress,
+                                metrics=None, **kwargs):
+        """
+        Yields the timepoint data dictionary of each sample, in order, as soon as it is available.
+        Only samples that have not been consumed yet are held in memory.
+
+        Samples are spread over a ProcessPoolExecutor with workers processes, or over executor if one is given.
+        They are submitted in chunks of chunksize samples.
+        Each sample draws from its own random stream, spawned from seed (an int or SeedSequence),
+        so for a given seed the data does not depend on whether or how samples are split between
+        threads or processes.
+        early_stop, if given, is called with the timepoint data of a sample after each timepoint. Once it returns True
+        that sample is not run any further and its timepoint data lacks the later timepoints.
+        progress, if not None, is called after each sample with a dictionary of the samples completed, 
+        the total, the elapsed seconds, the samples per second and the estimated seconds remaining.
+        If metrics is a RunMetrics, the metrics of every run of every sample are added to it, 
+        including those run in other processes.
+        Any other keyword arguments are passed to run.
+        """
+        parallel = executor is not None or (workers is not None and workers > 1)
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seed_sequences = seed.spawn(sample_count)
+        if metrics is None:
+            generate_sample = partial(self.generate_sample, parameters, initial_state, timepoints, **kwargs)
+        else:
+            generate_sample = partial(self._generate_measured_sample, parameters, initial_state, timepoints, **kwargs)
+
+        if not parallel:
+            yield from self._report_progress(map(generate_sample, seed_sequences), sample_count, progress, metrics)
+        elif executor is not None:
+            samples = executor.map(generate_sample, seed_sequences,
+                                   chunksize=chunksize or self._get_chunksize(sample_count, workers or 1))
+            yield from self._report_progress(samples, sample_count, progress, metrics)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as process_pool:
+                samples = process_pool.map(generate_sample, seed_sequences,
+                                           chunksize=chunksize or self._get_chunksize(sample_count, workers))
+                yield from self._report_progress(samples, sample_count, progress, metrics)
+
+    def run_recorded(self, parameters, initial_state, timepoints: list, on_record=None, **kwargs):
+        """
+        Returns the states of a single trajectory from initial_state at each of timepoints, which must not decrease.
+        on_record, if given, is called with the index of each timepoint and its state as soon as it is known.
+        Once it returns True the trajectory is not run any further and fewer states are returned.
+        Keyword arguments are passed to run. 
+        Runs from one timepoint to the next; models that can record in a single pass override this.
+        """
+        states = []
+        last_time = 0
+        current_state = initial_state
+        for index, time in enumerate(timepoints):
+            current_state = self.run(parameters, current_state, time - last_time, **kwargs)
+            states.append(current_state)
+            last_time = time
+            if on_record is not None and on_record(index, current_state):
+                break
+        return states
+
+    def generate_sample(self, parameters, initial_state, timepoints, seed=None, early_stop=None, **kwargs):
+        """
+        Returns the timepoint data of one sample, as in the data of generate_simulation_data.
+        Random numbers are drawn from a stream seeded by seed, an int or SeedSequence, or from the operating system.
+        early_stop is as in iterate_simulation_data and other keyword arguments are passed to run.
+        """
+        timepoint_data = {0: initial_state}
+
+        def on_record(index, state):
+            timepoint_data[timepoints[index]] = state
+            return early_stop is not None and early_stop(timepoint_data)
+
+        self.run_recorded(self.compile_parameters(parameters), initial_state, timepoints, on_record=on_record,
+                          rng=as_random_stream(seed), **kwargs)
+        return timepoint_data
+
+    def _generate_measured_sample(self, parameters, initial_state, timepoints, seed_sequence, **kwargs):
+        """Returns generate_sample and the RunMetrics of its runs."""
+        metrics = RunMetrics()
+        timepoint_data = self.generate_sample(parameters, initial_state, timepoints, seed_sequence, metrics=metrics, **kwargs)
+        return timepoint_data, metrics
+
+    @staticmethod
+    def _report_progress(samples, sample_count, progress, metrics):
+        start = perf_counter()
+        for completed, timepoint_data in enumerate(samples, 1):
+            if metrics is not None:
+                timepoint_data, sample_metrics = timepoint_data
+                metrics.merge(sample_metrics)
+            if progress is not None:
+                elapsed = perf_counter() - start
+                samples_per_second = completed / elapsed if elapsed > 0 else np.inf
+                progress({
+                    "completed": completed,
+                    "total": sample_count,
+                    "elapsed_seconds": elapsed,
+                    "samples_per_second": samples_per_second,
+                    "eta_seconds": (sample_count - completed) / samples_per_second,
+                })
+            yield timepoint_data
+
+    @staticmethod
+    def _get_chunksize(sample_count, workers):
+        """A few chunks per worker balances the load without pickling the model for every sample."""
+        return max(1, sample_count // (4 * workers))
 
-            timepoint_data = {0: initial_state}
-            last_time = 0
-            current_state = initial_state
-            for time in timepoints:
-                duration = time - last_time
-                current_state = self.run(
-                    parameters, current_state, duration, **kwargs)
-                timepoint_data[time] = current_state
-                last_time = time
-            simulation_result["data"].append(timepoint_data)
-        return simulation_result
 
+def _is_same_state(state, other_state):
+    """Whether two states are equal, compared as arrays if they can be exported to one."""
+    if hasattr(state, "export_to_array") and hasattr(other_state, "export_to_array"):
+        return np.array_equal(state.export_to_array(), other_state.export_to_array())
+    return state == other_state
@@ -0,0 +1,98 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+
+
+class MomentEquations:
+    """
+    Ordinary differential equations for the mean and covariance of the state of an EventModel
+    whose events form a mass action ReactionNetwork, such as a CSANModel.
+
+    closure selects the approximation:
+        - "lna": the linear noise approximation. The mean follows the deterministic rate equations
+        and the covariance follows the linearization of the rates around the mean.
+        - "normal": moment closure with third central moments set to zero, as for a normal distribution.
+        The mean is corrected by the covariance through the rates of events with two reactants.
+        - "lognormal": as "normal", with third moments of a log-normal distribution, which suits counts near zero.
+    Covariances are dimension x dimension, so the equations suit small and medium receptor counts.
+    """
+    closures = ("lna", "normal", "lognormal")
+
+    def __init__(self, model, closure="lna"):
+        if closure not in self.closures:
+            raise ValueError(f"Unknown moment closure {closure}. Choose one of {self.closures}")
+        self.model = model
+        self.closure = closure
+
+    def solve(self, parameters, initial_state, timepoints, initial_covariance=None, method="RK45", **options):
+        """
+        Returns the moments at 0 and at each of the increasing timepoints, starting from initial_state:
+        {
+            "timepoints": [0] + timepoints,
+            "means": [(timepoints + 1) x dimension array],
+            "covariances": [(timepoints + 1) x dimension x dimension array],
+        }
+        The initial state is known exactly unless initial_covariance is given.
+        method and other keyword arguments, such as rtol and atol, are passed to solve_ivp.
+        """
+        parameters = self.model.compile_parameters(parameters)
+        network = self.model.get_reaction_network().get_subnetwork(parameters.active_events)
+        rate_constants = np.array([parameters.rate_constants[event_index] for event_index in parameters.active_events], 
+                                  dtype=float)
+        bimolecular_events, first_reactants, second_reactants = network.get_bimolecular_events()
+        dimension = network.dimension
+
+        def get_moment_derivative(t, moments):
+            mean = moments[:dimension]
+            covariance = moments[dimension:].reshape(dimension, dimension)
+            rates = network.get_rates(mean, rate_constants)
+            # Expected covariance of each entry of the state with each rate, under the closure.
+            rate_covariances = network.get_rate_derivatives(mean, rate_constants) @ covariance
+            if self.closure != "lna":
+                rates[bimolecular_events] += rate_constants[bimolecular_events] * covariance[first_reactants, second_reactants]
+            if self.closure == "lognormal":
+                rate_covariances[bimolecular_events] = self._get_lognormal_rate_covariances(
+                    mean, covariance, rate_constants[bimolecular_events], first_reactants, second_reactants, 
+                    rate_covariances[bimolecular_events])
+            mean_derivative = network.stoichiometry.T @ rates
+            drift = network.stoichiometry.T @ rate_covariances
+            covariance_derivative = drift + drift.T + network.get_diffusion_matrix(rates)
+            return np.concatenate([mean_derivative, covariance_derivative.ravel()])
+
+        mean = np.asarray(initial_state.export_to_array(), dtype=float)
+        covariance = np.zeros((dimension, dimension)) if initial_covariance is None else np.asarray(initial_covariance, dtype=float)
+        times = [0] + list(timepoints)
+        solution = solve_ivp(get_moment_derivative, (0, times[-1]), np.concatenate([mean, covariance.ravel()]), 
+                             method=method, t_eval=times, **options)
+        if not solution.success:
+            raise RuntimeError(f"Moment equations could not be solved: {solution.message}")
+        moments = solution.y.T
+        return {
+            "timepoints": times,
+            "means": moments[:, :dimension],
+            "covariances": moments[:, dimension:].reshape(len(times), dimension, dimension),
+        }
+
+    @staticmethod
+    def get_observable_moments(moments, weights):
+        """Returns the means and variances over time of the linear observable weights @ state, from the result of solve."""
+        weights = np.asarray(weights, dtype=float)
+        means = moments["means"] @ weights
+        variances = np.einsum("tij,i,j->t", moments["covariances"], weights, weights)
+        return means, variances
+
+    @staticmethod
+    def _get_lognormal_rate_covariances(mean, covariance, rate_constants, first_reactants, second_reactants, 
+                                        normal_rate_covariances):
+        """
+        Returns the covariance of every entry x of the state with each rate k * x_p * x_q,
+        E[x x_p x_q] - E[x] E[x_p x_q], with the third moment of a log-normal distribution,
+        E[x x_p x_q] = E[x x_p] E[x x_q] E[x_p x_q] / (E[x] E[x_p] E[x_q]).
+        Where a mean is not positive the normal closure is kept.
+        """
+        second_moments = covariance + np.outer(mean, mean)
+        pair_moments = second_moments[first_reactants, second_reactants]
+        denominators = np.outer(mean[first_reactants] * mean[second_reactants], mean)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            third_moments = second_moments[first_reactants] * second_moments[second_reactants] * pair_moments[:, None] / denominators
+        rate_covariances = rate_constants[:, None] * (third_moments - np.outer(pair_moments, mean))
+        return np.where(denominators > 0, rate_covariances, normal_rate_covariances)
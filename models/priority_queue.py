@@ -0,0 +1,65 @@
+class IndexedPriorityQueue:
+    """
+    Binary min-heap over a fixed set of indices 0..n-1, each with a key.
+
+    Unlike heapq, the key of any index can be changed in O(log n), which is
+    what the Next Reaction Method needs when a firing changes the putative
+    times of its dependent events.
+    """
+
+    def __init__(self, keys):
+        self._keys = list(keys)
+        self._heap = list(range(len(self._keys)))
+        self._positions = list(range(len(self._keys)))
+        for position in reversed(range(len(self._heap) // 2)):
+            self._sift_down(position)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, index):
+        return self._keys[index]
+
+    def peek(self):
+        """Returns (index, key) of the smallest key."""
+        index = self._heap[0]
+        return index, self._keys[index]
+
+    def update(self, index, key):
+        """Changes the key of index and restores the heap property."""
+        old_key = self._keys[index]
+        self._keys[index] = key
+        if key < old_key:
+            self._sift_up(self._positions[index])
+        elif key > old_key:
+            self._sift_down(self._positions[index])
+
+    def _swap(self, position1, position2):
+        heap = self._heap
+        heap[position1], heap[position2] = heap[position2], heap[position1]
+        self._positions[heap[position1]] = position1
+        self._positions[heap[position2]] = position2
+
+    def _sift_up(self, position):
+        keys = self._keys
+        heap = self._heap
+        while position > 0:
+            parent = (position - 1) // 2
+            if keys[heap[position]] >= keys[heap[parent]]:
+                break
+            self._swap(position, parent)
+            position = parent
+
+    def _sift_down(self, position):
+        keys = self._keys
+        heap = self._heap
+        size = len(heap)
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and keys[heap[child]] < keys[heap[smallest]]:
+                    smallest = child
+            if smallest == position:
+                break
+            self._swap(position, smallest)
+            position = smallest
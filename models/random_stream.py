@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class RandomStream:
+    """
+    Random numbers for a single simulation, drawn from its own numpy Generator.
+
+    Uniforms and exponentials are drawn in blocks of block_size and handed out one at a time,
+    which is much faster than one Generator call per number. Two streams built from the same seed
+    produce the same numbers, whichever thread or process they are used in.
+    """
+
+    def __init__(self, generator=None, block_size=1024):
+        self.generator = np.random.default_rng() if generator is None else generator
+        self.block_size = block_size
+        self._uniforms = []
+        self._uniform_index = 0
+        self._exponentials = []
+        self._exponential_index = 0
+
+    def random(self):
+        """Returns a uniform number in [0, 1)."""
+        if self._uniform_index == len(self._uniforms):
+            self._uniforms = self.generator.random(self.block_size).tolist()
+            self._uniform_index = 0
+        self._uniform_index += 1
+        return self._uniforms[self._uniform_index - 1]
+
+    def exponential(self):
+        """Returns an exponential number with mean 1."""
+        if self._exponential_index == len(self._exponentials):
+            self._exponentials = self.generator.standard_exponential(self.block_size).tolist()
+            self._exponential_index = 0
+        self._exponential_index += 1
+        return self._exponentials[self._exponential_index - 1]
+
+    def binomial(self, n, p, size=None):
+        return self.generator.binomial(n, p, size)
+
+    def poisson(self, lam, size=None):
+        return self.generator.poisson(lam, size)
+
+
+def as_random_stream(rng=None):
+    """
+    Returns a RandomStream from rng, which can be a RandomStream, a numpy Generator,
+    a seed or SeedSequence for a new Generator, or None for a Generator seeded from the operating system.
+    """
+    if isinstance(rng, RandomStream):
+        return rng
+    if isinstance(rng, np.random.Generator):
+        return RandomStream(rng)
+    return RandomStream(np.random.default_rng(rng))
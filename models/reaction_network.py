@@ -0,0 +1,171 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class ReactionNetwork:
+    """
+    Declarative description of the events of an EventModel whose states are flat count vectors.
+
+    Built from what the events declare about themselves, it holds, in the order of the events:
+        - stoichiometry: sparse (events x dimension) matrix of the change each event makes to the state.
+        For events with random effects it is the expected change.
+        - reactant_orders: sparse (events x dimension) matrix of the order of each reactant of each event.
+        - propensity_laws: the get_propensity_law of each event.
+        "mass_action" rates are the rate constant of the event times the product of its reactant counts,
+        each raised to its order. None means the rate is only known through get_max_rate.
+        - random_effects: boolean array, True for events whose effect is random.
+        - the second moments of the change each event makes, for get_diffusion_matrix.
+
+    Engines can be driven from these arrays instead of the event objects.
+    """
+
+    def __init__(self, events, dimension, get_field_index):
+        """get_field_index maps a state field to its position in the flat state, or None if it is outside it."""
+        self.dimension = dimension
+        self.propensity_laws = [event.get_propensity_law() for event in events]
+        self.random_effects = np.array([event.has_random_effect() for event in events], dtype=bool)
+        self._is_mass_action = None
+
+        changes = {}
+        orders = {}
+        second_moments = {}
+        self._second_moments_known = True
+        for event_index, event in enumerate(events):
+            state_change = event.get_state_change()
+            reads = event.get_reads()
+            if state_change is None or reads is None:
+                raise ValueError("Reaction networks require every event to define get_state_change and get_reads")
+            for field, amount in state_change.items():
+                field_index = get_field_index(field)
+                if field_index is not None and amount != 0:
+                    changes[event_index, field_index] = changes.get((event_index, field_index), 0) + amount
+            for field in reads:
+                field_index = get_field_index(field)
+                if field_index is not None:
+                    orders[event_index, field_index] = orders.get((event_index, field_index), 0) + 1
+            distribution = event.get_state_change_distribution()
+            if distribution is None:
+                self._second_moments_known = False
+                continue
+            for probability, outcome in distribution:
+                flat_change = {}
+                for field, amount in outcome.items():
+                    field_index = get_field_index(field)
+                    if field_index is not None and amount != 0:
+                        flat_change[field_index] = flat_change.get(field_index, 0) + amount
+                for first_index, first_amount in flat_change.items():
+                    for second_index, second_amount in flat_change.items():
+                        key = event_index, first_index, second_index
+                        second_moments[key] = second_moments.get(key, 0) + probability * first_amount * second_amount
+
+        shape = (len(events), dimension)
+        self.stoichiometry = self._to_sparse(changes, shape, float)
+        self.reactant_orders = self._to_sparse(orders, shape, np.int64)
+        self._second_moment_entries = tuple(np.array([key[position] for key in second_moments], dtype=int) 
+                                            for position in range(3)) + (np.array(list(second_moments.values()), dtype=float),)
+
+        # Each event's reactant positions, repeated by order and padded with the position of a constant 1.
+        max_order = max(int(np.asarray(self.reactant_orders.sum(axis=1)).max(initial=0)), 1)
+        self._reactant_indices = np.full((len(events), max_order), dimension)
+        for event_index in range(len(events)):
+            row = self.reactant_orders[event_index]
+            positions = np.repeat(row.indices, row.data)
+            self._reactant_indices[event_index, :len(positions)] = positions
+
+    @property
+    def is_mass_action(self):
+        """Whether every event follows mass action, so that get_rates can be used."""
+        if self._is_mass_action is None:
+            self._is_mass_action = all(law == "mass_action" for law in self.propensity_laws)
+        return self._is_mass_action
+
+    @property
+    def event_count(self):
+        return self.stoichiometry.shape[0]
+
+    def get_rates(self, flat_state, rate_constants):
+        """
+        Returns the mass action rate of every event at a flat state, or at every row of a batch of flat states.
+        rate_constants are those of the events, such as the rate_constants of CompiledParameters.
+        """
+        if not self.is_mass_action:
+            raise ValueError("Only reaction networks of mass action events have rates")
+        flat_state = np.asarray(flat_state)
+        padded_state = np.concatenate([flat_state, np.ones(flat_state.shape[:-1] + (1,), dtype=flat_state.dtype)], axis=-1)
+        return np.asarray(rate_constants, dtype=float) * padded_state[..., self._reactant_indices].prod(axis=-1)
+
+    def get_subnetwork(self, event_indices):
+        """Returns the network of only the events at event_indices, in that order."""
+        event_indices = np.asarray(event_indices, dtype=int)
+        subnetwork = ReactionNetwork.__new__(ReactionNetwork)
+        subnetwork.dimension = self.dimension
+        subnetwork.propensity_laws = [self.propensity_laws[event_index] for event_index in event_indices]
+        subnetwork.random_effects = self.random_effects[event_indices]
+        subnetwork._is_mass_action = None
+        subnetwork.stoichiometry = self.stoichiometry[event_indices]
+        subnetwork.reactant_orders = self.reactant_orders[event_indices]
+        subnetwork._reactant_indices = self._reactant_indices[event_indices]
+        subnetwork._second_moments_known = self._second_moments_known
+        new_indices = np.full(self.event_count, -1)
+        new_indices[event_indices] = np.arange(len(event_indices))
+        entry_events, first_indices, second_indices, values = self._second_moment_entries
+        kept = new_indices[entry_events] >= 0
+        subnetwork._second_moment_entries = (new_indices[entry_events[kept]], first_indices[kept], second_indices[kept], 
+                                             values[kept])
+        return subnetwork
+
+    def get_rate_derivatives(self, flat_state, rate_constants):
+        """
+        Returns the sparse (events x dimension) matrix of the derivative of each mass action rate 
+        with respect to each entry of a flat state.
+        """
+        if not self.is_mass_action:
+            raise ValueError("Only reaction networks of mass action events have rates")
+        padded_state = np.append(np.asarray(flat_state, dtype=float), 1)
+        rate_constants = np.asarray(rate_constants, dtype=float)
+        reactant_counts = padded_state[self._reactant_indices]
+        event_indices = np.arange(self.event_count)
+        rows, columns, values = [], [], []
+        for slot in range(self._reactant_indices.shape[1]):
+            # The derivative of a product with respect to one factor is the product of the others.
+            others = np.delete(reactant_counts, slot, axis=1).prod(axis=1)
+            real = self._reactant_indices[:, slot] < self.dimension
+            rows.append(event_indices[real])
+            columns.append(self._reactant_indices[real, slot])
+            values.append(rate_constants[real] * others[real])
+        return csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))), 
+                          shape=(self.event_count, self.dimension))
+
+    def get_bimolecular_events(self):
+        """
+        Returns the indices of the events with two reactants, or one reactant of order two,
+        and the positions of their first and second reactants. 
+        """
+        if self._reactant_indices.shape[1] > 2:
+            raise ValueError("Only reaction networks of events of order at most two are supported")
+        if self._reactant_indices.shape[1] < 2:
+            return (np.zeros(0, dtype=int),) * 3
+        event_indices = np.flatnonzero(self._reactant_indices[:, 1] < self.dimension)
+        return event_indices, self._reactant_indices[event_indices, 0], self._reactant_indices[event_indices, 1]
+
+    def get_diffusion_matrix(self, event_rates):
+        """
+        Returns the dense (dimension x dimension) matrix of the sum over events of their rate
+        times the expected outer product of the change they make with itself.
+        """
+        if not self._second_moments_known:
+            raise ValueError("Diffusion matrices require every event to define get_state_change_distribution")
+        entry_events, first_indices, second_indices, values = self._second_moment_entries
+        diffusion = np.zeros((self.dimension, self.dimension))
+        np.add.at(diffusion, (first_indices, second_indices), np.asarray(event_rates)[entry_events] * values)
+        return diffusion
+
+    def apply(self, flat_state, event_counts):
+        """Returns flat_state after each event fires its number of times in event_counts, using the expected change."""
+        return flat_state + self.stoichiometry.T @ event_counts
+
+    @staticmethod
+    def _to_sparse(entries, shape, dtype):
+        rows = [event_index for event_index, _ in entries]
+        columns = [field_index for _, field_index in entries]
+        return csr_matrix((np.array(list(entries.values()), dtype=dtype), (rows, columns)), shape=shape)
@@ -0,0 +1,184 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+_code_versions = {}
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of the samples of Model.generate_simulation_data.
+
+    Entries are keyed by a hash of the model, the code of its package, the parameters, the initial state,
+    the timepoints, the sample count, the seed and the options passed to run, so a change to any of them,
+    including to the code, is a miss. Only seeded calls are cached, since unseeded ones are not reproducible,
+    and so are only calls whose options are plain data: a function such as early_stop has no stable description.
+
+    Samples of models with get_state_from_array are stored as one (samples x timepoints x dimension) array
+    in a .npz file, and those of other models, or samples with different timepoints, are pickled. Once the entries take up more than max_bytes,
+    the least recently used are evicted. Several processes can share a directory: entries are written to a
+    temporary file and renamed into place, and writes and evictions hold a lock on the directory.
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, model, parameters, initial_state, timepoints, sample_count, seed, **kwargs):
+        """
+        Returns the hash under which the samples of generate_simulation_data with these arguments are stored,
+        or None if they cannot be cached because an argument is not plain data.
+        """
+        if isinstance(seed, np.random.SeedSequence):
+            seed = {"entropy": seed.entropy, "spawn_key": seed.spawn_key,
+                    "children_spawned": seed.n_children_spawned}
+        if hasattr(initial_state, "export_to_array"):
+            initial_state = initial_state.export_to_array().tolist()
+        description = {
+            "model": model.get_cache_description(),
+            "code": self._get_code_version(model),
+            "parameters": dict(parameters),
+            "initial_state": initial_state,
+            "timepoints": list(timepoints),
+            "sample_count": sample_count,
+            "seed": seed,
+            "options": kwargs,
+        }
+        try:
+            encoded = json.dumps(description, sort_keys=True, default=self._encode)
+        except TypeError:
+            return None
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def get(self, model, key):
+        """Returns the list of timepoint data dictionaries stored under key, or None if there are none."""
+        for path in (self._get_path(key, ".npz"), self._get_path(key, ".pkl")):
+            try:
+                samples = self._read(model, path)
+            except FileNotFoundError:
+                continue
+            with self._lock():
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+            self.hits += 1
+            return samples
+        self.misses += 1
+        return None
+
+    def put(self, model, key, samples):
+        """Stores a list of timepoint data dictionaries under key, then evicts entries over max_bytes."""
+        times = list(samples[0]) if samples else []
+        if hasattr(model, "get_state_from_array") and samples and all(list(sample) == times for sample in samples):
+            states = np.array([[sample[time].export_to_array() for time in times] for sample in samples])
+            suffix = ".npz"
+            write = lambda file: np.savez(file, times=np.array(times), states=states)
+        else:
+            suffix = ".pkl"
+            write = lambda file: pickle.dump(samples, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                write(file)
+            with self._lock():
+                os.replace(temporary_path, self._get_path(key, suffix))
+                self._evict()
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def get_stats(self):
+        """Returns the hits and misses of this cache object, and the entries and bytes in its directory."""
+        sizes = [os.path.getsize(path) for path in self._get_entry_paths()]
+        return {"hits": self.hits, "misses": self.misses, "entries": len(sizes), "bytes": sum(sizes)}
+
+    def clear(self):
+        with self._lock():
+            for path in self._get_entry_paths():
+                os.remove(path)
+
+    def _read(self, model, path):
+        if path.endswith(".pkl"):
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        with np.load(path) as entry:
+            times = entry["times"].tolist()
+            states = entry["states"]
+        return [{time: model.get_state_from_array(states[sample_index, time_index])
+                 for time_index, time in enumerate(times)}
+                for sample_index in range(states.shape[0])]
+
+    def _evict(self):
+        """Removes least recently used entries until they fit in max_bytes. Must hold the lock."""
+        entries = []
+        for path in self._get_entry_paths():
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _encode(value):
+        """Encodes NumPy values for json.dumps. Anything else that json cannot encode raises a TypeError."""
+        if isinstance(value, (np.generic, np.ndarray)):
+            return value.tolist()
+        raise TypeError(f"{type(value).__name__} cannot be part of a cache key")
+
+    def _get_entry_paths(self):
+        return glob.glob(os.path.join(self.directory, "*.npz")) + glob.glob(os.path.join(self.directory, "*.pkl"))
+
+    def _get_path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _get_code_version(model):
+        """Hash of the source of the models package and of the module defining the model."""
+        module_path = getattr(sys.modules.get(type(model).__module__), "__file__", None)
+        if module_path not in _code_versions:
+            paths = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py")))
+            if module_path is not None and module_path not in paths:
+                paths.append(module_path)
+            code_hash = hashlib.sha256()
+            for path in paths:
+                with open(path, "rb") as source_file:
+                    code_hash.update(source_file.read())
+            _code_versions[module_path] = code_hash.hexdigest()
+        return _code_versions[module_path]
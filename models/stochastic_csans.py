@@ -1,148 +1,216 @@
-from models.event import TimeIndependentEvent as TIE, EventModel
+from functools import lru_cache
+from math import comb
+
+from models.event import TimeIndependentEvent as TIE, EventModel, add_to_state_field
+from models.csan_kernel import CSANPropensityKernel
+from models.csan_parameters import get_formation_rate_constants, get_formation_rate_table
+from models.moments import MomentEquations
+from models.random_stream import as_random_stream
 import numpy as np
 
 class State:
+    """
+    State of a CSANModel.
+
+    All counts live in one contiguous int64 buffer in the export_to_list layout:
+    [D, Es (e_receptors + 1), Ts (t_receptors + 1), EDTs (e_receptors x t_receptors), ETs (e_receptors x t_receptors)].
+    Es, Ts, EDTs and ETs are NumPy views into the buffer, so they are indexed and assigned as before,
+    copying a state is a single buffer copy and exporting it does not copy at all.
+    """
     def __init__(self, D, Es, Ts, EDTs, ETs):
-        self.D = D
-        self.Es = Es
-        self.Ts = Ts
-        self.EDTs = EDTs
-        self.ETs = ETs
+        counts = [D] + list(Es) + list(Ts) + [EDT for row in EDTs for EDT in row] + [ET for row in ETs for ET in row]
+        buffer = np.array(counts)
+        if buffer.dtype.kind in "biu":
+            buffer = buffer.astype(np.int64)
+        self._set_buffer(buffer, len(Es) - 1, len(Ts) - 1)
+
+    def _set_buffer(self, buffer, e_receptors, t_receptors):
+        self.e_receptors = e_receptors
+        self.t_receptors = t_receptors
+        self._buffer = buffer
+        Es_end = 1 + e_receptors + 1
+        Ts_end = Es_end + t_receptors + 1
+        EDTs_end = Ts_end + e_receptors * t_receptors
+        self._Es = buffer[1:Es_end]
+        self._Ts = buffer[Es_end:Ts_end]
+        self._EDTs = buffer[Ts_end:EDTs_end].reshape(e_receptors, t_receptors)
+        self._ETs = buffer[EDTs_end:].reshape(e_receptors, t_receptors)
+
+    @staticmethod
+    def get_dimension(e_receptors, t_receptors):
+        """Returns the length of the flat layout of states with the given receptor counts."""
+        return 3 + e_receptors + t_receptors + 2 * e_receptors * t_receptors
+
+    @staticmethod
+    def get_field_index(field, e_receptors, t_receptors):
+        """
+        Returns the position of a field such as ("D",) or ("EDTs", 1, 3) in the flat layout,
+        or None if the field is outside states with the given receptor counts.
+        """
+        name = field[0]
+        if name == "D":
+            return 0
+        if name == "Es" and 0 <= field[1] <= e_receptors:
+            return 1 + field[1]
+        if name == "Ts" and 0 <= field[1] <= t_receptors:
+            return e_receptors + 2 + field[1]
+        if name in ("EDTs", "ETs") and 0 <= field[1] < e_receptors and 0 <= field[2] < t_receptors:
+            start = e_receptors + t_receptors + 3
+            if name == "ETs":
+                start += e_receptors * t_receptors
+            return start + field[1] * t_receptors + field[2]
+        return None
+
+    @staticmethod
+    def from_array(buffer, e_receptors, t_receptors):
+        """Returns a state backed by buffer, which must be a flat array in the export_to_list layout. Does not copy."""
+        state = State.__new__(State)
+        state._set_buffer(buffer, e_receptors, t_receptors)
+        return state
+
+    @property
+    def D(self):
+        return self._buffer.item(0)
+
+    @D.setter
+    def D(self, value):
+        self._buffer[0] = value
+
+    @property
+    def Es(self):
+        return self._Es
+
+    @Es.setter
+    def Es(self, values):
+        self._Es[...] = values
+
+    @property
+    def Ts(self):
+        return self._Ts
+
+    @Ts.setter
+    def Ts(self, values):
+        self._Ts[...] = values
+
+    @property
+    def EDTs(self):
+        return self._EDTs
+
+    @EDTs.setter
+    def EDTs(self, values):
+        self._EDTs[...] = values
+
+    @property
+    def ETs(self):
+        return self._ETs
+
+    @ETs.setter
+    def ETs(self, values):
+        self._ETs[...] = values
+
+    def copy(self):
+        return State.from_array(self._buffer.copy(), self.e_receptors, self.t_receptors)
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        return State.from_array, (self._buffer, self.e_receptors, self.t_receptors)
 
     def verify_coherence(self):
-        if self.D < 0:
-            return False
-        for E in self.Es:
-            if E < 0:
-                return False
-        for T in self.Ts:
-            if T < 0:
-                return False
-        for EDT_by_E in self.EDTs:
-            for EDT in EDT_by_E:
-                if EDT < 0:
-                    return False
-        for ET_by_E in self.ETs:
-            for ET in ET_by_E:
-                if ET < 0:
-                    return False
-        return True
+        return bool((self._buffer >= 0).all())
 
     def E(self):
-        return sum(self.Es)
+        return self._Es.sum().item()
     
     def T(self):
-        return sum(self.Ts)
+        return self._Ts.sum().item()
     
     def EDT(self):
-        return sum([sum(row) for row in self.EDTs])
+        return self._EDTs.sum().item()
     
     def ET(self):
-        return sum([sum(row) for row in self.ETs])
+        return self._ETs.sum().item()
 
     def total_D(self):
-        total = self.D
-        for i, E in enumerate(self.Es):
-            total += i * E
-        for i, T in enumerate(self.Ts):
-            total += i * T
-        for i, row in enumerate(self.EDTs):
-            for j, EDT in enumerate(row):
-                total += (i + j + 1) * EDT
-        for i, row in enumerate(self.ETs):
-            for j, ET in enumerate(row):
-                total += (i + j) * ET
-        return total
+        return (self._buffer @ _get_total_D_weights(self.e_receptors, self.t_receptors)).item()
 
     def bound_D_per_E(self):
-        total_bound_D = 0
-        total_E = 0
-        for i, E in enumerate(self.Es):
-            total_bound_D += i * E
-            total_E += E
+        total_bound_D = (np.arange(self.e_receptors + 1) @ self._Es).item()
         if total_bound_D == 0:
             return total_bound_D
-        return total_bound_D / total_E
+        return total_bound_D / self.E()
     
     def bound_D_per_T(self):
-        total_bound_D = 0
-        total_T = 0
-        for i, T in enumerate(self.Ts):
-            total_bound_D += i * T
-            total_T += T
+        total_bound_D = (np.arange(self.t_receptors + 1) @ self._Ts).item()
         if total_bound_D == 0:
             return total_bound_D
-        return total_bound_D / total_T
+        return total_bound_D / self.T()
 
     def export_to_list(self):
-        l = [self.D]
-        for e in self.Es:
-            l.append(e)
-        for t in self.Ts:
-            l.append(t)
-        for l1 in self.EDTs:
-            for edt in l1:
-                l.append(edt)
-        for l1 in self.ETs:
-            for et in l1:
-                l.append(et)
-        return l
+        return self._buffer.tolist()
+
+    def export_to_array(self):
+        """Returns the buffer backing the state in the export_to_list layout. Does not copy."""
+        return self._buffer
 
     @staticmethod
     def import_from_list(l, e_receptors, t_receptors):
-        Ds_end = 1
-        D = l[0]
-        Es_end = Ds_end + e_receptors + 1
-        Es = l[Ds_end: Es_end]
-        Ts_end = Es_end + t_receptors + 1
-        Ts = l[Es_end:Ts_end]
-        EDTs = []
-        for i in range(e_receptors):
-            start = Ts_end + i * t_receptors
-            end = Ts_end + (i + 1) * t_receptors
-            EDTs.append(l[start:end])
-        ETs = []
-        for i in range(e_receptors):
-            start = Ts_end + i * t_receptors + t_receptors * e_receptors
-            end = Ts_end + (i + 1) * t_receptors + t_receptors * e_receptors
-            ETs.append(l[start:end])
-        return State(D, Es, Ts, EDTs, ETs)
-        
+        return State.from_array(np.array(l), e_receptors, t_receptors)
 
     def __repr__(self):
-        return f"D: {self.D}. Es: {self.Es}. Ts: {self.Ts}. EDTs: {self.EDTs}. ETs: {self.ETs}"
+        return f"D: {self.D}. Es: {self.Es.tolist()}. Ts: {self.Ts.tolist()}. EDTs: {self.EDTs.tolist()}. ETs: {self.ETs.tolist()}"
 
     def __add__(self, other):
-        return State(
-            self.D + other.D, 
-            [e1 + e2 for e1, e2 in zip(self.Es, other.Es)], 
-            [t1 + t2 for t1, t2 in zip(self.Ts, other.Ts)],
-            [[edt1 + edts for edt1, edt2 in zip(l1, l2)] for l1, l2 in zip(self.EDTs, other.EDTs)],
-            [[et1 + ets for et1, et2 in zip(l1, l2)] for l1, l2 in zip(self.ETs, other.ETs)]
-            )
+        return State.from_array(self._buffer + other._buffer, self.e_receptors, self.t_receptors)
     
     def __sub__(self, other):
-        return State(
-            self.D - other.D, 
-            [e1 - e2 for e1, e2 in zip(self.Es, other.Es)], 
-            [t1 - t2 for t1, t2 in zip(self.Ts, other.Ts)],
-            [[edt1 - edts for edt1, edt2 in zip(l1, l2)] for l1, l2 in zip(self.EDTs, other.EDTs)],
-            [[et1 - ets for et1, et2 in zip(l1, l2)] for l1, l2 in zip(self.ETs, other.ETs)],
-            )
+        return State.from_array(self._buffer - other._buffer, self.e_receptors, self.t_receptors)
 
     def __mul__(self, other):
-        return State(
-            self.D * other, 
-            [e1 * other for e1 in self.Es], 
-            [t1 * other for t1 in self.Ts],
-            [[edt1 * other for edt1 in l1] for l1 in self.EDTs],
-            [[et1 * other for et1 in l1] for l1 in self.ETs]
-            )
+        return State.from_array(self._buffer * other, self.e_receptors, self.t_receptors)
+
+CSAN_OBSERVABLES = {
+    "T": State.T,
+    "E": State.E,
+    "D": lambda state: state.D,
+    "total_D": State.total_D,
+    "bound_D_per_E": State.bound_D_per_E,
+    "bound_D_per_T": State.bound_D_per_T,
+}
+
+LINEAR_CSAN_OBSERVABLES = {name: CSAN_OBSERVABLES[name] for name in ("T", "E", "D", "total_D")}
+
+@lru_cache
+def _get_total_D_weights(e_receptors, t_receptors):
+    """CSANs carried by each entry of the flat layout."""
+    e_bound = np.arange(e_receptors + 1)
+    t_bound = np.arange(t_receptors + 1)
+    return np.concatenate([
+        [1],
+        e_bound,
+        t_bound,
+        (e_bound[:-1, None] + t_bound[None, :-1] + 1).ravel(),
+        (e_bound[:-1, None] + t_bound[None, :-1]).ravel(),
+    ])
+
+_reaction_networks = {}
 
 class CSANModel(EventModel):
-    def __init__(self, e_receptors, t_receptors):
+    methods = EventModel.methods + ("vectorized", "hybrid")
+    instrumented_methods = EventModel.instrumented_methods + ("vectorized",)
+    recording_methods = EventModel.recording_methods + ("vectorized",)
+
+    def __init__(self, e_receptors, t_receptors, method="direct"):
+        """
+        In addition to the methods of EventModel, method can be:
+            - "vectorized": the direct method with every rate computed at once by a CSANPropensityKernel.
+            - "hybrid": approximate. Fast events on abundant fields are integrated continuously 
+            and the others are simulated exactly. See _run_hybrid.
+        """
         self.e_receptors = e_receptors
         self.t_receptors = t_receptors
+        self._propensity_kernel = None
 
         events = []
         for bound_CSAN_count in range(e_receptors + 1):
@@ -164,107 +232,469 @@ class CSANModel(EventModel):
             for tumor_bound_count in range(t_receptors):
                 events.append(TrimerDeath(TCell_bound_count, tumor_bound_count, e_receptors, t_receptors)) 
                 events.append(DimerDeath(TCell_bound_count, tumor_bound_count, e_receptors, t_receptors))
-        self.events = events
+        super().__init__(events, method)
     
     
     def get_empty_state(self):
-        D = 0
-        Es = [0 for _ in range(self.e_receptors + 1)]
-        Ts = [0 for _ in range(self.t_receptors + 1)]
-        EDTs = [[0 for _ in range(self.t_receptors)] for __ in range(self.e_receptors)]
-        ETs = [[0 for _ in range(self.t_receptors)] for __ in range(self.e_receptors)]
-        
-        return State(D, Es, Ts, EDTs, ETs)
-    
-class TCellDeath(TIE):
+        buffer = np.zeros(State.get_dimension(self.e_receptors, self.t_receptors), dtype=np.int64)
+        return State.from_array(buffer, self.e_receptors, self.t_receptors)
+
+    def get_dimension(self):
+        return State.get_dimension(self.e_receptors, self.t_receptors)
+
+    def get_state_from_array(self, buffer):
+        return State.from_array(buffer, self.e_receptors, self.t_receptors)
+
+    def get_field_index(self, field):
+        return State.get_field_index(field, self.e_receptors, self.t_receptors)
+
+    def get_reaction_network(self):
+        """Returns the ReactionNetwork of the model. Models with the same receptor counts share it."""
+        key = (self.e_receptors, self.t_receptors)
+        if key not in _reaction_networks:
+            _reaction_networks[key] = super().get_reaction_network()
+        return _reaction_networks[key]
+
+    def _get_parameter_tables(self, parameters):
+        return {"formation_rate_constants": get_formation_rate_table(parameters, self.e_receptors, self.t_receptors)}
+
+    def get_propensity_kernel(self):
+        """Returns a kernel that computes the rates of all events, in the order of self.events, with NumPy."""
+        if self._propensity_kernel is None:
+            self._propensity_kernel = CSANPropensityKernel(self.e_receptors, self.t_receptors)
+        return self._propensity_kernel
+
+    def generate_batched_simulation_data(self, parameters: dict, initial_state, timepoints: list, 
+                                         sample_count: int = 1, max_num_steps=None, rng=None):
+        """
+        Returns the same result as generate_simulation_data, but advances all samples in lockstep.
+
+        The samples are held as rows of a (sample_count x dimension) array. Every iteration, each unfinished
+        sample either fires one event or reaches its next timepoint, and rates, waiting times
+        and event effects are computed for all of them at once with array operations.
+        Recorded states are views into one (sample_count x timepoints x dimension) array.
+        max_num_steps limits the number of iterations. rng is as in run.
+        """
+        generator = as_random_stream(rng).generator
+        kernel = self.get_propensity_kernel()
+        changes, birth_bound_counts = self._get_batch_tables()
+        timepoints_array = np.array(timepoints, dtype=float)
+        tumor_start = State.get_field_index(("Ts", 0), self.e_receptors, self.t_receptors)
+
+        states = np.tile(initial_state.export_to_array(), (sample_count, 1))
+        recorded = np.empty((sample_count, len(timepoints), states.shape[1]), dtype=states.dtype)
+        times = np.zeros(sample_count)
+        next_timepoints = np.zeros(sample_count, dtype=int)
+        active = np.arange(sample_count) if len(timepoints) else np.arange(0)
+        num_steps = 0
+        while active.size:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for batched simulation exceeded")
+            rates = kernel.get_rates(states[active], parameters)
+            cumulative_rates = np.cumsum(rates, axis=1)
+            total_rates = cumulative_rates[:, -1]
+            with np.errstate(divide="ignore"):
+                new_times = times[active] + generator.standard_exponential(active.size) / total_rates
+
+            # Samples whose next event is past their next timepoint record it and discard the event.
+            boundaries = timepoints_array[next_timepoints[active]]
+            crossing = new_times > boundaries
+            rows = active[crossing]
+            recorded[rows, next_timepoints[rows]] = states[rows]
+            times[rows] = boundaries[crossing]
+            next_timepoints[rows] += 1
+
+            firing = ~crossing
+            rows = active[firing]
+            targets = generator.random(rows.size) * total_rates[firing]
+            # Targets that rounding puts at the total rate select the last event of the row with a positive rate.
+            last_positive = rates.shape[1] - 1 - np.argmax(rates[firing, ::-1] > 0, axis=1)
+            event_indices = np.minimum((cumulative_rates[firing] <= targets[:, None]).sum(axis=1), last_positive)
+            states[rows] += changes[event_indices]
+            times[rows] = new_times[firing]
+
+            births = birth_bound_counts[event_indices] >= 0
+            if births.any():
+                parent_counts = birth_bound_counts[event_indices[births]]
+                child_counts = generator.binomial(parent_counts, 0.5)
+                np.add.at(states, (rows[births], tumor_start + child_counts), 1)
+                np.add.at(states, (rows[births], tumor_start + parent_counts - child_counts), 1)
+
+            active = active[next_timepoints[active] < len(timepoints)]
+
+        simulation_result = {
+            "parameters": parameters,
+            "model": self.name,
+            "data": [],
+            "timepoints": timepoints
+        }
+        for sample in recorded:
+            timepoint_data = {0: initial_state}
+            for time, flat_state in zip(timepoints, sample):
+                timepoint_data[time] = State.from_array(flat_state, self.e_receptors, self.t_receptors)
+            simulation_result["data"].append(timepoint_data)
+        return simulation_result
+
+    def generate_moment_data(self, parameters: dict, initial_state, timepoints: list, observables=None, closure="lna",
+                             **options):
+        """
+        Returns approximate means and variances of observables at timepoints from one solve of moment equations
+        instead of from samples. See MomentEquations for the closures. Other keyword arguments are passed to its solve.
+
+        observables maps names to linear functions of a state, LINEAR_CSAN_OBSERVABLES by default.
+        The result has the format of generate_summary_data without quantiles, 
+        and also holds the means and covariances of the whole state.
+        """
+        observables = LINEAR_CSAN_OBSERVABLES if observables is None else observables
+        moments = MomentEquations(self, closure).solve(parameters, initial_state, timepoints, **options)
+        moment_result = {
+            "timepoints": moments["timepoints"],
+            "observables": {},
+            "means": moments["means"],
+            "covariances": moments["covariances"],
+            "parameters": parameters,
+            "model": self.name,
+        }
+        for name, observable in observables.items():
+            means, variances = MomentEquations.get_observable_moments(moments, self.get_observable_weights(observable))
+            moment_result["observables"][name] = {"mean": means.tolist(), "variance": variances.tolist()}
+        return moment_result
+
+    def get_observable_weights(self, observable):
+        """Returns the weights of a linear observable, so that observable(state) is weights @ state.export_to_array()."""
+        unit_states = np.eye(self.get_dimension(), dtype=np.int64)
+        return np.array([observable(State.from_array(unit_state, self.e_receptors, self.t_receptors)) 
+                         for unit_state in unit_states], dtype=float)
+
+    def _get_batch_tables(self):
+        """
+        Returns the change each event makes to the flat layout, one row per event, and the bound CSAN count 
+        of each TumorBirth event (-1 for other events). The rows of TumorBirth events only remove the parent, 
+        since where the daughters go is random.
+        """
+        network = self.get_reaction_network()
+        changes = network.stoichiometry.toarray()
+        changes[network.random_effects] = -network.reactant_orders[network.random_effects].toarray()
+        birth_bound_counts = np.array([event.bound_CSAN_count if isinstance(event, TumorBirth) else -1 
+                                       for event in self.events])
+        return changes.astype(np.int64), birth_bound_counts
+
+    def _run_vectorized(self, parameters, current_state, duration, max_num_steps, rng, metrics=None, recorder=None):
+        kernel = self.get_propensity_kernel()
+        current_time = 0
+        num_steps = 0
+        if metrics is not None:
+            metrics.lap()
+        while True:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for single simulation exceeded")
+            rates = kernel.get_rates(current_state.export_to_array(), parameters)
+            cumulative_rates = np.cumsum(rates)
+            total_rate = cumulative_rates[-1]
+            if metrics is not None:
+                metrics.lap("rates")
+            if total_rate == 0:
+                break
+            current_time += rng.exponential() / total_rate
+            if recorder is not None and current_time > recorder.next_time and recorder.record(current_state, current_time):
+                break
+            if current_time > duration:
+                break
+            # The first event whose cumulative rate exceeds the target. It always has a positive rate,
+            # unless rounding puts the target at the total, and then it is the last event with one.
+            event_index = np.searchsorted(cumulative_rates, rng.random() * total_rate, side="right")
+            if event_index == len(rates):
+                event_index = np.flatnonzero(rates)[-1]
+            if metrics is not None:
+                metrics.lap("selection")
+            self.events[event_index].implement(current_state, rng=rng)
+            if metrics is not None:
+                metrics.lap("implement")
+                metrics.record_firing(self.events[event_index])
+        return current_state
+
+    def _run_hybrid(self, parameters, current_state, duration, max_num_steps, rng, epsilon=0.03, fast_count=100,
+                    fast_rate_ratio=10, noise=False):
+        """
+        Partitioned hybrid simulation, after Haseltine and Rawlings (2002) and Salis and Kaznessis (2005).
+
+        Every step, the events are split anew into fast and slow ones. An event is fast when every field it consumes
+        holds at least fast_count, its effect is not random, and its rate is at least fast_rate_ratio times 
+        the total rate of the events that consume smaller fields. In practice these are the binding events 
+        while free CSANs and cell populations are abundant.
+        Fast events are integrated as ODEs, or with noise=True as chemical Langevin equations, over steps that 
+        change no field they move by more than a fraction epsilon of the larger of its count and fast_count. Slow events fire exactly, when their integrated rate 
+        reaches an exponential threshold, so cell level events keep their discrete, random timing.
+        Counts are continuous during the run and rounded to the nearest integer at the end.
+        """
+        network = self.get_reaction_network().get_subnetwork(parameters.active_events)
+        events = [self.events[event_index] for event_index in parameters.active_events]
+        rate_constants = [parameters.rate_constants[event_index] for event_index in parameters.active_events]
+        stoichiometry = network.stoichiometry
+        transposed_stoichiometry = stoichiometry.T.tocsr()
+        # Fields each event consumes, padded with a position that is never small.
+        consumed = [[] for _ in events]
+        for event_index, field_index in zip(*(stoichiometry < 0).nonzero()):
+            consumed[event_index].append(field_index)
+        consumed_fields = np.full((len(events), max(map(len, consumed), default=1) or 1), network.dimension)
+        for event_index, fields in enumerate(consumed):
+            consumed_fields[event_index, :len(fields)] = fields
+        exact_only = network.random_effects
+
+        counts = current_state.export_to_array().astype(float)
+        current_time = 0
+        hazard = 0
+        hazard_threshold = rng.exponential()
+        num_steps = 0
+        while current_time < duration:
+            num_steps += 1
+            if max_num_steps is not None and num_steps > max_num_steps:
+                raise RuntimeError(
+                    "Maximum number of steps for single simulation exceeded")
+            rates = network.get_rates(counts, rate_constants)
+            abundant = (np.append(counts, np.inf)[consumed_fields].min(axis=1) >= fast_count) & ~exact_only
+            fast = abundant & (rates >= fast_rate_ratio * rates[~abundant].sum())
+            slow_rates = np.where(fast, 0, rates)
+            slow_rate = slow_rates.sum()
+
+            step = duration - current_time
+            if fast.any():
+                fast_rates = np.where(fast, rates, 0)
+                drift = transposed_stoichiometry @ fast_rates
+                moving = drift != 0
+                if moving.any():
+                    step = min(step, epsilon * (np.maximum(counts[moving], fast_count) / np.abs(drift[moving])).min())
+            elif slow_rate == 0:
+                break
+            fires = slow_rate > 0 and hazard + slow_rate * step >= hazard_threshold
+            if fires:
+                step = (hazard_threshold - hazard) / slow_rate
+
+            if fast.any():
+                firings = fast_rates * step
+                if noise:
+                    firings += np.sqrt(firings) * rng.generator.standard_normal(len(firings))
+                counts += transposed_stoichiometry @ firings
+                np.maximum(counts, 0, out=counts)
+            current_time += step
+            hazard += slow_rate * step
+            if not fires:
+                continue
+
+            event_index = np.searchsorted(np.cumsum(slow_rates), rng.random() * slow_rate, side="right")
+            if event_index == len(slow_rates):
+                event_index = np.flatnonzero(slow_rates)[-1]
+            if exact_only[event_index]:
+                # Implement on whole counts and carry over the change, keeping the fractional parts.
+                scratch_state = State.from_array(np.rint(counts).astype(np.int64), self.e_receptors, self.t_receptors)
+                before = scratch_state.export_to_array().copy()
+                events[event_index].implement(scratch_state, rng=rng)
+                counts += scratch_state.export_to_array() - before
+            else:
+                start, end = stoichiometry.indptr[event_index], stoichiometry.indptr[event_index + 1]
+                counts[stoichiometry.indices[start:end]] += stoichiometry.data[start:end]
+            np.maximum(counts, 0, out=counts)
+            hazard = 0
+            hazard_threshold = rng.exponential()
+
+        current_state.export_to_array()[:] = np.rint(counts)
+        return current_state
+
+class CSANEvent(TIE):
+    """
+    Events of the CSAN model. Their effects are described by get_state_change, 
+    which also determines the fields they write.
+    Their rates follow mass action: get_rate_constant times the counts of the fields in get_reads.
+    """
+
+    def get_propensity_law(self):
+        return "mass_action"
+
+    def get_writes(self):
+        return set(self.get_state_change())
+
+    def implement_many(self, state, count, **kwargs):
+        for field, amount in self.get_state_change().items():
+            add_to_state_field(state, field, amount * count)
+        return state
+
+class TCellDeath(CSANEvent):
     def __init__(self, bound_CSAN_count):
         self.bound_CSAN_count = bound_CSAN_count
 
     def get_max_rate(self, state, parameters):
-        return state.Es[self.bound_CSAN_count] * parameters["d_E"]
+        return state.Es.item(self.bound_CSAN_count) * parameters["d_E"]
 
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return model_parameters["d_E"]
+
+    def implement(self, state, rng=None):
         state.Es[self.bound_CSAN_count] = state.Es[self.bound_CSAN_count] - 1
         state.D = state.D + self.bound_CSAN_count
 
-class TumorBirth(TIE):
+    def get_reads(self):
+        return {("Es", self.bound_CSAN_count)}
+
+    def get_state_change(self):
+        return {("Es", self.bound_CSAN_count): -1, ("D",): self.bound_CSAN_count}
+
+class TumorBirth(CSANEvent):
     def __init__(self, bound_CSAN_count):
         self.bound_CSAN_count = bound_CSAN_count
     
     def get_max_rate(self, state, parameters):
-        return state.Ts[self.bound_CSAN_count] * parameters["b_T"]
+        return state.Ts.item(self.bound_CSAN_count) * parameters["b_T"]
         
 
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return model_parameters["b_T"]
+
+    def implement(self, state, rng=None):
         state.Ts[self.bound_CSAN_count] = state.Ts[self.bound_CSAN_count] - 1
-        child_csans = np.random.binomial(self.bound_CSAN_count, 0.5)
+        child_csans = (rng or np.random).binomial(self.bound_CSAN_count, 0.5)
         child_csans2 = self.bound_CSAN_count - child_csans
         state.Ts[child_csans] = state.Ts[child_csans] + 1
         state.Ts[child_csans2] = state.Ts[child_csans2] + 1
         return state
- 
-class TCellBinding(TIE):
+
+    def get_reads(self):
+        return {("Ts", self.bound_CSAN_count)}
+
+    def has_random_effect(self):
+        return True
+
+    def get_state_change(self):
+        change = {("Ts", child_csans): 2 * comb(self.bound_CSAN_count, child_csans) / 2 ** self.bound_CSAN_count 
+                  for child_csans in range(self.bound_CSAN_count + 1)}
+        change[("Ts", self.bound_CSAN_count)] -= 1
+        return change
+
+    def get_state_change_distribution(self):
+        distribution = []
+        for child_csans in range(self.bound_CSAN_count + 1):
+            change = {}
+            for field, amount in ((("Ts", self.bound_CSAN_count), -1), (("Ts", child_csans), 1), 
+                                  (("Ts", self.bound_CSAN_count - child_csans), 1)):
+                change[field] = change.get(field, 0) + amount
+            distribution.append((comb(self.bound_CSAN_count, child_csans) / 2 ** self.bound_CSAN_count, change))
+        return distribution
+
+    def implement_many(self, state, count, rng=None):
+        state.Ts[self.bound_CSAN_count] = state.Ts[self.bound_CSAN_count] - count
+        child_csans = (rng or np.random).binomial(self.bound_CSAN_count, 0.5, size=count)
+        child_counts = np.bincount(child_csans, minlength=self.bound_CSAN_count + 1)
+        # The sibling of each child with k CSANs has the other bound_CSAN_count - k.
+        state.Ts[:self.bound_CSAN_count + 1] += child_counts + child_counts[::-1]
+        return state
+
+class TCellBinding(CSANEvent):
     def __init__(self, bound_CSAN_count, receptor_count):
         self.bound_CSAN_count = bound_CSAN_count
         self.receptor_count = receptor_count
         self.free_receptor_count = self.receptor_count - self.bound_CSAN_count
     
     def get_max_rate(self, state, parameters):
-        return state.D * self.free_receptor_count * state.Es[self.bound_CSAN_count] * parameters["lambda_E"]
+        return state.D * self.free_receptor_count * state.Es.item(self.bound_CSAN_count) * parameters["lambda_E"]
         
     
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return self.free_receptor_count * model_parameters["lambda_E"]
+
+    def implement(self, state, rng=None):
         state.D = state.D - 1
         state.Es[self.bound_CSAN_count] = state.Es[self.bound_CSAN_count] - 1
         state.Es[self.bound_CSAN_count + 1] = state.Es[self.bound_CSAN_count + 1] + 1
         return state
 
-class TumorBinding(TIE):
+    def get_reads(self):
+        return {("D",), ("Es", self.bound_CSAN_count)}
+
+    def get_state_change(self):
+        return {("D",): -1, ("Es", self.bound_CSAN_count): -1, ("Es", self.bound_CSAN_count + 1): 1}
+
+class TumorBinding(CSANEvent):
     def __init__(self, bound_CSAN_count, receptor_count):
         self.bound_CSAN_count = bound_CSAN_count
         self.receptor_count = receptor_count
         self.free_receptor_count = self.receptor_count - self.bound_CSAN_count
     
     def get_max_rate(self, state, parameters):
-        return state.D * self.free_receptor_count * state.Ts[self.bound_CSAN_count] * parameters["lambda_T"]
+        return state.D * self.free_receptor_count * state.Ts.item(self.bound_CSAN_count) * parameters["lambda_T"]
          
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return self.free_receptor_count * model_parameters["lambda_T"]
+
+    def implement(self, state, rng=None):
         state.D = state.D - 1
         state.Ts[self.bound_CSAN_count] = state.Ts[self.bound_CSAN_count] - 1
         state.Ts[self.bound_CSAN_count + 1] = state.Ts[self.bound_CSAN_count + 1] + 1
         return state
 
-class TCellInternalization(TIE):
+    def get_reads(self):
+        return {("D",), ("Ts", self.bound_CSAN_count)}
+
+    def get_state_change(self):
+        return {("D",): -1, ("Ts", self.bound_CSAN_count): -1, ("Ts", self.bound_CSAN_count + 1): 1}
+
+class TCellInternalization(CSANEvent):
     def __init__(self, bound_CSAN_count, receptor_count):
         self.bound_CSAN_count = bound_CSAN_count
         self.receptor_count = receptor_count
         self.free_receptor_count = self.receptor_count - self.bound_CSAN_count
     
     def get_max_rate(self, state, parameters):
-        return self.bound_CSAN_count * state.Es[self.bound_CSAN_count] * parameters["mu_E"]
+        return self.bound_CSAN_count * state.Es.item(self.bound_CSAN_count) * parameters["mu_E"]
         
     
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return self.bound_CSAN_count * model_parameters["mu_E"]
+
+    def implement(self, state, rng=None):
         state.Es[self.bound_CSAN_count] = state.Es[self.bound_CSAN_count] - 1
         state.Es[self.bound_CSAN_count - 1] = state.Es[self.bound_CSAN_count - 1] + 1
         return state
 
-class TumorInternalization(TIE):
+    def get_reads(self):
+        return {("Es", self.bound_CSAN_count)}
+
+    def get_state_change(self):
+        return {("Es", self.bound_CSAN_count): -1, ("Es", self.bound_CSAN_count - 1): 1}
+
+class TumorInternalization(CSANEvent):
     def __init__(self, bound_CSAN_count, receptor_count):
         self.bound_CSAN_count = bound_CSAN_count
         self.receptor_count = receptor_count
         self.free_receptor_count = self.receptor_count - self.bound_CSAN_count
     
     def get_max_rate(self, state, parameters):
-        return self.bound_CSAN_count * state.Ts[self.bound_CSAN_count] * parameters["mu_T"]
+        return self.bound_CSAN_count * state.Ts.item(self.bound_CSAN_count) * parameters["mu_T"]
         
     
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return self.bound_CSAN_count * model_parameters["mu_T"]
+
+    def implement(self, state, rng=None):
         state.Ts[self.bound_CSAN_count] = state.Ts[self.bound_CSAN_count] - 1
         state.Ts[self.bound_CSAN_count - 1] = state.Ts[self.bound_CSAN_count - 1] + 1
         return state
 
-class ED_TFormation(TIE):
+    def get_reads(self):
+        return {("Ts", self.bound_CSAN_count)}
+
+    def get_state_change(self):
+        return {("Ts", self.bound_CSAN_count): -1, ("Ts", self.bound_CSAN_count - 1): 1}
+
+class ComplexFormation(CSANEvent):
+    """
+    Formation of a complex from a TCell and a tumor cell. 
+    complex_type is the position of the rate constant of the complex in get_formation_rate_constants.
+    """
+    complex_type = None
+
     def __init__(self, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
         self.TCell_bound_count = TCell_bound_count
         self.tumor_bound_count = tumor_bound_count
@@ -272,85 +702,53 @@ class ED_TFormation(TIE):
         self.tumor_receptors = tumor_receptors
 
     def get_max_rate(self, state, model_parameters):
-        p_e_t = model_parameters["p_E|T"]
-        p_ed_t = model_parameters["p_ED|T"]
-        p_e_dt = model_parameters["p_E|DT"]
-        lambda_ET = model_parameters["lambda_ET"]
-        m = model_parameters["M"]
-        c_e_t = (self.TCell_receptors - self.TCell_bound_count) * (self.tumor_receptors - self.tumor_bound_count) * p_e_t / (self.TCell_receptors * self.tumor_receptors)
-        c_e_dt = (self.TCell_receptors - self.TCell_bound_count) * self.tumor_bound_count * p_e_dt / (self.TCell_receptors * self.tumor_receptors)
-        c_ed_t = self.TCell_bound_count * (self.tumor_receptors - self.tumor_bound_count) * p_ed_t / (self.TCell_receptors * self.tumor_receptors)
-
-        c_f = 1 - c_e_t - c_e_dt - c_ed_t
-        if c_f == 1:
-            return 0
+        return self.get_rate_constant(model_parameters) * state.Es.item(self.TCell_bound_count) * state.Ts.item(self.tumor_bound_count)
+
+    def get_rate_constant(self, model_parameters):
+        # Compiled parameters carry the rate constants of every pair of bound counts.
+        table = getattr(model_parameters, "formation_rate_constants", None)
+        if table is None:
+            return get_formation_rate_constants(model_parameters, self.TCell_bound_count, self.tumor_bound_count, 
+                                                self.TCell_receptors, self.tumor_receptors)[self.complex_type]
+        return table[self.TCell_bound_count][self.tumor_bound_count][self.complex_type]
 
-        return lambda_ET * (1 - c_f ** m) * state.Es[self.TCell_bound_count] * state.Ts[self.tumor_bound_count] * c_ed_t / (c_e_t + c_e_dt + c_ed_t)
+    def get_reads(self):
+        return {("Es", self.TCell_bound_count), ("Ts", self.tumor_bound_count)}
 
-    def implement(self, state):
+class ED_TFormation(ComplexFormation):
+    complex_type = 0
+
+    def implement(self, state, rng=None):
         state.Es[self.TCell_bound_count] = state.Es[self.TCell_bound_count] - 1
         state.Ts[self.tumor_bound_count] = state.Ts[self.tumor_bound_count] - 1
         state.EDTs[self.TCell_bound_count - 1][self.tumor_bound_count] = state.EDTs[self.TCell_bound_count - 1][self.tumor_bound_count] + 1
 
-class E_DTFormation(TIE):
-    def __init__(self, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
-        self.TCell_bound_count = TCell_bound_count
-        self.tumor_bound_count = tumor_bound_count
-        self.TCell_receptors = TCell_receptors
-        self.tumor_receptors = tumor_receptors
-
-    def get_max_rate(self, state, model_parameters):
-        p_e_t = model_parameters["p_E|T"]
-        p_ed_t = model_parameters["p_ED|T"]
-        p_e_dt = model_parameters["p_E|DT"]
-        lambda_ET = model_parameters["lambda_ET"]
-        m = model_parameters["M"]
-        c_e_t = (self.TCell_receptors - self.TCell_bound_count) * (self.tumor_receptors - self.tumor_bound_count) * p_e_t / (self.TCell_receptors * self.tumor_receptors)
-        c_e_dt = (self.TCell_receptors - self.TCell_bound_count) * self.tumor_bound_count * p_e_dt / (self.TCell_receptors * self.tumor_receptors)
-        c_ed_t = self.TCell_bound_count * (self.tumor_receptors - self.tumor_bound_count) * p_ed_t / (self.TCell_receptors * self.tumor_receptors)
+    def get_state_change(self):
+        return {("Es", self.TCell_bound_count): -1, ("Ts", self.tumor_bound_count): -1, ("EDTs", self.TCell_bound_count - 1, self.tumor_bound_count): 1}
 
-        c_f = 1 - c_e_t - c_e_dt - c_ed_t
+class E_DTFormation(ComplexFormation):
+    complex_type = 1
 
-        
-        if c_f == 1:
-            return 0
-        return lambda_ET * (1 - c_f ** m) * state.Es[self.TCell_bound_count] * state.Ts[self.tumor_bound_count] * c_e_dt / (c_e_t + c_e_dt + c_ed_t)
-
-    def implement(self, state):
+    def implement(self, state, rng=None):
         state.Es[self.TCell_bound_count] = state.Es[self.TCell_bound_count] - 1
         state.Ts[self.tumor_bound_count] = state.Ts[self.tumor_bound_count] - 1
         state.EDTs[self.TCell_bound_count][self.tumor_bound_count - 1] = state.EDTs[self.TCell_bound_count][self.tumor_bound_count - 1] + 1
 
-class E_TFormation(TIE):
-    def __init__(self, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
-        self.TCell_bound_count = TCell_bound_count
-        self.tumor_bound_count = tumor_bound_count
-        self.TCell_receptors = TCell_receptors
-        self.tumor_receptors = tumor_receptors
+    def get_state_change(self):
+        return {("Es", self.TCell_bound_count): -1, ("Ts", self.tumor_bound_count): -1, ("EDTs", self.TCell_bound_count, self.tumor_bound_count - 1): 1}
 
-    def get_max_rate(self, state, model_parameters):
-        p_e_t = model_parameters["p_E|T"]
-        p_ed_t = model_parameters["p_ED|T"]
-        p_e_dt = model_parameters["p_E|DT"]
-        lambda_ET = model_parameters["lambda_ET"]
-        m = model_parameters["M"]
-        c_e_t = (self.TCell_receptors - self.TCell_bound_count) * (self.tumor_receptors - self.tumor_bound_count) * p_e_t / (self.TCell_receptors * self.tumor_receptors)
-        c_e_dt = (self.TCell_receptors - self.TCell_bound_count) * self.tumor_bound_count * p_e_dt / (self.TCell_receptors * self.tumor_receptors)
-        c_ed_t = self.TCell_bound_count * (self.tumor_receptors - self.tumor_bound_count) * p_ed_t / (self.TCell_receptors * self.tumor_receptors)
+class E_TFormation(ComplexFormation):
+    complex_type = 2
 
-        c_f = 1 - c_e_t - c_e_dt - c_ed_t
-
-        
-        if c_f == 1:
-            return 0
-        return lambda_ET * (1 - c_f ** m) * state.Es[self.TCell_bound_count] * state.Ts[self.tumor_bound_count] * c_e_t / (c_e_t + c_e_dt + c_ed_t)
-
-    def implement(self, state):
+    def implement(self, state, rng=None):
         state.Es[self.TCell_bound_count] = state.Es[self.TCell_bound_count] - 1
         state.Ts[self.tumor_bound_count] = state.Ts[self.tumor_bound_count] - 1
         state.ETs[self.TCell_bound_count][self.tumor_bound_count] = state.ETs[self.TCell_bound_count][self.tumor_bound_count] + 1
 
-class TrimerDeath(TIE):
+    def get_state_change(self):
+        return {("Es", self.TCell_bound_count): -1, ("Ts", self.tumor_bound_count): -1, ("ETs", self.TCell_bound_count, self.tumor_bound_count): 1}
+
+class TrimerDeath(CSANEvent):
     def __init__(self, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
         self.TCell_bound_count = TCell_bound_count
         self.tumor_bound_count = tumor_bound_count
@@ -359,14 +757,23 @@ class TrimerDeath(TIE):
 
     def get_max_rate(self, state, model_parameters):
         d_EDT = model_parameters["d_EDT"]
-        return d_EDT * state.EDTs[self.TCell_bound_count][self.tumor_bound_count]
+        return d_EDT * state.EDTs.item(self.TCell_bound_count, self.tumor_bound_count)
     
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return model_parameters["d_EDT"]
+
+    def implement(self, state, rng=None):
         state.EDTs[self.TCell_bound_count][self.tumor_bound_count] = state.EDTs[self.TCell_bound_count][self.tumor_bound_count] - 1
         state.D = state.D + self.tumor_bound_count
         state.Es[self.TCell_bound_count + 1] = state.Es[self.TCell_bound_count + 1] + 1 
 
-class DimerDeath(TIE):
+    def get_reads(self):
+        return {("EDTs", self.TCell_bound_count, self.tumor_bound_count)}
+
+    def get_state_change(self):
+        return {("EDTs", self.TCell_bound_count, self.tumor_bound_count): -1, ("D",): self.tumor_bound_count, ("Es", self.TCell_bound_count + 1): 1}
+
+class DimerDeath(CSANEvent):
     def __init__(self, TCell_bound_count, tumor_bound_count, TCell_receptors, tumor_receptors):
         self.TCell_bound_count = TCell_bound_count
         self.tumor_bound_count = tumor_bound_count
@@ -375,10 +782,20 @@ class DimerDeath(TIE):
     
     def get_max_rate(self, state, model_parameters):
         d_ET = model_parameters["d_ET"]
-        return d_ET * state.ETs[self.TCell_bound_count][self.tumor_bound_count]
+        return d_ET * state.ETs.item(self.TCell_bound_count, self.tumor_bound_count)
     
-    def implement(self, state):
+    def get_rate_constant(self, model_parameters):
+        return model_parameters["d_ET"]
+
+    def implement(self, state, rng=None):
         state.ETs[self.TCell_bound_count][self.tumor_bound_count] = state.ETs[self.TCell_bound_count][self.tumor_bound_count] - 1
         state.D = state.D + self.tumor_bound_count
         state.Es[self.TCell_bound_count] = state.Es[self.TCell_bound_count] + 1 
 
+    def get_reads(self):
+        return {("ETs", self.TCell_bound_count, self.tumor_bound_count)}
+
+    def get_state_change(self):
+        return {("ETs", self.TCell_bound_count, self.tumor_bound_count): -1, ("D",): self.tumor_bound_count, ("Es", self.TCell_bound_count): 1}
+
+
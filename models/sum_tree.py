@@ -0,0 +1,57 @@
+class PropensityTree:
+    """
+    Complete binary tree whose leaves are event rates and whose internal nodes are sums of their children.
+
+    Changing one rate and sampling an event proportionally to its rate both take O(log n),
+    instead of the O(n) rebuild and linear scan of the direct method.
+    Parents are recomputed from their children rather than adjusted by differences,
+    so rounding errors do not accumulate over many updates.
+    """
+
+    def __init__(self, rates):
+        self._size = len(rates)
+        self._leaf_start = 1
+        while self._leaf_start < self._size:
+            self._leaf_start *= 2
+        self._nodes = [0.0] * (2 * self._leaf_start)
+        for index, rate in enumerate(rates):
+            self._nodes[self._leaf_start + index] = rate
+        for node in reversed(range(1, self._leaf_start)):
+            self._nodes[node] = self._nodes[2 * node] + self._nodes[2 * node + 1]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self._nodes[self._leaf_start + index]
+
+    @property
+    def total(self):
+        return self._nodes[1]
+
+    def update(self, index, rate):
+        """Sets the rate of the event at index."""
+        nodes = self._nodes
+        node = self._leaf_start + index
+        nodes[node] = rate
+        node //= 2
+        while node:
+            nodes[node] = nodes[2 * node] + nodes[2 * node + 1]
+            node //= 2
+
+    def sample(self, target):
+        """
+        Returns the index of the event whose cumulative rate interval contains target.
+        target should be drawn uniformly from [0, total).
+        """
+        nodes = self._nodes
+        node = 1
+        while node < self._leaf_start:
+            left = nodes[2 * node]
+            # Rounding can push target just past the left sum; never descend into an empty subtree.
+            if target < left or nodes[2 * node + 1] == 0:
+                node = 2 * node
+            else:
+                target -= left
+                node = 2 * node + 1
+        return node - self._leaf_start
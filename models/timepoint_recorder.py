@@ -0,0 +1,63 @@
+from copy import deepcopy
+
+import numpy as np
+
+
+class TimepointRecorder:
+    """
+    Records the states of a single pass of an engine at timepoints, as the simulation time crosses them.
+
+    Engines call record with the time of the next event before implementing it, which records the current
+    state at every timepoint before that time, and stop if it returns True. The state at a timepoint includes
+    the events at that exact time. Recording only costs the engines a comparison per step with next_time.
+
+    If get_state_from_array is given, states are copied into the rows of an array preallocated for every
+    timepoint and recorded as views of them. Otherwise they are deep copies.
+    on_record, if given, is called with the index of each timepoint and its state as it is recorded.
+    Once it returns True recording stops, and so does the engine.
+    stop stops the engine at its next step instead, for example from RunMetrics once a budget is exhausted.
+    """
+
+    def __init__(self, initial_state, timepoints, get_state_from_array=None, on_record=None):
+        if any(later < earlier for earlier, later in zip(timepoints, timepoints[1:])):
+            raise ValueError("Timepoints must not decrease")
+        self.timepoints = timepoints
+        self.on_record = on_record
+        self.states = []
+        self.stopped = False
+        self.stop_time = None
+        self.next_time = timepoints[0] if len(timepoints) > 0 else np.inf
+        self._get_state_from_array = get_state_from_array
+        self._array = None
+        if get_state_from_array is not None:
+            buffer = initial_state.export_to_array()
+            self._array = np.empty((len(timepoints),) + buffer.shape, dtype=buffer.dtype)
+
+    def record(self, state, time=np.inf):
+        """Records state at every timepoint before time that is not recorded yet. Returns whether recording stopped."""
+        if self.stopped:
+            if self.next_time == -np.inf:
+                self.stop_time = time
+                self.next_time = np.inf
+            return True
+        while self.next_time < time:
+            index = len(self.states)
+            if self._array is not None:
+                self._array[index] = state.export_to_array()
+                recorded_state = self._get_state_from_array(self._array[index])
+            else:
+                recorded_state = deepcopy(state)
+            self.states.append(recorded_state)
+            self.next_time = self.timepoints[index + 1] if index + 1 < len(self.timepoints) else np.inf
+            if self.on_record is not None and self.on_record(index, recorded_state):
+                self.stopped = True
+                self.next_time = np.inf
+        return self.stopped
+
+    def stop(self):
+        """
+        Stops recording, and the engine at its next step, when it calls record with the time of that step.
+        That time is kept in stop_time: the state the engine returns is its state at every time before it.
+        """
+        self.stopped = True
+        self.next_time = -np.inf
@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+
+from models.stochastic_csans import State
+
+
+class TrajectoryStore:
+    """
+    Columnar on-disk store of CSANModel simulation samples.
+
+    Samples live in a memory-mapped .npy file holding a (capacity x timepoints x dimension) int64 array,
+    where each state is in the State.export_to_list layout. A JSON sidecar next to it (same name, .json suffix)
+    holds the receptor counts, timepoints, parameters, any other metadata and how many samples have been written.
+    The file grows by doubling its capacity, so appending is amortized O(1) and the data never has to fit in RAM.
+
+    Create a store with TrajectoryStore.create and reopen it with TrajectoryStore(path).
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        with open(self._get_metadata_path(path)) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.e_receptors = self.metadata["e_receptors"]
+        self.t_receptors = self.metadata["t_receptors"]
+        self.timepoints = self.metadata["timepoints"]
+        self.writable = writable
+        self._data = np.load(path, mmap_mode="r+" if writable else "r")
+
+    @staticmethod
+    def create(path, e_receptors, t_receptors, timepoints, parameters=None, capacity=1024, **metadata):
+        """Creates an empty store at path, which should end in .npy, and returns it open for writing."""
+        shape = (capacity, len(timepoints), State.get_dimension(e_receptors, t_receptors))
+        data = np.lib.format.open_memmap(path, mode="w+", dtype=np.int64, shape=shape)
+        del data
+        metadata.update({
+            "e_receptors": e_receptors,
+            "t_receptors": t_receptors,
+            "timepoints": list(timepoints),
+            "parameters": parameters,
+            "sample_count": 0,
+        })
+        TrajectoryStore._write_metadata(path, metadata)
+        return TrajectoryStore(path, writable=True)
+
+    @property
+    def sample_count(self):
+        return self.metadata["sample_count"]
+
+    @property
+    def array(self):
+        """The (samples x timepoints x dimension) array of written samples. A memory map; nothing is loaded."""
+        return self._data[:self.sample_count]
+
+    def __len__(self):
+        return self.sample_count
+
+    def append(self, sample):
+        """
+        Appends one sample, either a timepoint data dictionary as produced by generate_simulation_data
+        or a (timepoints x dimension) array.
+        """
+        if not self.writable:
+            raise ValueError("Trajectory store was opened read-only")
+        if isinstance(sample, dict):
+            sample = [sample[time].export_to_array() for time in self.timepoints]
+        if self.sample_count == self._data.shape[0]:
+            self._grow()
+        self._data[self.sample_count] = sample
+        self.metadata["sample_count"] += 1
+
+    def extend(self, samples):
+        """Appends every sample of an iterable, such as Model.iterate_simulation_data, then flushes."""
+        for sample in samples:
+            self.append(sample)
+        self.flush()
+
+    def flush(self):
+        """Writes appended samples and the sample count to disk."""
+        self._data.flush()
+        self._write_metadata(self.path, self.metadata)
+
+    def get_state(self, sample_index, timepoint_index):
+        """Returns the state of a sample at a timepoint. The state is a view of the memory map."""
+        return State.from_array(self.array[sample_index, timepoint_index], self.e_receptors, self.t_receptors)
+
+    def get_sample(self, sample_index):
+        """Returns a sample as a timepoint data dictionary of views of the memory map."""
+        return {time: self.get_state(sample_index, timepoint_index)
+                for timepoint_index, time in enumerate(self.timepoints)}
+
+    def iterate_samples(self):
+        for sample_index in range(self.sample_count):
+            yield self.get_sample(sample_index)
+
+    def _grow(self):
+        old_data = self._data
+        shape = (2 * max(old_data.shape[0], 1),) + old_data.shape[1:]
+        temporary_path = self.path + ".growing"
+        new_data = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=old_data.dtype, shape=shape)
+        chunk = max(1, 2 ** 26 // max(1, old_data[0].nbytes))
+        for start in range(0, old_data.shape[0], chunk):
+            end = min(start + chunk, old_data.shape[0])
+            new_data[start:end] = old_data[start:end]
+        new_data.flush()
+        del new_data
+        del old_data
+        self._data = None
+        os.replace(temporary_path, self.path)
+        self._data = np.load(self.path, mmap_mode="r+")
+
+    @staticmethod
+    def _get_metadata_path(path):
+        root, _ = os.path.splitext(path)
+        return root + ".json"
+
+    @staticmethod
+    def _write_metadata(path, metadata):
+        temporary_path = TrajectoryStore._get_metadata_path(path) + ".tmp"
+        with open(temporary_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file, default=float)
+        os.replace(temporary_path, TrajectoryStore._get_metadata_path(path))
@@ -0,0 +1,43 @@
+from models.stochastic_csans import CSANModel
+from models.abc_smc import ABCSMC
+from models.fitting import read_data_table
+from constants import SIMPLE_D41_PARAMETERS
+
+
+model = CSANModel(4, 8)
+param_names = list(SIMPLE_D41_PARAMETERS.keys())
+timepoints, columns = read_data_table("data/Normalized D41.csv")
+initial_T = 100
+
+
+def get_conditions():
+    """The conditions of the first eight columns: tumor cells alone, with T cells, then decreasing doses."""
+    conditions = []
+    for sim_index, column in enumerate(list(columns.values())[:8]):
+        initial_state = model.get_empty_state()
+        initial_state.Ts[0] = initial_T
+        if sim_index != 0:
+            initial_state.Es[0] = 300
+        if sim_index >= 2:
+            initial_state.D = 4**(8 - sim_index) * 20
+        conditions.append((initial_state, column))
+    return conditions
+
+def get_normalized_T(state):
+    return state.T() / initial_T
+
+def get_param_dict(param_list):
+    return {name: param for name, param in zip(param_names, param_list)}
+
+def get_param_list(param_dict):
+    return [param_dict[name] for name in param_names]
+
+if __name__ == "__main__":
+    bounds = [(0, guess * 2) for guess in get_param_list(SIMPLE_D41_PARAMETERS)]
+    with ABCSMC(model, get_conditions(), timepoints, get_normalized_T, bounds, get_parameters=get_param_dict,
+                particle_count=200, workers=8, seed=41) as abc:
+        result = abc.run(generation_count=6)
+    for generation in result["generations"]:
+        print(generation)
+    posterior_mean = result["weights"] @ result["particles"]
+    print(get_param_dict(posterior_mean))
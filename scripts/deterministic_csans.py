@@ -1,22 +1,25 @@
-from model import Model
-from itertools import product
+from models.model import Model
 from scipy.special import binom
-from scipy.integrate import odeint
+from scipy.integrate import odeint, solve_ivp
+from scipy.sparse import block_diag, csr_matrix
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from constants import ZEROS
 from copy import copy
 
+import numpy as np
+
 class CSANDetModel(Model):
+    # Above this dimension run defaults to BDF with the sparse Jacobian, since odeint needs it as a dense matrix,
+    # of dimension ** 2 floats: about 290 MB here and 3.3 GB at 100 x 100 receptors.
+    dense_jacobian_max_dimension = 6000
     
     def __init__(self, e_receptors, t_receptors):
         self.e_receptors = e_receptors
         self.t_receptors = t_receptors
         self.dimension = 3 + e_receptors + t_receptors + 2 * e_receptors * t_receptors
-
-    def run(self, parameters, initial_state, timepoints):
-        f = lambda state, t: self.derivative(state, parameters)
-        result = odeint(f, initial_state, timepoints)
-        return result
-
+        self._tables_parameters = None
+        self._derivative_tables = None
 
     def _get_d_index(self):
         return 0
@@ -67,218 +70,195 @@ class CSANDetModel(Model):
         return (1 - e_bound / self.e_receptors) * (1 - t_bound / self.t_receptors) * parameters["p_E|T"]
         
     def get_derivative(self, state, parameters):
-        derivative = [0] * self.dimension
-
-        # get CSANs derivative
-        csans_change = 0
-        
-        # bindings to effectors
-        for i in range(self.e_receptors + 1):
-            index = self._get_e_index(i)
-            csans_change -= parameters["lambda_E"] * state[index] * (self.e_receptors - i) * state[self._get_d_index()]
-        
-        # bindings to tumors
-        for i in range(self.t_receptors + 1):
-            index = self._get_t_index(i)
-            csans_change -= parameters["lambda_T"] * state[index] * (self.t_receptors - i) * state[self._get_d_index()]
-        
-        # tumor cells dying
-        for i, j in product(range(self.e_receptors), range(self.t_receptors)):
-            index = self._get_et_index(i, j)
-            csans_change += parameters["d_ET"] * state[index] * j
-            index = self._get_edt_index(i, j)
-            csans_change += parameters["d_EDT"] * state[index] * j
-        
-        # effector cells dying
-        for i in range(self.e_receptors + 1):
-            index = self._get_e_index(i)
-            csans_change += parameters["d_E"] * state[index] * i
-
-        # ET killings
-        for i, j in product(range(self.e_receptors), range(self.t_receptors)):
-            index = self._get_et_index(i, j)
-            csans_change += parameters["d_ET"] * state[index] * j
-
-        ## EDT killings
-        for i, j in product(range(self.e_receptors), range(self.t_receptors)):
-            index = self._get_edt_index(i, j)
-            csans_change += parameters["d_EDT"] * state[index] * j
-
-        derivative[0] = csans_change
-
-
-        # get Es derivatives
-        for i in range(self.e_receptors + 1):
-            e_change = 0
-            
-            # incoming births
-            for j in range(self.e_receptors + 1):
-                index = self._get_e_index(j)
-                e_change += 2 * parameters["b_E"] * binom(j, i) / (2 ** j) * state[index]
-            
-            # outgoing births
-            index = self._get_e_index(i)
-            e_change -= parameters["b_E"] * state[index]
-            
-            # deaths
-            e_change -= parameters["d_E"] * state[index]
-
-            # incoming dimer kills
-            for j in range(self.t_receptors):
-                if i == self.e_receptors:
-                    continue
-                index = self._get_et_index(i, j)
-                e_change += state[index] * parameters["d_ET"]
-                    
-            for j in range(self.t_receptors):
-                if i == 0:
-                    continue
-                index = self._get_edt_index(i - 1, j)
-                e_change += state[index] * parameters["d_EDT"]
-
-            # incoming csan bindings
-            if i != 0:
-                index = self._get_e_index(i - 1)
-                e_change += state[self._get_d_index()] * state[index] * (self.e_receptors - i + 1) * parameters["lambda_E"]
-                
-
-            # outgoing csan bindings
-            if i != self.e_receptors:
-                index = self._get_e_index(i)
-                e_change -= state[self._get_d_index()] * state[index] * (self.e_receptors - i) * parameters["lambda_E"]
-
-            # incoming csan absorbtions
-            pass
-            # outgoing csan absorbtions
-            pass
-            # dimer/trimer formation
-            for j in range(self.t_receptors + 1):
-                t_index = self._get_t_index(j)
-                e_index = self._get_e_index(i)
-                
-                e_bound_pro = i / self.e_receptors
-                t_bound_pro = j / self.t_receptors
-                success_prob = (1 - e_bound_pro) * (1 - t_bound_pro) * parameters["p_E|T"] + \
-                    (e_bound_pro) * (1 - t_bound_pro) * parameters["p_ED|T"] + \
-                    (1 - e_bound_pro) * (t_bound_pro) * parameters["p_E|DT"]
-                total_prob = 1 - (1 - success_prob) ** parameters["M"]
-                
-                e_change -= state[t_index] * state[e_index] * parameters["lambda_ET"] * total_prob 
-
-            # put change in derivative
-            index = self._get_e_index(i)
-            derivative[index] = e_change
-
-
-        # get Ts derivatives
-        for i in range(self.t_receptors + 1):
-            t_change = 0
-
-            # incoming births
-            for j in range(self.t_receptors + 1):
-                index = self._get_t_index(j)
-                t_change += 2 * parameters["b_T"] * binom(j, i) / (2 ** j) * state[index]
-            
-            # outgoing births
-            index = self._get_t_index(i)
-            t_change -= parameters["b_T"] * state[index]
-
-            # deaths
-            t_change -= parameters["d_T"] * state[index]
-
-            # incoming csan bindings
-            if i != 0:
-                index = self._get_t_index(i - 1)
-                t_change += state[index] * parameters["lambda_T"] * (self.t_receptors - i + 1) * state[self._get_d_index()]
-
-            # outgoing csan bindings
-            if i != self.t_receptors:
-                index = self._get_t_index(i)
-                t_change -= state[index] * parameters["lambda_T"] * (self.t_receptors - i) * state[self._get_d_index()]
-
-            # incoming csan absorbtions
-            pass
-
-
-            # outgoing csan absorbtions
-            pass
-
-            # dimer/trimer formation
-            for j in range(self.e_receptors + 1):
-                t_index = self._get_t_index(i)
-                e_index = self._get_e_index(j)
-                
-                e_bound_pro = i / self.e_receptors
-                t_bound_pro = j / self.t_receptors
-                success_prob = (1 - e_bound_pro) * (1 - t_bound_pro) * parameters["p_E|T"] + \
-                    (e_bound_pro) * (1 - t_bound_pro) * parameters["p_ED|T"] + \
-                    (1 - e_bound_pro) * (t_bound_pro) * parameters["p_E|DT"]
-                total_prob = 1 - (1 - success_prob) ** parameters["M"]
-                
-                t_change -= state[t_index] * state[e_index] * parameters["lambda_ET"] * total_prob 
-
-            index = self._get_t_index(i)
-            derivative[index] = t_change
-
-        # get ETs derivatives
-        for i, j in product(range(self.e_receptors), range(self.t_receptors)):
-            et_change = 0
-            
-            # E|T formation
-            e_index = self._get_e_index(i)
-            t_index = self._get_t_index(j)
-            single_ET = self._single_success_prob(i, j, parameters, False, False)
-            single_ED_T = self._single_success_prob(i, j, parameters, True, False)
-            single_E_DT = self._single_success_prob(i, j, parameters, False, True)
+        """
+        Returns the derivative of state as a list. 
+        Every term is a matrix-vector or outer product with tables that are computed once per parameter set.
+        """
+        return self._evaluate_derivative(state, parameters, self._get_derivative_tables(parameters)).tolist()
+
+    def _evaluate_derivative(self, state, parameters, tables):
+        e = self.e_receptors
+        t = self.t_receptors
+        state = np.asarray(state, dtype=float)
+        d = state[0]
+        es = state[1:e + 2]
+        ts = state[e + 2:e + t + 3]
+        ets = state[e + t + 3:e + t + 3 + e * t].reshape(e, t)
+        edts = state[e + t + 3 + e * t:].reshape(e, t)
+
+        e_bindings = d * es * tables["e_binding_rates"]
+        t_bindings = d * ts * tables["t_binding_rates"]
+        et_killings = parameters["d_ET"] * ets
+        edt_killings = parameters["d_EDT"] * edts
+        # CSANs released by tumor cell deaths and by killings, which are the same events.
+        released_csans = et_killings.sum(axis=0) @ tables["t_bound"] + edt_killings.sum(axis=0) @ tables["t_bound"]
+
+        d_change = -e_bindings.sum() - t_bindings.sum() + 2 * released_csans + parameters["d_E"] * (tables["e_bound"] @ es)
+
+        e_change = tables["e_births"] @ es - e_bindings
+        e_change[1:] += e_bindings[:-1]
+        e_change[:-1] += et_killings.sum(axis=1)
+        e_change[1:] += edt_killings.sum(axis=1)
+        e_change -= es * (tables["e_formation_probabilities"] @ ts) * parameters["lambda_ET"]
+
+        t_change = tables["t_births"] @ ts - t_bindings
+        t_change[1:] += t_bindings[:-1]
+        t_change -= ts * (tables["t_formation_probabilities"] @ es) * parameters["lambda_ET"]
+
+        et_change = tables["et_formations"] * np.outer(es[:-1], ts[:-1]) - et_killings
+        edt_change = (tables["ed_t_formations"] * np.outer(es[1:], ts[:-1]) 
+                      + tables["e_dt_formations"] * np.outer(es[:-1], ts[1:]) - edt_killings)
+
+        return np.concatenate([[d_change], e_change, t_change, et_change.ravel(), edt_change.ravel()])
+
+    def get_jacobian(self, state, parameters):
+        """
+        Returns the Jacobian of get_derivative at state as a sparse matrix.
+        The derivative is a constant linear part plus products of two entries of the state
+        (bindings of D to cells and formation of complexes), so the Jacobian is exact.
+        """
+        return self._evaluate_jacobian(state, self._get_jacobian_terms(parameters))
+
+    def get_jacobian_sparsity(self, parameters):
+        """Returns the sparsity pattern of get_jacobian as a sparse boolean matrix."""
+        linear_part, rows, first_factors, second_factors, _ = self._get_jacobian_terms(parameters)
+        pattern = linear_part != 0
+        entries = np.ones(2 * len(rows), dtype=bool)
+        bilinear_pattern = csr_matrix((entries, (np.concatenate([rows, rows]), np.concatenate([first_factors, second_factors]))),
+                                      shape=linear_part.shape, dtype=bool)
+        return pattern + bilinear_pattern
+
+    def _evaluate_jacobian(self, state, jacobian_terms):
+        linear_part, rows, first_factors, second_factors, coefficients = jacobian_terms
+        state = np.asarray(state, dtype=float)
+        # d/dx_p (c x_p x_q) = c x_q and d/dx_q (c x_p x_q) = c x_p.
+        bilinear_part = csr_matrix((np.concatenate([coefficients * state[second_factors], coefficients * state[first_factors]]),
+                                    (np.concatenate([rows, rows]), np.concatenate([first_factors, second_factors]))),
+                                   shape=linear_part.shape)
+        return linear_part + bilinear_part
+
+    def _get_jacobian_terms(self, parameters):
+        """
+        Returns the derivative as a sparse linear part A and bilinear terms, so that
+        derivative[rows[k]] includes coefficients[k] * state[first_factors[k]] * state[second_factors[k]].
+        Cached with the derivative tables.
+        """
+        tables = self._get_derivative_tables(parameters)
+        if "jacobian_terms" in tables:
+            return tables["jacobian_terms"]
+        e = self.e_receptors
+        t = self.t_receptors
+        e_indices = 1 + np.arange(e + 1)
+        t_indices = e + 2 + np.arange(t + 1)
+        et_indices = (e + t + 3 + np.arange(e * t)).reshape(e, t)
+        edt_indices = et_indices + e * t
+        d_index = np.zeros(1, dtype=int)
+        i_grid, j_grid = np.meshgrid(np.arange(e), np.arange(t), indexing="ij")
+
+        linear_terms = []
+        # Births and deaths.
+        linear_terms.append((e_indices[:, None], e_indices[None, :], tables["e_births"]))
+        linear_terms.append((t_indices[:, None], t_indices[None, :], tables["t_births"]))
+        # CSANs released by deaths and killings.
+        linear_terms.append((d_index, e_indices, parameters["d_E"] * tables["e_bound"]))
+        linear_terms.append((d_index, et_indices, 2 * parameters["d_ET"] * j_grid))
+        linear_terms.append((d_index, edt_indices, 2 * parameters["d_EDT"] * j_grid))
+        # Killings free the TCell and remove the complex.
+        linear_terms.append((e_indices[i_grid], et_indices, parameters["d_ET"]))
+        linear_terms.append((e_indices[i_grid + 1], edt_indices, parameters["d_EDT"]))
+        linear_terms.append((et_indices, et_indices, -parameters["d_ET"]))
+        linear_terms.append((edt_indices, edt_indices, -parameters["d_EDT"]))
+
+        bilinear_terms = []
+        # Bindings of D to cells with a free receptor.
+        for indices, binding_rates in ((e_indices, tables["e_binding_rates"]), (t_indices, tables["t_binding_rates"])):
+            bilinear_terms.append((d_index, d_index, indices, -binding_rates))
+            bilinear_terms.append((indices, d_index, indices, -binding_rates))
+            bilinear_terms.append((indices[1:], d_index, indices[:-1], binding_rates[:-1]))
+        # Formation losses and the complexes they form.
+        bilinear_terms.append((e_indices[:, None], e_indices[:, None], t_indices[None, :], 
+                               -parameters["lambda_ET"] * tables["e_formation_probabilities"]))
+        bilinear_terms.append((t_indices[:, None], t_indices[:, None], e_indices[None, :], 
+                               -parameters["lambda_ET"] * tables["t_formation_probabilities"]))
+        bilinear_terms.append((et_indices, e_indices[i_grid], t_indices[j_grid], tables["et_formations"]))
+        bilinear_terms.append((edt_indices, e_indices[i_grid + 1], t_indices[j_grid], tables["ed_t_formations"]))
+        bilinear_terms.append((edt_indices, e_indices[i_grid], t_indices[j_grid + 1], tables["e_dt_formations"]))
+
+        rows, columns, values = [], [], []
+        for term_rows, term_columns, term_values in linear_terms:
+            term_rows, term_columns, term_values = np.broadcast_arrays(term_rows, term_columns, term_values)
+            rows.append(term_rows.ravel())
+            columns.append(term_columns.ravel())
+            values.append(term_values.ravel().astype(float))
+        values = np.concatenate(values)
+        nonzero = values != 0
+        linear_part = csr_matrix((values[nonzero], (np.concatenate(rows)[nonzero], np.concatenate(columns)[nonzero])), 
+                                 shape=(self.dimension, self.dimension))
+
+        rows, first_factors, second_factors, coefficients = [], [], [], []
+        for term in bilinear_terms:
+            term_rows, term_first_factors, term_second_factors, term_coefficients = np.broadcast_arrays(*term)
+            rows.append(term_rows.ravel())
+            first_factors.append(term_first_factors.ravel())
+            second_factors.append(term_second_factors.ravel())
+            coefficients.append(term_coefficients.ravel().astype(float))
+        coefficients = np.concatenate(coefficients)
+        nonzero = coefficients != 0
+        tables["jacobian_terms"] = (linear_part, np.concatenate(rows)[nonzero], np.concatenate(first_factors)[nonzero], 
+                                    np.concatenate(second_factors)[nonzero], coefficients[nonzero])
+        return tables["jacobian_terms"]
+
+    def _get_derivative_tables(self, parameters):
+        """
+        Returns the parameter dependent tables of get_derivative. 
+        They are cached until the parameters change.
+        """
+        if self._tables_parameters is not None and self._tables_parameters == parameters:
+            return self._derivative_tables
+        e = self.e_receptors
+        t = self.t_receptors
+        e_bound = np.arange(e + 1)
+        t_bound = np.arange(t + 1)
+
+        # Entry (i, j) is the rate at which cells with j bound CSANs give birth to cells with i bound CSANs.
+        e_births = 2 * parameters["b_E"] * binom(e_bound[None, :], e_bound[:, None]) / 2.0 ** e_bound[None, :]
+        e_births -= np.diag(np.full(e + 1, parameters["b_E"] + parameters["d_E"]))
+        t_births = 2 * parameters["b_T"] * binom(t_bound[None, :], t_bound[:, None]) / 2.0 ** t_bound[None, :]
+        t_births -= np.diag(np.full(t + 1, parameters["b_T"] + parameters["d_T"]))
+
+        def get_formation_probabilities(e_bound_proportions, t_bound_proportions):
+            success_probabilities = (1 - e_bound_proportions) * (1 - t_bound_proportions) * parameters["p_E|T"] + \
+                e_bound_proportions * (1 - t_bound_proportions) * parameters["p_ED|T"] + \
+                (1 - e_bound_proportions) * t_bound_proportions * parameters["p_E|DT"]
+            return 1 - (1 - success_probabilities) ** parameters["M"]
+
+        def get_complex_formations(e_bound_counts, t_bound_counts, complex_type):
+            single_ET = self._single_success_prob(e_bound_counts, t_bound_counts, parameters, False, False)
+            single_ED_T = self._single_success_prob(e_bound_counts, t_bound_counts, parameters, True, False)
+            single_E_DT = self._single_success_prob(e_bound_counts, t_bound_counts, parameters, False, True)
             single = single_ET + single_E_DT + single_ED_T
-            if single_ET != 0:
-                et_change += parameters["lambda_ET"] * (1 - (1 - single) ** parameters["M"]) * state[e_index] * state[t_index] * single_ET / single
-
-            # ET killing
-            index = self._get_et_index(i, j)
-            et_change -= state[index] * parameters["d_ET"]
-            
-
-            index = self._get_et_index(i, j)
-            derivative[index] = et_change
-
-
-        # get EDTs derivatives 
-        for i, j in product(range(self.e_receptors), range(self.t_receptors)):
-            edt_change = 0
-            # ED|T formation
-            e_index = self._get_e_index(i + 1)
-            t_index = self._get_t_index(j)
-            single_ET = self._single_success_prob(i + 1, j, parameters, False, False)
-            single_ED_T = self._single_success_prob(i + 1, j, parameters, True, False)
-            single_E_DT = self._single_success_prob(i + 1, j, parameters, False, True)
-            single = single_ET + single_E_DT + single_ED_T
-            if single_ED_T != 0:
-                edt_change += parameters["lambda_ET"] * (1 - (1 - single) ** parameters["M"]) * state[e_index] * state[t_index] * single_ED_T / single
-            
-            # E|DT formation
-            e_index = self._get_e_index(i)
-            t_index = self._get_t_index(j + 1)
-            single_ET = self._single_success_prob(i, j + 1, parameters, False, False)
-            single_ED_T = self._single_success_prob(i, j + 1, parameters, True, False)
-            single_E_DT = self._single_success_prob(i, j + 1, parameters, False, True)
-            single = single_ET + single_E_DT + single_ED_T
-            if single_E_DT != 0:
-                edt_change += parameters["lambda_ET"] * (1 - (1 - single) ** parameters["M"]) * state[e_index] * state[t_index] * single_E_DT / single
-
-            index = self._get_edt_index(i, j)
-            derivative[index] = edt_change
-            
-            # EDT killing
-            index = self._get_edt_index(i, j)
-            edt_change -= state[index] * parameters["d_EDT"]
-            
-
-            index = self._get_edt_index(i, j)
-            derivative[index] = edt_change
-
-
-        return derivative
+            single_complex = {"ET": single_ET, "ED_T": single_ED_T, "E_DT": single_E_DT}[complex_type]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                formations = parameters["lambda_ET"] * (1 - (1 - single) ** parameters["M"]) * single_complex / single
+            return np.where(single_complex != 0, formations, 0)
+
+        e_grid, t_grid = np.meshgrid(np.arange(e), np.arange(t), indexing="ij")
+        self._derivative_tables = {
+            "e_bound": e_bound,
+            "t_bound": np.arange(t),
+            "e_binding_rates": parameters["lambda_E"] * (e - e_bound),
+            "t_binding_rates": parameters["lambda_T"] * (t - t_bound),
+            "e_births": e_births,
+            "t_births": t_births,
+            "e_formation_probabilities": get_formation_probabilities(e_bound[:, None] / e, t_bound[None, :] / t),
+            # The tumor cell loop takes its own bound count as the proportion of TCell receptors and vice versa.
+            "t_formation_probabilities": get_formation_probabilities(t_bound[:, None] / e, e_bound[None, :] / t),
+            "et_formations": get_complex_formations(e_grid, t_grid, "ET"),
+            "ed_t_formations": get_complex_formations(e_grid + 1, t_grid, "ED_T"),
+            "e_dt_formations": get_complex_formations(e_grid, t_grid + 1, "E_DT"),
+        }
+        self._tables_parameters = dict(parameters)
+        return self._derivative_tables
     
     def get_initial_state(self, d, e, t):
         state = [0] * (self.e_receptors + self.t_receptors + 2 * self.e_receptors * self.t_receptors + 3)
@@ -287,10 +267,134 @@ class CSANDetModel(Model):
         state[self._get_t_index(0)] = t
         return state
 
-    def run(self, parameters, initial_state, timepoints):
-        f = lambda x, t: self.get_derivative(x, parameters)
-        result = odeint(f, initial_state, timepoints)
-        return result
+    def run(self, parameters, initial_state, timepoints, method=None, rtol=None, atol=None):
+        """
+        Returns the states at timepoints, one row per timepoint, starting from initial_state at timepoints[0].
+
+        method "odeint" uses odeint (LSODA) with the analytic Jacobian as a dense matrix.
+        "BDF", "Radau" and "LSODA" use solve_ivp with the analytic Jacobian, see solve.
+        By default it is "odeint", which is the fastest while the system has at most dense_jacobian_max_dimension
+        entries (at 30 x 30 receptors 0.07 s against 0.38 s for BDF), and "BDF" with the sparse Jacobian above that.
+        rtol and atol are the tolerances of the solver, which has its own defaults when they are None.
+        Those of solve_ivp (rtol 1e-3) are much looser than those of odeint (about 1.5e-8).
+        """
+        if method is None:
+            method = "odeint" if self.dimension <= self.dense_jacobian_max_dimension else "BDF"
+        tolerances = {name: value for name, value in (("rtol", rtol), ("atol", atol)) if value is not None}
+        if method == "odeint":
+            tables = self._get_derivative_tables(parameters)
+            jacobian_terms = self._get_jacobian_terms(parameters)
+            f = lambda x, t: self._evaluate_derivative(x, parameters, tables)
+            jacobian = lambda x, t: self._evaluate_jacobian(x, jacobian_terms).toarray()
+            return odeint(f, initial_state, timepoints, Dfun=jacobian, **tolerances)
+        solution = self.solve(parameters, initial_state, timepoints[-1] - timepoints[0], method=method, 
+                              start_time=timepoints[0], **tolerances)
+        return solution.sol(timepoints).T
+
+    def solve(self, parameters, initial_state, duration, method="BDF", start_time=0, **options):
+        """
+        Integrates from initial_state at start_time for duration with solve_ivp and returns its result.
+        Its sol attribute is the dense output: a function from times, or an array of times, to states,
+        so states at any timepoints are cheap once solved.
+
+        method is a solve_ivp method. The implicit "BDF" and "Radau" use the sparse Jacobian 
+        and suit the stiff systems of fast complex killings and slow bindings. "LSODA" uses it as a dense matrix.
+        Other keyword arguments, such as rtol and atol, are passed to solve_ivp.
+        """
+        tables = self._get_derivative_tables(parameters)
+        jacobian_terms = self._get_jacobian_terms(parameters)
+        f = lambda t, x: self._evaluate_derivative(x, parameters, tables)
+        if method == "LSODA":
+            jacobian = lambda t, x: self._evaluate_jacobian(x, jacobian_terms).toarray()
+        else:
+            jacobian = lambda t, x: self._evaluate_jacobian(x, jacobian_terms)
+        solution = solve_ivp(f, (start_time, start_time + duration), np.asarray(initial_state, dtype=float), 
+                             method=method, jac=jacobian, dense_output=True, **options)
+        if not solution.success:
+            raise RuntimeError(f"Deterministic CSAN model could not be solved: {solution.message}")
+        return solution
+
+    def run_batch(self, parameters, initial_states, timepoints, method=None, rtol=None, atol=None, 
+                  workers=None, executor=None, stacked=False):
+        """
+        Returns the states at timepoints of K systems as a (K x timepoints x dimension) array.
+        parameters is a parameter dictionary or a list of K of them, and initial_states an initial state 
+        or a list of K of them, so that dose sweeps share one parameter set and parameter sweeps one initial state.
+
+        Each system is integrated by run with method, in parallel over workers processes or an executor if given.
+        With stacked=True the K systems are instead integrated together by solve_batch, with method "BDF" by default.
+        Stacking is slower for dose sweeps: at 20 x 20 receptors and 7 doses, odeint takes 0.31 s for all of them,
+        stacked BDF 0.88 s with its default rtol and 2.5 s with rtol=1e-8, which matches odeint's accuracy.
+        """
+        parameter_list, initial_state_list = self._broadcast_batch(parameters, initial_states)
+        if stacked:
+            solution = self.solve_batch(parameter_list, initial_state_list, timepoints[-1] - timepoints[0], 
+                                        method="BDF" if method is None else method, start_time=timepoints[0], 
+                                        **{name: value for name, value in (("rtol", rtol), ("atol", atol)) if value is not None})
+            states = solution.sol(timepoints).T
+            return states.reshape(len(timepoints), len(parameter_list), self.dimension).transpose(1, 0, 2)
+
+        run = partial(self._run_batch_item, timepoints=timepoints, method=method, rtol=rtol, atol=atol)
+        if executor is not None:
+            return np.array(list(executor.map(run, parameter_list, initial_state_list)))
+        if workers is None or workers <= 1:
+            return np.array(list(map(run, parameter_list, initial_state_list)))
+        with ProcessPoolExecutor(max_workers=workers) as process_pool:
+            return np.array(list(process_pool.map(run, parameter_list, initial_state_list)))
+
+    def solve_batch(self, parameters, initial_states, duration, method="BDF", start_time=0, **options):
+        """
+        Integrates K systems, given by lists of parameters and initial states, as one stacked system 
+        with solve_ivp and returns its result, as in solve. The state of the stacked system is the K states one after another.
+        Its Jacobian is block diagonal and passed as a sparse matrix, so the implicit methods "BDF" and "Radau"
+        factorize the whole stacked Jacobian with a sparse LU decomposition, which stays as cheap as the blocks.
+        All K systems share one adaptive step size, so the stiffest or fastest changing of them sets it for every other.
+        "LSODA" is refused, since it would need the stacked Jacobian as a dense matrix.
+        """
+        if method == "LSODA":
+            raise ValueError("Stacked systems cannot be solved with LSODA, which needs a dense Jacobian. Use BDF or Radau")
+        parameter_list, initial_state_list = self._broadcast_batch(parameters, initial_states)
+        # Tables are computed in turn, so fetch each set's tables and Jacobian terms together.
+        blocks = []
+        for block_parameters in parameter_list:
+            tables = self._get_derivative_tables(block_parameters)
+            blocks.append((block_parameters, tables, self._get_jacobian_terms(block_parameters)))
+        dimension = self.dimension
+
+        def f(t, x):
+            return np.concatenate([self._evaluate_derivative(x[k * dimension:(k + 1) * dimension], block_parameters, tables)
+                                   for k, (block_parameters, tables, _) in enumerate(blocks)])
+
+        def jacobian(t, x):
+            block_jacobians = [self._evaluate_jacobian(x[k * dimension:(k + 1) * dimension], jacobian_terms)
+                               for k, (_, _, jacobian_terms) in enumerate(blocks)]
+            return block_diag(block_jacobians, format="csc")
+
+        initial_state = np.concatenate([np.asarray(state, dtype=float) for state in initial_state_list])
+        solution = solve_ivp(f, (start_time, start_time + duration), initial_state, method=method, jac=jacobian, 
+                             dense_output=True, **options)
+        if not solution.success:
+            raise RuntimeError(f"Deterministic CSAN model could not be solved: {solution.message}")
+        return solution
+
+    def _run_batch_item(self, parameters, initial_state, timepoints, method, rtol, atol):
+        return self.run(parameters, initial_state, timepoints, method=method, rtol=rtol, atol=atol)
+
+    @staticmethod
+    def _broadcast_batch(parameters, initial_states):
+        """Returns lists of K parameter sets and K initial states from a single one or a list of each."""
+        parameter_list = [parameters] if isinstance(parameters, dict) else list(parameters)
+        initial_state_list = list(initial_states)
+        if not isinstance(initial_state_list[0], (list, tuple, np.ndarray)):
+            initial_state_list = [initial_state_list]
+        count = max(len(parameter_list), len(initial_state_list))
+        if len(parameter_list) == 1:
+            parameter_list = parameter_list * count
+        if len(initial_state_list) == 1:
+            initial_state_list = initial_state_list * count
+        if len(parameter_list) != count or len(initial_state_list) != count:
+            raise ValueError("parameters and initial_states must have the same length, or one of them a single entry")
+        return parameter_list, initial_state_list
 
     def _d(self, state):
         return state[0]
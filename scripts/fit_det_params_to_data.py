@@ -22,9 +22,10 @@ print(initial_doses)
 
 fig, ax = plt.subplots()
 
-for dose in initial_doses:
-    initial_state = model.get_initial_state(dose, 30000, 10000)
-    res = model.run(parameters, initial_state, timepoints)
+initial_states = [model.get_initial_state(dose, 30000, 10000) for dose in initial_doses]
+results = model.run_batch(parameters, initial_states, timepoints)
+
+for dose, res in zip(initial_doses, results):
     d_res = [float(model._d(timepoint)) for timepoint in res]
     e_res = [float(sum(model._e(timepoint))) for timepoint in res]
     t_res = [float(sum(model._t(timepoint))) for timepoint in res]
@@ -1,7 +1,10 @@
 from models.stochastic_csans import CSANModel
+from models.fitting import BayesianOptimizer, GaussianProcessSurrogate, SimulationObjective
 from scipy import optimize
 from constants import SIMPLE_D41_PARAMETERS
 import csv
+import os
+import sys
 
 
 model = CSANModel(4, 8)
@@ -18,10 +21,8 @@ with open('data/D41_Ave.csv', newline='', ) as csvfile:
 def fit_to_data(data, guess, initial_condition):
     pass
 
-def _sample_error(parameters, data):
-    parameters = get_param_dict(parameters)
-    print(parameters)
-    error = 0
+def get_conditions(data):
+    conditions = []
     for sim_index in range(8):
         initial_state = model.get_empty_state()
         initial_state.Ts[0] = 100
@@ -29,15 +30,11 @@ def _sample_error(parameters, data):
             initial_state.Es[0] = 300
         if sim_index >= 2:
             initial_state.D = 4**(8 - sim_index) * 20
-        
-        sample = model.generate_simulation_data(parameters, initial_state, timepoints)["data"][0]
-        real_data = [data[i][sim_index] for i in range(8)]
-        normalized_sample = [sample[timepoint].T() / 1000 for timepoint in timepoints]
+        conditions.append((initial_state, [data[i][sim_index] for i in range(8)]))
+    return conditions
 
-        for real_point, sample_point in zip(real_data, normalized_sample):
-            error += (real_point - sample_point) ** 2
-    print(error)
-    return error
+def get_normalized_T(state):
+    return state.T() / 1000
 
 def get_param_dict(param_list):
     return {name: param for name, param in zip(param_names, param_list)}
@@ -46,12 +43,23 @@ def get_param_list(param_dict):
     return [param_dict[name] for name in param_names]
 
 if __name__ == "__main__":
-    initial_state = model.get_empty_state()
-    
     initial_guess = get_param_list(SIMPLE_D41_PARAMETERS)
     bounds = [(0, guess * 2) for guess in initial_guess]
-    opt_res = optimize.minimize(_sample_error, initial_guess, args=data, bounds=bounds)
+    with SimulationObjective(model, get_conditions(data), timepoints, get_normalized_T, get_parameters=get_param_dict,
+                             replicate_count=4, seed=41, workers=8, verbose=True) as objective:
+        if "--surrogate" in sys.argv[1:]:
+            # Only points chosen by Bayesian optimization are simulated. The surrogate is saved after
+            # every run and picked up by the next, so fits can be continued.
+            surrogate_path = "data/D41_surrogate.npz"
+            if os.path.exists(surrogate_path):
+                surrogate = GaussianProcessSurrogate.load(surrogate_path)
+            else:
+                surrogate = GaussianProcessSurrogate(bounds)
+            optimizer = BayesianOptimizer(objective, bounds, surrogate=surrogate, batch_size=8, seed=41)
+            opt_res = optimizer.minimize(iteration_count=20, initial_points=[initial_guess] if len(surrogate.values) == 0 else None)
+            surrogate.save(surrogate_path)
+            opt_res.x = get_param_dict(opt_res.x)
+        else:
+            # Common random numbers keep the objective smooth enough for the gradient estimates of minimize.
+            opt_res = optimize.minimize(objective, initial_guess, bounds=bounds)
     print(opt_res)
-    
-
-    
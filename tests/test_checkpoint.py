@@ -0,0 +1,113 @@
+import time
+
+import numpy as np
+import pytest
+
+import constants
+from models.checkpoint import ResumableSimulation
+from models.stochastic_csans import CSANModel
+
+TIMEPOINTS = [1, 2, 4]
+
+
+def get_initial_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100
+    initial_state.Es[0] = 300
+    initial_state.D = 2000
+    return initial_state
+
+
+def assert_same_samples(samples, other_samples):
+    assert len(samples) == len(other_samples)
+    for timepoint_data, other_timepoint_data in zip(samples, other_samples):
+        assert timepoint_data.keys() == other_timepoint_data.keys()
+        for time, state in timepoint_data.items():
+            assert np.array_equal(state.export_to_array(), other_timepoint_data[time].export_to_array())
+
+
+def test_resumed_simulation_is_bit_exact(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    initial_state = get_initial_state(model)
+    continued = ResumableSimulation(model, constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 3, seed=5,
+                                     checkpoint_interval=0.5)
+    interrupted_count = 0
+    while not continued.run(step_budget=300)["complete"]:
+        interrupted_count += 1
+
+    path = str(tmp_path / "simulation.pkl")
+    simulation = ResumableSimulation(model, constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 3, seed=5, path=path,
+                                     checkpoint_interval=0.5)
+    resumed_count = 0
+    while not simulation.run(step_budget=300)["complete"]:
+        resumed_count += 1
+        simulation = ResumableSimulation.resume(path, model)
+    assert resumed_count == interrupted_count > 0
+    assert_same_samples(simulation.get_result()["data"], continued.get_result()["data"])
+
+
+def test_budgets_stop_runs_inside_segments():
+    model = CSANModel(1, 1, method="sum_tree")
+    simulation = ResumableSimulation(model, constants.TEST_PARAMETERS, get_initial_state(model), [1000], seed=0,
+                                     checkpoint_interval=None)
+    start = time.perf_counter()
+    assert not simulation.run(time_budget=0.05)["complete"]
+    assert time.perf_counter() - start < 1
+    stop_time = simulation._sample["time"]
+    assert 0 < stop_time < 1000
+
+    assert not simulation.run(step_budget=10)["complete"]
+    assert simulation._sample["time"] > stop_time
+
+
+def test_max_num_steps_stops_with_a_checkpoint(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    initial_state = get_initial_state(model)
+    path = str(tmp_path / "simulation.pkl")
+    simulation = ResumableSimulation(model, constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, seed=2, path=path,
+                                     max_num_steps=50)
+    stopped_count = 0
+    while not simulation.run()["complete"]:
+        stopped_count += 1
+        simulation = ResumableSimulation.resume(path, model)
+    assert stopped_count > 0
+    assert len(simulation.get_result()["data"]) == 1
+
+
+def test_step_budget_requires_an_instrumented_method():
+    model = CSANModel(1, 1, method="hybrid")
+    simulation = ResumableSimulation(model, constants.TEST_PARAMETERS, get_initial_state(model), TIMEPOINTS, seed=0)
+    with pytest.raises(ValueError):
+        simulation.run(step_budget=100)
+
+
+def test_generate_simulation_data_resumes_from_checkpoint(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    initial_state = get_initial_state(model)
+    path = str(tmp_path / "simulation.pkl")
+    ResumableSimulation(model, constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 2, seed=1, path=path).run(step_budget=1)
+    resumed = model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 2, seed=1, checkpoint=path)
+    uninterrupted = ResumableSimulation(model, constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 2, seed=1)
+    uninterrupted.run(step_budget=1)
+    assert_same_samples(resumed["data"], uninterrupted.run()["data"])
+    with pytest.raises(ValueError):
+        model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 3, seed=1, checkpoint=path)
+
+
+def test_generate_simulation_data_checks_the_checkpoint_and_reports_completion(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    initial_state = get_initial_state(model)
+    path = str(tmp_path / "simulation.pkl")
+    result = model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 2, seed=1,
+                                            checkpoint=path, step_budget=10)
+    assert not result["complete"]
+    other_state = get_initial_state(model)
+    other_state.D = 1000
+    for changed in [dict(seed=2), dict(seed=1, method="direct"), dict(seed=1, initial_state=other_state)]:
+        arguments = dict(dict(seed=1, initial_state=initial_state), **changed)
+        with pytest.raises(ValueError):
+            model.generate_simulation_data(constants.TEST_PARAMETERS, timepoints=TIMEPOINTS, sample_count=2,
+                                           checkpoint=path, **arguments)
+    result = model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, 2, seed=1, checkpoint=path)
+    assert result["complete"]
+    assert len(result["data"]) == 2
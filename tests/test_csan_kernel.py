@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import constants
+from models.stochastic_csans import CSANModel
+
+PARAMETER_SETS = [value for name, value in vars(constants).items() if name.isupper() and isinstance(value, dict)]
+
+
+def get_random_state(model, rng):
+    state = model.get_empty_state()
+    buffer = state.export_to_array()
+    buffer[:] = rng.integers(0, 1000, size=buffer.shape)
+    return model.get_state_from_array(buffer)
+
+
+@pytest.mark.parametrize("e_receptors, t_receptors", [(1, 1), (4, 8), (3, 2)])
+def test_kernel_rates_are_bit_identical_to_event_rates(e_receptors, t_receptors):
+    model = CSANModel(e_receptors, t_receptors)
+    kernel = model.get_propensity_kernel()
+    rng = np.random.default_rng(0)
+    for parameters in PARAMETER_SETS:
+        compiled_parameters = model.compile_parameters(parameters)
+        for _ in range(5):
+            state = get_random_state(model, rng)
+            event_rates = np.array([event.get_max_rate(state, compiled_parameters) for event in model.events])
+            kernel_rates = kernel.get_rates(state.export_to_array(), compiled_parameters)
+            assert np.array_equal(kernel_rates, event_rates)
+
+
+def test_kernel_rates_of_a_batch_are_those_of_each_row():
+    model = CSANModel(4, 8)
+    kernel = model.get_propensity_kernel()
+    parameters = model.compile_parameters(constants.TEST_PARAMETERS)
+    rng = np.random.default_rng(1)
+    batch = np.stack([get_random_state(model, rng).export_to_array() for _ in range(4)])
+    rates = kernel.get_rates(batch, parameters)
+    for row, row_rates in zip(batch, rates):
+        assert np.array_equal(row_rates, kernel.get_rates(row, parameters))
+
+
+def test_kernel_rates_do_not_overflow_at_large_counts():
+    model = CSANModel(4, 8)
+    state = model.get_empty_state()
+    state.D = 3 * 10 ** 9
+    state.Es[0] = 3 * 10 ** 9
+    state.Ts[0] = 3 * 10 ** 9
+    parameters = model.compile_parameters(constants.TEST_PARAMETERS)
+    event_rates = np.array([event.get_max_rate(state, parameters) for event in model.events])
+    kernel_rates = model.get_propensity_kernel().get_rates(state.export_to_array(), parameters)
+    assert np.allclose(kernel_rates, event_rates, rtol=1e-15, atol=0)
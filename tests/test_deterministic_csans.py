@@ -0,0 +1,158 @@
+from itertools import product
+
+import numpy as np
+import pytest
+from scipy.special import binom
+
+import constants
+from scripts.deterministic_csans import CSANDetModel
+
+PARAMETER_SETS = [value for name, value in vars(constants).items() if name.isupper() and isinstance(value, dict)]
+RECEPTOR_COUNTS = [(1, 1), (2, 3), (4, 8)]
+
+
+def get_loop_derivative(model, state, parameters):
+    """The derivative as CSANDetModel computed it with Python loops over receptor states, before it was vectorized."""
+    derivative = [0] * model.dimension
+    d_index = model._get_d_index()
+
+    csans_change = 0
+    for i in range(model.e_receptors + 1):
+        csans_change -= parameters["lambda_E"] * state[model._get_e_index(i)] * (model.e_receptors - i) * state[d_index]
+    for i in range(model.t_receptors + 1):
+        csans_change -= parameters["lambda_T"] * state[model._get_t_index(i)] * (model.t_receptors - i) * state[d_index]
+    for i, j in product(range(model.e_receptors), range(model.t_receptors)):
+        csans_change += parameters["d_ET"] * state[model._get_et_index(i, j)] * j
+        csans_change += parameters["d_EDT"] * state[model._get_edt_index(i, j)] * j
+    for i in range(model.e_receptors + 1):
+        csans_change += parameters["d_E"] * state[model._get_e_index(i)] * i
+    for i, j in product(range(model.e_receptors), range(model.t_receptors)):
+        csans_change += parameters["d_ET"] * state[model._get_et_index(i, j)] * j
+    for i, j in product(range(model.e_receptors), range(model.t_receptors)):
+        csans_change += parameters["d_EDT"] * state[model._get_edt_index(i, j)] * j
+    derivative[0] = csans_change
+
+    for i in range(model.e_receptors + 1):
+        e_change = 0
+        for j in range(model.e_receptors + 1):
+            e_change += 2 * parameters["b_E"] * binom(j, i) / (2 ** j) * state[model._get_e_index(j)]
+        index = model._get_e_index(i)
+        e_change -= parameters["b_E"] * state[index]
+        e_change -= parameters["d_E"] * state[index]
+        for j in range(model.t_receptors):
+            if i != model.e_receptors:
+                e_change += state[model._get_et_index(i, j)] * parameters["d_ET"]
+        for j in range(model.t_receptors):
+            if i != 0:
+                e_change += state[model._get_edt_index(i - 1, j)] * parameters["d_EDT"]
+        if i != 0:
+            e_change += state[d_index] * state[model._get_e_index(i - 1)] * (model.e_receptors - i + 1) * parameters["lambda_E"]
+        if i != model.e_receptors:
+            e_change -= state[d_index] * state[index] * (model.e_receptors - i) * parameters["lambda_E"]
+        for j in range(model.t_receptors + 1):
+            e_bound_pro = i / model.e_receptors
+            t_bound_pro = j / model.t_receptors
+            success_prob = ((1 - e_bound_pro) * (1 - t_bound_pro) * parameters["p_E|T"]
+                            + e_bound_pro * (1 - t_bound_pro) * parameters["p_ED|T"]
+                            + (1 - e_bound_pro) * t_bound_pro * parameters["p_E|DT"])
+            total_prob = 1 - (1 - success_prob) ** parameters["M"]
+            e_change -= state[model._get_t_index(j)] * state[index] * parameters["lambda_ET"] * total_prob
+        derivative[index] = e_change
+
+    for i in range(model.t_receptors + 1):
+        t_change = 0
+        for j in range(model.t_receptors + 1):
+            t_change += 2 * parameters["b_T"] * binom(j, i) / (2 ** j) * state[model._get_t_index(j)]
+        index = model._get_t_index(i)
+        t_change -= parameters["b_T"] * state[index]
+        t_change -= parameters["d_T"] * state[index]
+        if i != 0:
+            t_change += state[model._get_t_index(i - 1)] * parameters["lambda_T"] * (model.t_receptors - i + 1) * state[d_index]
+        if i != model.t_receptors:
+            t_change -= state[index] * parameters["lambda_T"] * (model.t_receptors - i) * state[d_index]
+        # The receptor proportions are swapped here, as they were in the loop version.
+        for j in range(model.e_receptors + 1):
+            e_bound_pro = i / model.e_receptors
+            t_bound_pro = j / model.t_receptors
+            success_prob = ((1 - e_bound_pro) * (1 - t_bound_pro) * parameters["p_E|T"]
+                            + e_bound_pro * (1 - t_bound_pro) * parameters["p_ED|T"]
+                            + (1 - e_bound_pro) * t_bound_pro * parameters["p_E|DT"])
+            total_prob = 1 - (1 - success_prob) ** parameters["M"]
+            t_change -= state[index] * state[model._get_e_index(j)] * parameters["lambda_ET"] * total_prob
+        derivative[index] = t_change
+
+    def get_formation_rate(e_bound, t_bound, e_csan, t_csan):
+        single_probabilities = [model._single_success_prob(e_bound, t_bound, parameters, *csans)
+                                for csans in [(False, False), (True, False), (False, True)]]
+        single = sum(single_probabilities)
+        probability = model._single_success_prob(e_bound, t_bound, parameters, e_csan, t_csan)
+        if probability == 0:
+            return 0
+        return parameters["lambda_ET"] * (1 - (1 - single) ** parameters["M"]) * probability / single
+
+    for i, j in product(range(model.e_receptors), range(model.t_receptors)):
+        et_change = (get_formation_rate(i, j, False, False) * state[model._get_e_index(i)] * state[model._get_t_index(j)]
+                     - state[model._get_et_index(i, j)] * parameters["d_ET"])
+        derivative[model._get_et_index(i, j)] = et_change
+
+        edt_change = (get_formation_rate(i + 1, j, True, False) * state[model._get_e_index(i + 1)] * state[model._get_t_index(j)]
+                      + get_formation_rate(i, j + 1, False, True) * state[model._get_e_index(i)] * state[model._get_t_index(j + 1)]
+                      - state[model._get_edt_index(i, j)] * parameters["d_EDT"])
+        derivative[model._get_edt_index(i, j)] = edt_change
+    return derivative
+
+
+def get_random_state(model, rng):
+    return rng.uniform(0, 1000, size=model.dimension)
+
+
+@pytest.mark.parametrize("e_receptors, t_receptors", RECEPTOR_COUNTS)
+def test_derivative_agrees_with_loop_version(e_receptors, t_receptors):
+    model = CSANDetModel(e_receptors, t_receptors)
+    rng = np.random.default_rng(0)
+    for parameters in PARAMETER_SETS:
+        state = get_random_state(model, rng)
+        expected = np.array(get_loop_derivative(model, state, parameters))
+        assert np.allclose(model.get_derivative(state, parameters), expected, rtol=1e-10, atol=1e-10 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("e_receptors, t_receptors", RECEPTOR_COUNTS)
+def test_jacobian_agrees_with_differences_of_loop_version(e_receptors, t_receptors):
+    model = CSANDetModel(e_receptors, t_receptors)
+    rng = np.random.default_rng(1)
+    for parameters in PARAMETER_SETS:
+        state = get_random_state(model, rng)
+        jacobian = model.get_jacobian(state, parameters).toarray()
+        # The derivative is at most quadratic in the state, so central differences are exact up to rounding.
+        differences = np.empty_like(jacobian)
+        for column in range(model.dimension):
+            step = np.zeros(model.dimension)
+            step[column] = 1.0
+            differences[:, column] = (np.array(get_loop_derivative(model, state + step, parameters))
+                                      - np.array(get_loop_derivative(model, state - step, parameters))) / 2
+        assert np.allclose(jacobian, differences, rtol=1e-8, atol=1e-8 * max(np.abs(differences).max(), 1))
+        sparsity = model.get_jacobian_sparsity(parameters).toarray()
+        assert not np.any(jacobian[~sparsity])
+
+
+def test_run_defaults_to_sparse_bdf_for_large_systems():
+    timepoints = [0, 1, 2]
+    small_model = CSANDetModel(2, 3)
+    initial_state = small_model.get_initial_state(20000, 30000, 10000)
+    assert np.allclose(small_model.run(constants.EFFECTIVE_PARAMS, initial_state, timepoints),
+                       small_model.run(constants.EFFECTIVE_PARAMS, initial_state, timepoints, method="odeint"))
+
+    large_model = CSANDetModel(2, 3)
+    large_model.dense_jacobian_max_dimension = large_model.dimension - 1
+    assert np.allclose(large_model.run(constants.EFFECTIVE_PARAMS, initial_state, timepoints),
+                       large_model.run(constants.EFFECTIVE_PARAMS, initial_state, timepoints, method="BDF"))
+
+
+def test_run_batch_matches_runs_of_each_system():
+    model = CSANDetModel(2, 3)
+    timepoints = [0, 1, 2, 4]
+    initial_states = [model.get_initial_state(dose, 30000, 10000) for dose in (0, 10000, 40000)]
+    runs = np.array([model.run(constants.EFFECTIVE_PARAMS, state, timepoints) for state in initial_states])
+    assert np.array_equal(model.run_batch(constants.EFFECTIVE_PARAMS, initial_states, timepoints), runs)
+    stacked = model.run_batch(constants.EFFECTIVE_PARAMS, initial_states, timepoints, stacked=True, rtol=1e-8, atol=1e-6)
+    assert np.allclose(stacked, runs, rtol=1e-4, atol=1e-3)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+import constants
+from models.metrics import RunMetrics
+from models.stochastic_csans import CSANModel
+
+# Drug binding to T cells and internalization only, at copy numbers where tau leaping takes long leaps.
+BINDING_PARAMETERS = dict(constants.TEST_PARAMETERS, b_T=0, lambda_T=0, lambda_ET=0, d_E=0.1, lambda_E=1e-5, mu_E=0.5)
+
+
+def get_initial_state(model, scale=1):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100 * scale
+    initial_state.Es[0] = 300 * scale
+    initial_state.D = 2000 * scale
+    return initial_state
+
+
+def get_binding_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Es[0] = 2000
+    initial_state.Es[1] = 1000
+    initial_state.D = 20000
+    return initial_state
+
+
+def get_final_counts(model, parameters, initial_state, method, duration, sample_count, seed, **options):
+    """Returns the drug count and T cell counts at duration of sample_count runs, as a (samples x 3) array."""
+    counts = []
+    for sample_seed in np.random.SeedSequence(seed).spawn(sample_count):
+        state = model.run(parameters, initial_state, duration, method=method, rng=sample_seed, **options)
+        counts.append([state.D, sum(state.Es), sum(state.Ts)])
+    return np.array(counts, dtype=float)
+
+
+def assert_means_agree(samples, reference, standard_errors=5):
+    difference = np.abs(samples.mean(axis=0) - reference.mean(axis=0))
+    standard_error = np.sqrt(samples.var(axis=0) / len(samples) + reference.var(axis=0) / len(reference))
+    assert np.all(difference <= standard_errors * standard_error + 1e-9), (samples.mean(axis=0), reference.mean(axis=0))
+
+
+@pytest.mark.parametrize("method", ["next_reaction", "sum_tree"])
+def test_exact_engine_means_agree_with_direct(method):
+    model = CSANModel(1, 1)
+    initial_state = get_initial_state(model)
+    reference = get_final_counts(model, constants.TEST_PARAMETERS, initial_state, "direct", 1, 150, seed=0)
+    samples = get_final_counts(model, constants.TEST_PARAMETERS, initial_state, method, 1, 150, seed=1)
+    assert_means_agree(samples, reference)
+
+
+def test_tau_leap_means_agree_with_ssa():
+    model = CSANModel(1, 1)
+    initial_state = get_binding_state(model)
+    reference = get_final_counts(model, BINDING_PARAMETERS, initial_state, "sum_tree", 1, 200, seed=0)
+    metrics = RunMetrics()
+    leaped = get_final_counts(model, BINDING_PARAMETERS, initial_state, "tau_leap", 1, 200, seed=1, metrics=metrics)
+    assert sum(metrics.firings.values()) > 10 * metrics.steps
+    assert_means_agree(leaped, reference)
+
+
+def test_tau_leap_leaps_at_high_copy_numbers():
+    model = CSANModel(1, 1)
+    metrics = RunMetrics()
+    model.run(constants.TEST_PARAMETERS, get_initial_state(model, 100), 0.1, method="tau_leap", rng=0, metrics=metrics)
+    assert sum(metrics.firings.values()) > 10 * metrics.steps
+
+
+def test_tau_leap_leaps_at_thousands_of_cells_and_a_realistic_dose():
+    model = CSANModel(1, 1, method="tau_leap")
+    initial_state = get_initial_state(model, 100)
+    initial_state.D = 640000
+    metrics = RunMetrics()
+    final_state = model.run(constants.SIMPLE_D41_PARAMETERS, initial_state, 0.05, rng=0, metrics=metrics)
+    assert sum(metrics.firings.values()) > 10 * metrics.steps
+    assert final_state.verify_coherence()
+
+
+def test_tau_leap_records_timepoints():
+    model = CSANModel(1, 1)
+    timepoints = [0, 0.25, 0.5, 1]
+    states = model.run_recorded(BINDING_PARAMETERS, get_binding_state(model), timepoints, method="tau_leap", rng=0)
+    assert len(states) == len(timepoints)
+    assert states[0].D == 20000
+    assert all(state.verify_coherence() for state in states)
+
+
+def test_batched_simulation_agrees_with_generate_simulation_data():
+    model = CSANModel(2, 3)
+    initial_state = get_initial_state(model)
+    timepoints = [0.1, 0.3]
+    batched = model.generate_batched_simulation_data(constants.TEST_PARAMETERS, initial_state, timepoints, 200, rng=0)
+    reference = model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, timepoints, 200, seed=1,
+                                               method="sum_tree", progress=None)
+    for time in timepoints:
+        assert_means_agree(np.array([[sample[time].D, sum(sample[time].Ts)] for sample in batched["data"]], dtype=float),
+                           np.array([[sample[time].D, sum(sample[time].Ts)] for sample in reference["data"]], dtype=float))
+
+
+def test_hybrid_means_agree_with_direct():
+    model = CSANModel(1, 1)
+    initial_state = get_binding_state(model)
+    reference = get_final_counts(model, BINDING_PARAMETERS, initial_state, "direct", 1, 150, seed=0)
+    samples = get_final_counts(model, BINDING_PARAMETERS, initial_state, "hybrid", 1, 150, seed=1, noise=True)
+    assert_means_agree(samples, reference)
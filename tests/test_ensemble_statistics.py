@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from models.ensemble_statistics import EnsembleSummary, P2Quantile, RunningMoments
+
+
+@pytest.mark.parametrize("p", [0.05, 0.5, 0.95])
+def test_p2_quantiles_agree_with_numpy(p):
+    rng = np.random.default_rng(0)
+    # Every entry of the arrays follows a different distribution.
+    samples = np.stack([rng.normal(size=5000), rng.exponential(size=5000), rng.integers(0, 50, size=5000),
+                        rng.lognormal(size=5000)], axis=-1).reshape(5000, 2, 2)
+    estimate = P2Quantile(p)
+    for values in samples:
+        estimate.add(values)
+    # The fractions of samples below and up to the estimate bracket p, whatever the scale of the entry and its ties.
+    below = (samples < estimate.value).mean(axis=0)
+    up_to = (samples <= estimate.value).mean(axis=0)
+    assert np.all((below < p + 0.015) & (up_to > p - 0.015)), (estimate.value, np.quantile(samples, p, axis=0))
+    assert np.allclose(estimate.value[0], np.quantile(samples, p, axis=0)[0], atol=0.1)
+
+
+def test_p2_quantiles_are_exact_for_few_samples():
+    samples = np.array([[3.0, 1.0], [1.0, 4.0], [2.0, 0.0], [5.0, 2.0]])
+    estimate = P2Quantile(0.25)
+    for count, values in enumerate(samples, 1):
+        estimate.add(values)
+        assert np.array_equal(estimate.value, np.quantile(samples[:count], 0.25, axis=0))
+
+
+def test_running_moments_agree_with_numpy():
+    samples = np.random.default_rng(1).normal(3, 2, size=(1000, 3, 2))
+    moments = RunningMoments()
+    for values in samples:
+        moments.add(values)
+    assert np.allclose(moments.mean, samples.mean(axis=0))
+    assert np.allclose(moments.variance, samples.var(axis=0, ddof=1))
+
+
+def test_ensemble_summary_of_samples():
+    rng = np.random.default_rng(2)
+    values = rng.poisson(10, size=(500, 3))
+    summary = EnsembleSummary({"count": lambda state: state}, quantiles=(0.5,))
+    for sample_values in values:
+        summary.add(dict(zip([0, 1, 2], sample_values)))
+    result = summary.get_summary()
+    assert result["timepoints"] == [0, 1, 2]
+    assert result["sample_count"] == 500
+    assert np.allclose(result["observables"]["count"]["mean"], values.mean(axis=0))
+    assert np.allclose(result["observables"]["count"]["variance"], values.var(axis=0, ddof=1))
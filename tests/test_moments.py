@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import constants
+from models.moments import MomentEquations
+from models.stochastic_csans import CSANModel
+
+TIMEPOINTS = [0.5, 1, 2]
+SAMPLE_COUNT = 300
+
+
+@pytest.fixture(scope="module")
+def model():
+    return CSANModel(1, 1, method="sum_tree")
+
+
+@pytest.fixture(scope="module")
+def initial_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100
+    initial_state.Es[0] = 300
+    initial_state.D = 2000
+    return initial_state
+
+
+@pytest.fixture(scope="module")
+def ensemble(model, initial_state):
+    """The states of SAMPLE_COUNT SSA samples at TIMEPOINTS, as a (samples x timepoints x dimension) array."""
+    data = model.generate_simulation_data(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS, SAMPLE_COUNT, seed=0,
+                                          progress=None)["data"]
+    return np.array([[timepoint_data[time].export_to_array() for time in TIMEPOINTS] for timepoint_data in data],
+                    dtype=float)
+
+
+@pytest.mark.parametrize("closure", MomentEquations.closures)
+def test_moments_agree_with_ssa(model, initial_state, ensemble, closure):
+    moments = MomentEquations(model, closure).solve(constants.TEST_PARAMETERS, initial_state, TIMEPOINTS,
+                                                    rtol=1e-6, atol=1e-6)
+    assert moments["timepoints"] == [0] + TIMEPOINTS
+    means = moments["means"][1:]
+    variances = np.einsum("tii->ti", moments["covariances"][1:])
+    sample_means = ensemble.mean(axis=0)
+    sample_variances = ensemble.var(axis=0, ddof=1)
+    assert np.all(np.abs(means - sample_means) <= 5 * np.sqrt(sample_variances / SAMPLE_COUNT) + 1e-6)
+    # The sample variance of roughly normal counts has a relative standard error of sqrt(2 / samples).
+    assert np.all(np.abs(variances - sample_variances) <= 5 * np.sqrt(2 / SAMPLE_COUNT) * sample_variances + 1e-6)
@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import constants
+from models.random_stream import as_random_stream
+from models.stochastic_csans import CSANModel
+
+TIMEPOINTS = [0.5, 1, 2]
+
+
+def get_initial_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100
+    initial_state.Es[0] = 300
+    initial_state.D = 2000
+    return initial_state
+
+
+def get_data_arrays(simulation_result):
+    return [np.array([timepoint_data[time].export_to_array() for time in TIMEPOINTS])
+            for timepoint_data in simulation_result["data"]]
+
+
+def test_streams_from_the_same_seed_agree():
+    stream, other_stream = as_random_stream(3), as_random_stream(np.random.default_rng(3))
+    assert [stream.random() for _ in range(20)] == [other_stream.random() for _ in range(20)]
+    assert [stream.exponential() for _ in range(20)] == [other_stream.exponential() for _ in range(20)]
+
+
+def test_samples_do_not_depend_on_workers():
+    model = CSANModel(1, 1, method="sum_tree")
+    arguments = (constants.TEST_PARAMETERS, get_initial_state(model), TIMEPOINTS, 6)
+    serial = get_data_arrays(model.generate_simulation_data(*arguments, seed=11, progress=None))
+    processes = get_data_arrays(model.generate_simulation_data(*arguments, seed=11, workers=2, chunksize=1, progress=None))
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        threads = get_data_arrays(model.generate_simulation_data(*arguments, seed=np.random.SeedSequence(11),
+                                                                 executor=executor, chunksize=2, progress=None))
+    assert all(np.array_equal(sample, other_sample) for sample, other_sample in zip(serial, processes))
+    assert all(np.array_equal(sample, other_sample) for sample, other_sample in zip(serial, threads))
+    other_seed = get_data_arrays(model.generate_simulation_data(*arguments, seed=12, progress=None))
+    assert not all(np.array_equal(sample, other_sample) for sample, other_sample in zip(serial, other_seed))
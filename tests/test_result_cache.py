@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+import constants
+from models.result_cache import ResultCache
+from models.stochastic_csans import CSANModel
+
+TIMEPOINTS = [0.5, 1]
+
+
+def get_initial_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100
+    initial_state.Es[0] = 300
+    initial_state.D = 2000
+    return initial_state
+
+
+def generate(model, cache, seed, parameters=constants.TEST_PARAMETERS, **kwargs):
+    return model.generate_simulation_data(parameters, get_initial_state(model), TIMEPOINTS, 3, cache=cache, seed=seed,
+                                          progress=None, **kwargs)["data"]
+
+
+def assert_same_samples(samples, other_samples):
+    assert len(samples) == len(other_samples)
+    for timepoint_data, other_timepoint_data in zip(samples, other_samples):
+        assert list(timepoint_data) == list(other_timepoint_data)
+        for time, state in timepoint_data.items():
+            assert np.array_equal(state.export_to_array(), other_timepoint_data[time].export_to_array())
+
+
+def test_second_call_hits(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    cache = ResultCache(str(tmp_path))
+    simulated = generate(model, cache, seed=3)
+    cached = generate(model, cache, seed=3)
+    assert_same_samples(cached, simulated)
+    assert_same_samples(cached, generate(model, None, seed=3))
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    generate(model, cache, seed=None)
+    assert cache.get_stats()["entries"] == 1
+
+
+def test_key_depends_on_every_argument(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    cache = ResultCache(str(tmp_path))
+    initial_state = get_initial_state(model)
+
+    def get_key(parameters=constants.TEST_PARAMETERS, seed=3, **kwargs):
+        return cache.get_key(model, parameters, initial_state, TIMEPOINTS, 3, seed, **kwargs)
+
+    key = get_key()
+    assert key == get_key(parameters=dict(constants.TEST_PARAMETERS))
+    assert key == get_key(seed=np.int64(3)) != get_key(seed=4)
+    assert key != get_key(parameters=dict(constants.TEST_PARAMETERS, d_E=0.5))
+    assert key != get_key(method="direct")
+    assert key != cache.get_key(CSANModel(1, 2, method="sum_tree"), constants.TEST_PARAMETERS,
+                                get_initial_state(CSANModel(1, 2)), TIMEPOINTS, 3, 3)
+    assert get_key(seed=np.random.SeedSequence(3)) != get_key(seed=np.random.SeedSequence(4))
+    assert get_key(early_stop=lambda timepoint_data: False) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    cache = ResultCache(str(tmp_path))
+    paths = []
+    for seed in [1, 2]:
+        generate(model, cache, seed=seed)
+        key = cache.get_key(model, constants.TEST_PARAMETERS, get_initial_state(model), TIMEPOINTS, 3, seed)
+        paths.append(cache._get_path(key, ".npz"))
+        os.utime(paths[-1], (seed, seed))
+    # Reading the older entry makes the other one the least recently used.
+    generate(model, cache, seed=1)
+    cache.max_bytes = 2.5 * os.path.getsize(paths[0])
+    generate(model, cache, seed=5)
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert cache.get_stats()["entries"] == 2
+
+
+def test_seed_sequence_is_spawned_after_a_hit(tmp_path):
+    model = CSANModel(1, 1, method="sum_tree")
+    cache = ResultCache(str(tmp_path))
+    simulated_seed, cached_seed = np.random.SeedSequence(7), np.random.SeedSequence(7)
+    generate(model, cache, seed=simulated_seed)
+    generate(model, cache, seed=cached_seed)
+    assert cache.hits == 1
+    assert cached_seed.n_children_spawned == simulated_seed.n_children_spawned == 3
+    assert_same_samples(generate(model, cache, seed=cached_seed), generate(model, None, seed=simulated_seed))
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import constants
+from models.stochastic_csans import CSANModel
+from models.trajectory_store import TrajectoryStore
+
+TIMEPOINTS = [0.5, 1, 2]
+
+
+def get_initial_state(model):
+    initial_state = model.get_empty_state()
+    initial_state.Ts[0] = 100
+    initial_state.Es[0] = 300
+    initial_state.D = 2000
+    return initial_state
+
+
+def test_samples_round_trip_and_survive_growing(tmp_path):
+    model = CSANModel(1, 2, method="sum_tree")
+    samples = model.generate_simulation_data(constants.TEST_PARAMETERS, get_initial_state(model), TIMEPOINTS, 5,
+                                             seed=0, progress=None)["data"]
+    path = str(tmp_path / "samples.npy")
+    store = TrajectoryStore.create(path, 1, 2, TIMEPOINTS, constants.TEST_PARAMETERS, capacity=2, seed=0)
+    store.extend(samples[:3])
+    store.append(np.array([samples[3][time].export_to_array() for time in TIMEPOINTS]))
+    store.extend(samples[4:])
+    assert store._data.shape[0] == 8
+
+    reopened = TrajectoryStore(path)
+    assert len(reopened) == 5
+    assert reopened.timepoints == TIMEPOINTS
+    assert reopened.metadata["parameters"] == constants.TEST_PARAMETERS
+    assert reopened.metadata["seed"] == 0
+    for sample, stored_sample in zip(samples, reopened.iterate_samples()):
+        assert list(stored_sample) == TIMEPOINTS
+        for time in TIMEPOINTS:
+            assert np.array_equal(stored_sample[time].export_to_array(), sample[time].export_to_array())
+            assert stored_sample[time].verify_coherence()
+    assert reopened.array.shape == (5, len(TIMEPOINTS), model.get_dimension())
+    with pytest.raises(ValueError):
+        reopened.append(samples[0])